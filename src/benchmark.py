@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+from datetime import date
+import numpy as np
+import pandas as pd
+
+import data_loading as dl
+import data_processing as dp
+import list_preparation as lp
+import plotting_functions as pf
+
+# Synthetic data used instead of the ecoinvent csv files (see generate_system_model)
+benchmark_path = "../data/benchmark"
+compartments = ["air", "water", "soil", "natural resource"]
+geographies = ["GLO", "RoW", "RER", "CH", "DE", "FR", "US", "CN", "IN", "BR"]
+
+
+def zipf_choice(rng, n, size, exponent=1.1):
+    """
+    This function draws indices between 0 and n - 1 with a few very popular indices and a long tail of rare ones,
+    like the inputs (electricity, transport) and the emissions (carbon dioxide) of the ecoinvent activities.
+    """
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def unique_exchanges(rows, columns, coefficients):
+    """
+    This function removes the repeated (row, column) pairs of generated exchanges and sorts them by column.
+    """
+    exchanges = pd.DataFrame({"row": rows, "column": columns, "coefficient": coefficients})
+    return exchanges.drop_duplicates(["row", "column"]).sort_values(["column", "row"]).reset_index(drop=True)
+
+
+def generate_system_model(path, system_model="cutoff", n_activities=20000, n_flows=4000, n_methods=700, seed=0):
+    """
+    This function writes synthetic csv files with the shape of an ecoinvent system model, so that the performance can
+    be measured without the licensed data. Every product has a market that buys from its producers (plus transport),
+    a few products also have a market group, and the producers buy from the markets of other products, the popular
+    ones (e.g. electricity) much more often. The number of inputs, emissions and characterization factors per column
+    is heavy tailed as in ecoinvent. The inputs of each activity sum up to less than 1, so that the A-Matrix can
+    be inverted.
+
+    Required arguments:
+    - path: string, path to where the csv files are stored in folders by system model, e.g. "../data/benchmark/raw"
+
+    Optional arguments:
+    - system_model: string, one of either "cutoff", "apos" or "consequential". Default is "cutoff".
+    - n_activities: int, number of activities (products of ie_index). Default is 20000.
+    - n_flows: int, number of elementary exchanges (ee_index). Default is 4000.
+    - n_methods: int, number of LCIA methods (LCIA_index). Default is 700.
+    - seed: int, seed of the random numbers, the same seed gives the same files. Default is 0.
+
+    Returns:
+    - no returns, the six csv files are written to path/system_model
+    """
+    rng = np.random.default_rng(seed)
+    n_products = max(1, n_activities // 4)
+    n_groups = n_products // 50
+    n_producers = n_activities - n_products - n_groups
+    if n_producers < n_products:
+        raise ValueError("n_activities is too small, at least 2 activities per product are needed.")
+
+    # Activities: one market per product, a few market groups, then at least one producer per product
+    group_products = rng.choice(n_products, n_groups, replace=False)
+    producer_products = np.concatenate([np.arange(n_products),
+                                        rng.integers(0, n_products, n_producers - n_products)])
+    activity_products = np.concatenate([np.arange(n_products), group_products, producer_products])
+    product_names = np.array([f"synthetic product {p}, grade {p % 7}" for p in range(n_products)], dtype=object)
+    activity_names = ([f"market for synthetic product {p}, grade {p % 7}" for p in range(n_products)] +
+                      [f"market group for synthetic product {p}, grade {p % 7}" for p in group_products] +
+                      [f"synthetic product {p} production, route {i} with a long description of the technology"
+                       for i, p in enumerate(producer_products)])
+    ie_index = pd.DataFrame({"activityName": activity_names,
+                             "geography": rng.choice(geographies, n_activities),
+                             "product": product_names[activity_products],
+                             "unit": rng.choice(["kg", "kWh", "MJ", "m3", "unit", "tkm"], n_activities)})
+    producers = n_products + n_groups + np.arange(n_producers)
+
+    # A: inputs of the markets from the producers of their product, with a small loss
+    producer_order = np.argsort(producer_products, kind="mergesort")
+    market_inputs = pd.DataFrame({"row": producers[producer_order], "column": producer_products[producer_order],
+                                  "weight": rng.gamma(0.5, size=n_producers)})
+    market_inputs["coefficient"] = -0.9 * market_inputs["weight"] / market_inputs.groupby("column")["weight"].transform(
+        "sum")
+    # Transport of the markets from the first (popular) markets
+    n_transport = rng.integers(0, 3, n_products)
+    transport = pd.DataFrame({"row": zipf_choice(rng, n_products, n_transport.sum()),
+                              "column": np.repeat(np.arange(n_products), n_transport),
+                              "coefficient": -rng.uniform(0.001, 0.03, n_transport.sum())})
+    # Market groups buy from the market of their product and a few other markets
+    n_group_inputs = rng.integers(1, 5, n_groups)
+    group_inputs = pd.DataFrame({"row": np.concatenate([group_products,
+                                                        rng.integers(0, n_products, n_group_inputs.sum())]),
+                                 "column": np.concatenate([n_products + np.arange(n_groups),
+                                                           np.repeat(n_products + np.arange(n_groups),
+                                                                     n_group_inputs)]),
+                                 "weight": rng.gamma(1.0, size=n_groups + n_group_inputs.sum())})
+    group_inputs["coefficient"] = -0.95 * group_inputs["weight"] / group_inputs.groupby("column")["weight"].transform(
+        "sum")
+    # Producers buy from the markets, heavy tailed number of inputs with a few dominant ones
+    n_inputs = np.clip(rng.lognormal(np.log(8), 0.8, n_producers), 1, 300).astype(int)
+    producer_inputs = pd.DataFrame({"row": zipf_choice(rng, n_products, n_inputs.sum(), 0.9),
+                                    "column": np.repeat(producers, n_inputs)})
+    producer_inputs = producer_inputs.drop_duplicates(["row", "column"])
+    producer_inputs["weight"] = rng.gamma(0.3, size=len(producer_inputs)) + 1e-6
+    producer_inputs["coefficient"] = (-rng.uniform(0.3, 0.95, n_activities)[producer_inputs["column"].values] *
+                                      producer_inputs["weight"] /
+                                      producer_inputs.groupby("column")["weight"].transform("sum"))
+    # Some inputs are by-products that give credits
+    credits = rng.random(len(producer_inputs)) < 0.03
+    producer_inputs.loc[credits, "coefficient"] *= -0.1
+
+    exchanges = pd.concat([pd.DataFrame({"row": np.arange(n_activities), "column": np.arange(n_activities),
+                                         "coefficient": 1.0}),
+                           market_inputs, transport, group_inputs, producer_inputs])
+    exchanges = exchanges[(exchanges["row"] != exchanges["column"]) | (exchanges["coefficient"] == 1.0)]
+    A_public = unique_exchanges(exchanges["row"].values, exchanges["column"].values, exchanges["coefficient"].values)
+
+    # B: heavy tailed number of emissions of the producers, few emissions of the markets
+    n_emissions = np.concatenate([rng.integers(0, 3, n_products + n_groups),
+                                  np.clip(rng.lognormal(np.log(15), 0.9, n_producers), 1, 400).astype(int)])
+    B_public = unique_exchanges(zipf_choice(rng, n_flows, n_emissions.sum()),
+                                np.repeat(np.arange(n_activities), n_emissions),
+                                rng.lognormal(-4, 2.5, n_emissions.sum()))
+    ee_index = pd.DataFrame({"name": [f"synthetic substance {i}" for i in range(n_flows)],
+                             "compartment": rng.choice(compartments, n_flows, p=[0.45, 0.3, 0.1, 0.15]),
+                             "subcompartment": rng.choice(["unspecified", "urban air close to ground",
+                                                           "surface water", "in ground"], n_flows),
+                             "unit": "kg"})
+
+    # C: heavy tailed number of characterization factors per method, mostly for the common flows
+    n_factors = np.clip(rng.lognormal(np.log(60), 1.5, n_methods), 1, n_flows).astype(int)
+    factors = rng.lognormal(0, 2, n_factors.sum())
+    factors[rng.random(n_factors.sum()) < 0.05] *= -1
+    C_public = unique_exchanges(np.repeat(np.arange(n_methods), n_factors),
+                                zipf_choice(rng, n_flows, n_factors.sum(), 0.7), factors)
+    C_public = C_public.sort_values(["row", "column"]).reset_index(drop=True)
+    LCIA_index = pd.DataFrame({"method": [f"synthetic method {m % 40}" for m in range(n_methods)],
+                               "category": [f"category {m % 25}" for m in range(n_methods)],
+                               "indicator": [f"indicator {m}" for m in range(n_methods)],
+                               "unit": rng.choice(["kg CO2-Eq", "kg SO2-Eq", "MJ", "points"], n_methods)})
+
+    os.makedirs(f"{path}/{system_model}", exist_ok=True)
+    A_public.to_csv(f"{path}/{system_model}/A_public.csv", sep=";", index=False)
+    B_public.to_csv(f"{path}/{system_model}/B_public.csv", sep=";", index=False)
+    C_public.to_csv(f"{path}/{system_model}/C_public.csv", sep=";", index=False)
+    ee_index.to_csv(f"{path}/{system_model}/ee_index.csv", sep=";", index_label="index")
+    ie_index.to_csv(f"{path}/{system_model}/ie_index.csv", sep=";", index_label="index", encoding="latin1")
+    LCIA_index.to_csv(f"{path}/{system_model}/LCIA_index.csv", sep=";", index_label="index")
+
+
+def timed(timings, stage, function, *args, **kwargs):
+    """
+    This function runs a function and adds its run time to the timings of a stage.
+
+    Required arguments:
+    - timings: dictionary with the stage names as keys and lists of run times in seconds as values
+    - stage: string, the name of the stage, e.g. "sort_datasets"
+    - function: the function to be timed, called with the remaining arguments
+
+    Returns:
+    - the result of the function
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+
+def benchmark_stages(system_model, data_path, n_activities, n_flows, n_methods, n_products, n_plot_methods, seed,
+                     export):
+    """
+    This function runs and times the stages of the plotting on the synthetic data in data_path, see run_benchmark.
+
+    Returns:
+    - timings: dictionary with the stage names as keys and lists of run times in seconds as values
+    - errors: dictionary with the stage names as keys and the error messages as values
+    - method_index_list: list of int, the plotted methods
+    - prod_index_list: list of int, the plotted products
+    """
+    timings = {}
+    errors = {}
+
+    if not os.path.exists(f"{dl.path}/{system_model}/LCIA_index.csv"):
+        timed(timings, "generate_system_model", generate_system_model, dl.path, system_model, n_activities, n_flows,
+              n_methods, seed)
+
+    # Import, from the csv files and from the binary cache
+    matrices = timed(timings, "import_data (csv)", dl.import_data, dl.path, system_model, use_cache=False)
+    dl.import_data(dl.path, system_model)
+    timed(timings, "import_data (cache)", dl.import_data, dl.path, system_model)
+
+    # Lcia scores of all the methods, and on demand for the plotted methods only (the score store is empty)
+    rng = np.random.default_rng(seed)
+    method_index_list = sorted(rng.choice(n_methods, min(n_plot_methods, n_methods), replace=False).tolist())
+    timed(timings, "calculate_impact_scores (all methods)", dl.calculate_impact_scores,
+          *[matrix.copy() for matrix in matrices], use_store=False)
+    timed(timings, "select_system_model", dl.select_system_model, system_model)
+    timed(timings, "solve_methods (plotted methods)", dl.solve_methods, method_index_list)
+
+    # Data, figures and export per product
+    prod_index_list = sorted(rng.choice(n_activities, min(n_products, n_activities), replace=False).tolist())
+    for prod_index in prod_index_list:
+        timed(timings, "create_dfs_barplots", dp.create_dfs_barplots, prod_index, method_index_list)
+        for method_index in method_index_list:
+            timed(timings, "sort_datasets", lp.sort_datasets, prod_index, method_index)
+    timed(timings, "create_dfs_barplots_batch", dp.create_dfs_barplots_batch, prod_index_list, method_index_list)
+
+    # The figures are collected instead of exported, so that building and exporting them are measured separately
+    export_figure = pf.export_figure
+    figures = []
+    pf.export_figure = lambda fig, fig_path, formats=None: figures.append((fig, fig_path))
+    try:
+        for prod_index in prod_index_list:
+            timed(timings, "barplot (figure)", pf.barplot, system_model, prod_index, dl.l_break, method_index_list,
+                  save_fig=True)
+            for item in pf.treemap_lists(system_model, prod_index, method_index_list):
+                fig, log_row = timed(timings, "treemap (figure)", pf.treemap_figure, item)
+                if fig is not None:
+                    figures.append((fig, pf.treemap_path(system_model, prod_index, item["method_index"])))
+    finally:
+        pf.export_figure = export_figure
+
+    if export:
+        os.makedirs(f"{data_path}/plots", exist_ok=True)
+        for fig, fig_path in figures:
+            try:
+                timed(timings, "export_figure", pf.export_figure, fig,
+                      f"{data_path}/plots/{os.path.basename(fig_path)}")
+            except Exception as e:
+                errors["export_figure"] = str(e)
+                break
+
+    return timings, errors, method_index_list, prod_index_list
+
+
+def run_benchmark(n_activities=20000, n_flows=4000, n_methods=700, n_products=200, n_plot_methods=3, seed=0,
+                  export=True, path=None):
+    """
+    This function measures the performance of the stages of the plotting on synthetic data
+    (see generate_system_model): the import of the csv files and of the binary cache, the calculation of the lcia
+    scores (all the methods, and on demand for the plotted methods), the data of the bar plots and the treemaps, the
+    figures and their export. The data is only generated once per size and seed, the lcia scores are calculated
+    in every run with an empty score store. The settings of data_loading and a system model loaded before are
+    restored at the end.
+
+    Optional arguments:
+    - n_activities, n_flows, n_methods: int, size of the synthetic system model. Default is 20000, 4000 and 700,
+        about the size of an ecoinvent release.
+    - n_products: int, number of randomly chosen products that are plotted. Default is 200.
+    - n_plot_methods: int, number of randomly chosen methods that are plotted. Default is 3.
+    - seed: int, seed of the synthetic data and of the chosen products and methods. Default is 0.
+    - export: bool, if True, the export of the figures is measured as well (requires the image export engine of
+        plotly). Default is True.
+    - path: string, path of the json file with the results. Default is a new file in the logs folder.
+
+    Returns:
+    - results: dictionary with the configuration, the environment and per stage the number of runs, the total,
+        mean and maximum run time in seconds; also written to path as json
+    """
+    system_model = "cutoff"
+    data_path = f"{benchmark_path}/a{n_activities}_f{n_flows}_m{n_methods}_s{seed}"
+    settings = {"path": dl.path, "cache_path": dl.cache_path, "score_path": dl.score_path,
+                "lcia_on_demand": dl.lcia_on_demand}
+    loaded_model = dl.loaded_models.pop(system_model, None)
+    selected_system_model = dl.selected_system_model
+
+    os.makedirs(data_path, exist_ok=True)
+    dl.path = f"{data_path}/raw"
+    dl.cache_path = f"{data_path}/cache"
+    dl.score_path = tempfile.mkdtemp(prefix="scores_", dir=data_path)
+    dl.lcia_on_demand = True
+    dp.treemap_cache.clear()
+    dp.exchange_cache.clear()
+    try:
+        timings, errors, method_index_list, prod_index_list = benchmark_stages(
+            system_model, data_path, n_activities, n_flows, n_methods, n_products, n_plot_methods, seed, export)
+    finally:
+        shutil.rmtree(dl.score_path, ignore_errors=True)
+        for name, value in settings.items():
+            setattr(dl, name, value)
+        dl.loaded_models.pop(system_model, None)
+        if loaded_model is not None:
+            dl.loaded_models[system_model] = loaded_model
+        dp.treemap_cache.clear()
+        dp.exchange_cache.clear()
+        if selected_system_model is not None:
+            dl.select_system_model(selected_system_model)
+        else:
+            dl.selected_system_model = None
+
+    results = {"config": {"n_activities": n_activities, "n_flows": n_flows, "n_methods": n_methods,
+                          "n_products": len(prod_index_list), "method_index_list": method_index_list, "seed": seed,
+                          "image_formats": dl.image_formats},
+               "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                               "pandas": pd.__version__, "platform": platform.platform(),
+                               "cpu_count": os.cpu_count()},
+               "stages": {stage: {"count": len(times), "total": sum(times), "mean": sum(times) / len(times),
+                                  "max": max(times)} for stage, times in timings.items()},
+               "errors": errors}
+
+    if path is None:
+        os.makedirs("../logs", exist_ok=True)
+        path = f"../logs/benchmark_{date.today().strftime('%d-%m-%Y')}_{time.strftime('%H-%M-%S')}.json"
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the plotting on synthetic ecoinvent-shaped data.")
+    parser.add_argument("--activities", type=int, default=20000)
+    parser.add_argument("--flows", type=int, default=4000)
+    parser.add_argument("--methods", type=int, default=700)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--plot-methods", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-export", action="store_true", help="do not measure the export of the figures")
+    parser.add_argument("--output", default=None, help="path of the json file with the results")
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmark(args.activities, args.flows, args.methods, args.products, args.plot_methods,
+                                      args.seed, not args.no_export, args.output)
+    json.dump(benchmark_results, sys.stdout, indent=2)
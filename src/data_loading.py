@@ -1,9 +1,18 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+import numpy as np
 import pandas as pd
 import scipy.sparse as sp
-from pypardiso import spsolve
+from pypardiso import spsolve, PyPardisoSolver
 
 
 path = "../data/raw"
+cache_path = "../data/cache"
+score_path = "../data/scores"
+system_models = ["cutoff", "apos", "consequential"]
 
 red_orig = 'rgba(237,28,36, 1)'
 red2_orig = 'rgba(237,28,36, 0.5)'
@@ -23,179 +32,605 @@ hues_barplots = [red_orig, black_orig, grey3B_orig, grey2B_orig, red2_orig, grey
 hues_treemaps = ["rgb(119, 119, 119)", "rgb(255, 170, 170)", "rgb(0, 140, 100)", "rgb(180, 235, 200)"]
 font_type = "Helvetica"
 l_break = 3
+# Formats every figure is exported to (any format supported by plotly.io.write_image, e.g. "png", "svg", "pdf")
+image_formats = ["png"]
+# Format of the progress logs of the plotting, one of "csv", "jsonl", "sqlite" (see open_log)
+log_format = "csv"
+# Manifest of the plotted items, used to resume interrupted runs (see open_manifest)
+manifest_path = "../logs/manifest.sqlite"
+# Number of products whose bar plot data is calculated at once (see create_barplots and barplot_dfs)
+barplot_batch_size = 100
+# If True, lcia scores are only calculated for the methods that are actually plotted (see solve_methods). The full
+# lcia-Matrix (lcia, lcia_df) is then not available, the scores are read with lcia_scores instead
+lcia_on_demand = False
+
+# Source files of one system model and the binary cache that replaces them after the first import
+exchange_files = ["A_public", "B_public", "C_public"]
+index_files = ["ee_index", "ie_index", "LCIA_index"]
+# Text columns that are grouped, searched or edited while plotting and are therefore not stored as categories
+label_columns = ["activityName", "product", "name", "compartment"]
+# 'Flow compartment' of the bar plots for the inputs from other activities
+technosphere_cat = "Inputs f. technosphere"
+
+
+def source_signature(path, system_model):
+    """
+    This function records the modification time and size of the csv files of one system model. It is used to
+    check if the binary cache is still up to date.
+
+    Required arguments:
+    - path: string, path to where the csv files are stored in folders by system model, e.g. "../data/raw"
+    - system_model: string, one of either "cutoff", "apos" or "consequential"
+
+    Returns:
+    - signature: dictionary with the file name as key and a list [mtime, size] as value
+    """
+    signature = {}
+    for file_name in exchange_files + index_files:
+        stat = os.stat(f"{path}/{system_model}/{file_name}.csv")
+        signature[file_name] = [stat.st_mtime, stat.st_size]
+
+    return signature
+
+
+def typed_exchanges(exchanges):
+    """
+    This function converts an exchange matrix (A_public, B_public or C_public) to compact types:
+    int32 for the row and column indices and float64 for the coefficients.
 
-def import_data(path):
+    Required arguments:
+    - exchanges: dataframe with the columns 'row', 'column' and 'coefficient'
+
+    Returns:
+    - exchanges: the same dataframe with the compact types
+    """
+    return exchanges.astype({"row": np.int32, "column": np.int32, "coefficient": np.float64})
+
+
+def categorize_index(index_df):
+    """
+    This function stores the repetitive text columns of an index table (e.g. geography, compartment, unit) as
+    categories. The label columns (see label_columns) are left as plain strings.
+
+    Required arguments:
+    - index_df: dataframe, one of ee_index, ie_index or LCIA_index
+
+    Returns:
+    - index_df: the same dataframe with categorical columns
+    """
+    for column in index_df.columns:
+        if (column not in label_columns and index_df[column].dtype == object and
+                index_df[column].nunique() < len(index_df) / 2):
+            index_df[column] = index_df[column].astype("category")
+
+    return index_df
+
+
+def read_csv_data(path, system_model):
+    """
+    This function reads the csv files of one system model.
+
+    Required arguments:
+    - path: string, path to where the csv files are stored in folders by system model, e.g. "../data/raw"
+    - system_model: string, one of either "cutoff", "apos" or "consequential"
+
+    Returns:
+    - six matrices for the system model (A_public, B_public, C_public, ee_index, ie_index and LCIA_index)
+    """
+    A_public = pd.read_csv(f"{path}/{system_model}/A_public.csv", delimiter=";")
+    B_public = pd.read_csv(f"{path}/{system_model}/B_public.csv", delimiter=";")
+    C_public = pd.read_csv(f"{path}/{system_model}/C_public.csv", delimiter=";")
+
+    ee_index = pd.read_csv(f"{path}/{system_model}/ee_index.csv", sep=";", index_col="index")
+    ie_index = pd.read_csv(f"{path}/{system_model}/ie_index.csv", sep=";", encoding="latin1", index_col="index")
+    LCIA_index = pd.read_csv(f"{path}/{system_model}/LCIA_index.csv", sep=";", index_col="index")
+
+    return A_public, B_public, C_public, ee_index, ie_index, LCIA_index
+
+
+def write_atomic(file_name, write):
+    """
+    This function writes a file through a temporary file of its own in the same folder, which is renamed to
+    file_name once it is complete. Readers therefore never see a half-written file, and several processes can write
+    the same file at the same time.
+
+    Required arguments:
+    - file_name: string, path of the file
+    - write: function that writes the file, called with the path of the temporary file
+
+    Returns:
+    - no returns, the file is written to file_name
+    """
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    handle, temp_name = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(file_name))
+    os.close(handle)
+    try:
+        write(temp_name)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def write_cache(cache_dir, signature, matrices):
     """
-    This function imports the globally required libraries and the data for the three different system models.
+    This function writes the binary cache of one system model: one .npy file per column of the exchange
+    matrices and one pickle file per index table. The signature of the previous cache is removed first and the
+    signature of the csv files is written last, so that an interrupted or ongoing write is never taken for a valid
+    cache. Every file is replaced as a whole (see write_atomic).
+
+    Required arguments:
+    - cache_dir: string, folder of the cache for this system model, e.g. "../data/cache/cutoff"
+    - signature: dictionary created with the source_signature function
+    - matrices: list of the six matrices (A_public, B_public, C_public, ee_index, ie_index and LCIA_index)
+
+    Returns:
+    - no returns, the files are written to cache_dir
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(f"{cache_dir}/signature.json"):
+        os.remove(f"{cache_dir}/signature.json")
+
+    for file_name, matrix in zip(exchange_files + index_files, matrices):
+        if file_name in exchange_files:
+            for column in ["row", "column", "coefficient"]:
+                store_array(f"{cache_dir}/{file_name}_{column}.npy", matrix[column].values)
+        else:
+            write_atomic(f"{cache_dir}/{file_name}.pkl", matrix.to_pickle)
+
+    def write_signature(signature_path):
+        with open(signature_path, "w") as signature_file:
+            json.dump(signature, signature_file)
+
+    write_atomic(f"{cache_dir}/signature.json", write_signature)
+
+
+def read_cache(cache_dir, signature):
+    """
+    This function reads the binary cache of one system model if it exists and matches the current csv files.
+
+    Required arguments:
+    - cache_dir: string, folder of the cache for this system model, e.g. "../data/cache/cutoff"
+    - signature: dictionary created with the source_signature function for the current csv files
+
+    Returns:
+    - list of the six matrices (A_public, B_public, C_public, ee_index, ie_index and LCIA_index),
+        or None if the cache is missing, stale or cannot be read (e.g. a truncated file)
+    """
+    try:
+        with open(f"{cache_dir}/signature.json") as signature_file:
+            cached_signature = json.load(signature_file)
+    except (OSError, ValueError):
+        return None
+    if cached_signature != signature:
+        return None
+
+    matrices = []
+    try:
+        for file_name in exchange_files:
+            matrices.append(pd.DataFrame({column: np.load(f"{cache_dir}/{file_name}_{column}.npy")
+                                          for column in ["row", "column", "coefficient"]}))
+        for file_name in index_files:
+            matrices.append(pd.read_pickle(f"{cache_dir}/{file_name}.pkl"))
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        return None
+
+    return matrices
+
+
+def import_data(path, system_model, use_cache=True):
+    """
+    This function imports the data for one system model. On the first import the csv files are converted to a
+    binary cache in cache_path, which is used instead of the csv files as long as these do not change
+    (same modification time and size).
 
     Required arguments:
     - path: string, path to where the csv files are stored in folders by system model,
         e.g. "../data/raw"
+    - system_model: string, one of either "cutoff", "apos" or "consequential"
+
+    Optional arguments:
+    - use_cache: bool, if True, the binary cache is read and written. Default is True.
 
     Returns:
-    - six matrices for each of the system models (A_public, B_public, C_public, ie_index, ee_index and LCIA_index)
+    - six matrices for the system model (A_public, B_public, C_public, ee_index, ie_index and LCIA_index)
     """
+    cache_dir = f"{cache_path}/{system_model}"
+    signature = source_signature(path, system_model)
+
+    if use_cache:
+        matrices = read_cache(cache_dir, signature)
+        if matrices is not None:
+            return tuple(matrices)
+
     # Import data
-    A_public_cutoff = pd.read_csv(f"{path}/cutoff/A_public.csv", delimiter=";")
-    A_public_apos = pd.read_csv(f"{path}/apos/A_public.csv", delimiter=";")
-    A_public_consequential = pd.read_csv(f"{path}/consequential/A_public.csv", delimiter=";")
+    A_public, B_public, C_public, ee_index, ie_index, LCIA_index = read_csv_data(path, system_model)
+    A_public = typed_exchanges(A_public)
+    B_public = typed_exchanges(B_public)
+    C_public = typed_exchanges(C_public)
+    ee_index = categorize_index(ee_index)
+    ie_index = categorize_index(ie_index)
+    LCIA_index = categorize_index(LCIA_index)
 
-    B_public_cutoff = pd.read_csv(f"{path}/cutoff/B_public.csv", delimiter=";")
-    B_public_apos = pd.read_csv(f"{path}/apos/B_public.csv", delimiter=";")
-    B_public_consequential = pd.read_csv(f"{path}/consequential/B_public.csv", delimiter=";")
+    if use_cache:
+        write_cache(cache_dir, signature, [A_public, B_public, C_public, ee_index, ie_index, LCIA_index])
 
-    C_public_cutoff = pd.read_csv(f"{path}/cutoff/C_public.csv", delimiter=";")
-    C_public_apos = pd.read_csv(f"{path}/apos/C_public.csv", delimiter=";")
-    C_public_consequential = pd.read_csv(f"{path}/consequential/C_public.csv", delimiter=";")
+    return A_public, B_public, C_public, ee_index, ie_index, LCIA_index
 
-    ee_index_cutoff = pd.read_csv(f"{path}/cutoff/ee_index.csv", sep=";", index_col="index")
-    ee_index_apos = pd.read_csv(f"{path}/apos/ee_index.csv", sep=";", index_col="index")
-    ee_index_consequential = pd.read_csv(f"{path}/consequential/ee_index.csv", sep=";", index_col="index")
 
-    ie_index_cutoff = pd.read_csv(f"{path}/cutoff/ie_index.csv", sep=";", encoding="latin1", index_col="index")
-    ie_index_apos = pd.read_csv(f"{path}/apos/ie_index.csv", sep=";", encoding="latin1", index_col="index")
-    ie_index_consequential = pd.read_csv(f"{path}/consequential/ie_index.csv",
-                                         sep=";", encoding="latin1", index_col="index")
+def matrices_hash(A_public, B_public, C_public, ee_index, ie_index, LCIA_index):
+    """
+    This function calculates a hash of the data the lcia scores are calculated from. It is used as key of the
+    score store, so that stored scores are only reused for exactly the same matrices.
+
+    Required arguments:
+    - six matrices for the system model (A_public, B_public, C_public, ee_index, ie_index and LCIA_index)
 
-    LCIA_index_cutoff = pd.read_csv(f"{path}/cutoff/LCIA_index.csv", sep=";", index_col="index")
-    LCIA_index_apos = pd.read_csv(f"{path}/apos/LCIA_index.csv", sep=";", index_col="index")
-    LCIA_index_consequential = pd.read_csv(f"{path}/consequential/LCIA_index.csv", sep=";", index_col="index")
+    Returns:
+    - key: string, sha256 hex digest of the exchange matrices and the sizes of the index tables
+    """
+    sha = hashlib.sha256()
+    sha.update(f"{len(ee_index)};{len(ie_index)};{len(LCIA_index)}".encode())
+    for exchanges in [A_public, B_public, C_public]:
+        for column in ["row", "column", "coefficient"]:
+            sha.update(np.ascontiguousarray(exchanges[column].values).tobytes())
 
-    return (A_public_cutoff, A_public_apos, A_public_consequential,
-            B_public_cutoff, B_public_apos, B_public_consequential,
-            C_public_cutoff, C_public_apos, C_public_consequential,
-            ee_index_cutoff, ee_index_apos, ee_index_consequential,
-            ie_index_cutoff, ie_index_apos, ie_index_consequential,
-            LCIA_index_cutoff, LCIA_index_apos, LCIA_index_consequential)
+    return sha.hexdigest()
 
 
-def calculate_impact_scores(A_public_cutoff, A_public_apos, A_public_consequential,
-                            B_public_cutoff, B_public_apos, B_public_consequential,
-                            C_public_cutoff, C_public_apos, C_public_consequential,
-                            ee_index_cutoff, ee_index_apos, ee_index_consequential,
-                            ie_index_cutoff, ie_index_apos, ie_index_consequential,
-                            LCIA_index_cutoff, LCIA_index_apos, LCIA_index_consequential):
+def store_array(file_name, array):
     """
-    This function performs the calculation of lcia scores for all three system models.
+    This function saves an array as .npy file through a temporary file (see write_atomic), so that an interrupted run
+    never leaves a half-written file behind and several processes can store the same file at the same time.
 
     Required arguments:
-    - six matrices for each of the system models (A_public, B_public, C_public, ie_index, ee_index and LCIA_index)
+    - file_name: string, path of the .npy file
+    - array: numpy array to be saved
 
     Returns:
-    - the C-Matrix in array form for each of the system models
-    - the lcia-Matrix with the scores of all the products for each of the system models
+    - no returns, the file is written to file_name
+    """
+    def write_array(temp_name):
+        with open(temp_name, "wb") as array_file:
+            np.save(array_file, array)
+
+    write_atomic(file_name, write_array)
+
+
+def calculate_impact_scores(A_public, B_public, C_public, ee_index, ie_index, LCIA_index,
+                            use_store=True, store_lci=False, on_demand=False):
+    """
+    This function performs the calculation of lcia scores for one system model. The scores are kept in a store in
+    score_path under the hash of the matrices (see matrices_hash), so that the calculation is only done once per
+    release and later runs load the stored scores as memory mapped array.
+    The scores are solved directly for the characterized right-hand side (C*B)^T, which has one column per method,
+    so the products x elementary exchanges lci-Matrix is not calculated.
+
+    Required arguments:
+    - six matrices for the system model (A_public, B_public, C_public, ee_index, ie_index and LCIA_index)
+
+    Optional arguments:
+    - use_store: bool, if True, stored scores are used and new scores are stored. Default is True.
+    - store_lci: bool, if True, the lci-Matrix is additionally calculated and stored next to the lcia scores.
+        Default is False.
+    - on_demand: bool, if True, no scores are calculated yet. The scores of a method are only calculated once it is
+        requested with the solve_methods function and only the calculated methods are kept (see lcia_scores).
+        Default is False.
+
+    Returns:
+    - A_public_cor: the A-Matrix without the values in the diagonal
+    - c_array: the transposed C-Matrix as sparse CSC matrix (elementary exchanges x methods)
+    - lcia: the lcia-Matrix with the scores of all the products and methods, None with on_demand
+    - LCIA_index: the LCIA_index with the additional column 'method_long'
+    - lcia_df: the lcia-Matrix as dataframe with the long method names as column names, None with on_demand
+    - lcia_solver: dictionary used by solve_methods to calculate missing methods, with the hash of the matrices
+        ('key'), the matrices A^T and (C*B)^T ('A_T', 'cb'), the factorization of A^T once it is needed ('solver'),
+        the set of methods that are already calculated ('solved'), the use_store setting ('use_store'), the array of
+        the scores ('scores', the lcia-Matrix or with on_demand the calculated methods) and, with on_demand, the
+        column of each calculated method in it ('columns')
     """
     # Remove values in the diagonal
-    # Lcia scores for the cutoff matrices
-    A_cutoff = sp.coo_matrix((A_public_cutoff["coefficient"], (A_public_cutoff["row"],
-                                                               A_public_cutoff["column"]))).tocsc()
-    A_public_cor_cutoff = A_public_cutoff.loc[A_public_cutoff["row"] != A_public_cutoff["column"]].copy()
-
-    B_cutoff = sp.coo_matrix((B_public_cutoff["coefficient"], (B_public_cutoff["row"],
-                                                               B_public_cutoff["column"])),
-                             shape=(len(ee_index_cutoff), len(ie_index_cutoff)))
-    lci_cutoff = spsolve(A_cutoff.transpose(), B_cutoff.transpose())
-    C_cutoff = sp.coo_matrix((C_public_cutoff["coefficient"], (C_public_cutoff["row"],
-                                                               C_public_cutoff["column"])),
-                             shape=(len(LCIA_index_cutoff), len(ee_index_cutoff)))
-    c_array_cutoff = C_cutoff.transpose().toarray()
-    lcia_cutoff = lci_cutoff * C_cutoff.transpose()
-
-    LCIA_index_cutoff['method_long'] = LCIA_index_cutoff[LCIA_index_cutoff.columns[:-1]].apply(
-        lambda x: ", ".join(x.astype(str)), axis=1)
-    lcia_df_cutoff = pd.DataFrame(data=lcia_cutoff[:, :],
-                                  columns=LCIA_index_cutoff['method_long'].values)
-
-    # Lcia scores for the apos matrices
-    A_apos = sp.coo_matrix((A_public_apos["coefficient"], (A_public_apos["row"],
-                                                           A_public_apos["column"]))).tocsc()
-    A_public_cor_apos = A_public_apos.loc[A_public_apos["row"] != A_public_apos["column"]].copy()
-
-    B_apos = sp.coo_matrix((B_public_apos["coefficient"], (B_public_apos["row"],
-                                                           B_public_apos["column"])),
-                           shape=(len(ee_index_apos), len(ie_index_apos)))
-    lci_apos = spsolve(A_apos.transpose(), B_apos.transpose())
-    C_apos = sp.coo_matrix((C_public_apos["coefficient"], (C_public_apos["row"],
-                                                           C_public_apos["column"])),
-                           shape=(len(LCIA_index_apos), len(ee_index_apos)))
-    c_array_apos = C_apos.transpose().toarray()
-    lcia_apos = lci_apos * C_apos.transpose()
-
-    LCIA_index_apos['method_long'] = LCIA_index_apos[LCIA_index_apos.columns[:-1]].apply(
+    A_public_cor = A_public.loc[A_public["row"] != A_public["column"]].copy()
+
+    A = sp.coo_matrix((A_public["coefficient"], (A_public["row"], A_public["column"]))).tocsc()
+    B = sp.coo_matrix((B_public["coefficient"], (B_public["row"], B_public["column"])),
+                      shape=(len(ee_index), len(ie_index))).tocsr()
+    C = sp.coo_matrix((C_public["coefficient"], (C_public["row"], C_public["column"])),
+                      shape=(len(LCIA_index), len(ee_index)))
+    c_array = C.transpose().tocsc()
+
+    # Solve for (C*B)^T (one column per method) instead of B^T (one column per elementary exchange),
+    # so that the dense lci-Matrix is never built: lcia = A^-T * B^T * C^T = A^-T * (C*B)^T
+    lcia_solver = {"key": matrices_hash(A_public, B_public, C_public, ee_index, ie_index, LCIA_index),
+                   "A_T": A.transpose().tocsr(),
+                   "cb": (C.tocsr() * B).transpose().tocsc(),
+                   "solver": None,
+                   "solved": set(),
+                   "use_store": use_store,
+                   "scores": None,
+                   "columns": None}
+
+    # Lcia scores, from the store if they were calculated before for the same matrices
+    lcia_file = f"{score_path}/{lcia_solver['key']}/lcia.npy"
+    if use_store and os.path.exists(lcia_file):
+        lcia = np.load(lcia_file, mmap_mode="r")
+        lcia_solver["solved"] = set(range(len(LCIA_index)))
+    elif on_demand:
+        lcia = None
+        lcia_solver["columns"] = {}
+        lcia_solver["scores"] = np.empty((len(ie_index), 8), order="F")
+    else:
+        cb = lcia_solver["cb"].toarray()
+        lcia = spsolve(lcia_solver["A_T"], cb).reshape(cb.shape)
+        lcia_solver["solved"] = set(range(len(LCIA_index)))
+        if use_store:
+            if store_lci:
+                store_array(f"{os.path.dirname(lcia_file)}/lci.npy", spsolve(lcia_solver["A_T"], B.transpose()))
+            store_array(lcia_file, lcia)
+
+    LCIA_index['method_long'] = LCIA_index[LCIA_index.columns[:-1]].apply(
         lambda x: ", ".join(x.astype(str)), axis=1)
-    lcia_df_apos = pd.DataFrame(data=lcia_apos[:, :],
-                                columns=LCIA_index_apos['method_long'].values)
-
-    # Lcia scores for the apos matrices
-    A_consequential = sp.coo_matrix((A_public_consequential["coefficient"], (A_public_consequential["row"],
-                                                                             A_public_consequential["column"]))).tocsc()
-    A_public_cor_consequential = A_public_consequential.loc[
-        A_public_consequential["row"] != A_public_consequential["column"]].copy()
-
-    B_consequential = sp.coo_matrix((B_public_consequential["coefficient"], (B_public_consequential["row"],
-                                                                             B_public_consequential["column"])),
-                                    shape=(len(ee_index_consequential), len(ie_index_consequential)))
-    lci_consequential = spsolve(A_consequential.transpose(), B_consequential.transpose())
-    C_consequential = sp.coo_matrix((C_public_consequential["coefficient"], (C_public_consequential["row"],
-                                                                             C_public_consequential["column"])),
-                                    shape=(len(LCIA_index_consequential), len(ee_index_consequential)))
-    c_array_consequential = C_consequential.transpose().toarray()
-    lcia_consequential = lci_consequential * C_consequential.transpose()
-
-    LCIA_index_consequential['method_long'] = LCIA_index_consequential[LCIA_index_consequential.columns[:-1]].apply(
-        lambda x: ", ".join(x.astype(str)), axis=1)
-    lcia_df_consequential = pd.DataFrame(data=lcia_consequential[:, :],
-                                         columns=LCIA_index_consequential['method_long'].values)
-
-    return (A_public_cor_cutoff, c_array_cutoff, lcia_cutoff, LCIA_index_cutoff, lcia_df_cutoff,
-            A_public_cor_apos, c_array_apos, lcia_apos, LCIA_index_apos, lcia_df_apos,
-            A_public_cor_consequential, c_array_consequential, lcia_consequential, LCIA_index_consequential,
-            lcia_df_consequential)
-
-
-(A_public_cutoff, A_public_apos, A_public_consequential,
- B_public_cutoff, B_public_apos, B_public_consequential,
- C_public_cutoff, C_public_apos, C_public_consequential,
- ee_index_cutoff, ee_index_apos, ee_index_consequential,
- ie_index_cutoff, ie_index_apos, ie_index_consequential,
- LCIA_index_cutoff, LCIA_index_apos, LCIA_index_consequential) = import_data(path)
-
-(A_public_cor_cutoff, c_array_cutoff, lcia_cutoff, LCIA_index_cutoff, lcia_df_cutoff,
- A_public_cor_apos, c_array_apos, lcia_apos, LCIA_index_apos, lcia_df_apos,
- A_public_cor_consequential, c_array_consequential, lcia_consequential, LCIA_index_consequential, lcia_df_consequential
- ) = calculate_impact_scores(A_public_cutoff, A_public_apos, A_public_consequential,
-                             B_public_cutoff, B_public_apos, B_public_consequential,
-                             C_public_cutoff, C_public_apos, C_public_consequential,
-                             ee_index_cutoff, ee_index_apos, ee_index_consequential,
-                             ie_index_cutoff, ie_index_apos, ie_index_consequential,
-                             LCIA_index_cutoff, LCIA_index_apos, LCIA_index_consequential)
-
-
-def select_system_model(system_model, A_public_cutoff, A_public_apos, A_public_consequential,
-                        A_public_cor_cutoff, A_public_cor_apos, A_public_cor_consequential,
-                        B_public_cutoff, B_public_apos, B_public_consequential,
-                        C_public_cutoff, C_public_apos, C_public_consequential,
-                        ee_index_cutoff, ee_index_apos, ee_index_consequential,
-                        ie_index_cutoff, ie_index_apos, ie_index_consequential,
-                        LCIA_index_cutoff, LCIA_index_apos, LCIA_index_consequential,
-                        c_array_cutoff, c_array_apos, c_array_consequential,
-                        lcia_cutoff, lcia_apos, lcia_consequential,
-                        lcia_df_cutoff, lcia_df_apos, lcia_df_consequential):
+    if lcia is None:
+        lcia_df = None
+    else:
+        lcia_solver["scores"] = lcia
+        lcia_df = pd.DataFrame(data=lcia[:, :], columns=LCIA_index['method_long'].values)
+
+    return A_public_cor, c_array, lcia, LCIA_index, lcia_df, lcia_solver
+
+
+def solve_methods(method_index_list):
+    """
+    This function makes sure that the lcia scores of the selected system model are calculated for the given methods.
+    Missing methods are read from the score store or calculated with one back-substitution each, using the
+    factorization of A^T which is only done once per system model. With on-demand scores (see
+    calculate_impact_scores), only the calculated methods are kept, in an array that doubles its size when it is full.
+
+    Required arguments:
+    - method_index_list: list of int, indices of the LCIA methods from the LCIA_index matrix
+
+    Returns:
+    - no returns, the scores are written to lcia_solver['scores'], see lcia_scores
+    """
+    columns = lcia_solver["columns"]
+    missing = [method_index for method_index in dict.fromkeys(method_index_list)
+               if method_index not in lcia_solver["solved"]]
+    if columns is not None and len(columns) + len(missing) > lcia_solver["scores"].shape[1]:
+        scores = lcia_solver["scores"]
+        lcia_solver["scores"] = np.empty((scores.shape[0], max(2 * scores.shape[1], len(columns) + len(missing))),
+                                         order="F")
+        lcia_solver["scores"][:, :len(columns)] = scores[:, :len(columns)]
+
+    for method_index in missing:
+        column = method_index if columns is None else len(columns)
+        scores = lcia_solver["scores"]
+
+        method_file = f"{score_path}/{lcia_solver['key']}/lcia_m{method_index}.npy"
+        if lcia_solver["use_store"] and os.path.exists(method_file):
+            scores[:, column] = np.load(method_file)
+        else:
+            if lcia_solver["solver"] is None:
+                lcia_solver["solver"] = PyPardisoSolver()
+                lcia_solver["solver"].factorize(lcia_solver["A_T"])
+            cb_method = lcia_solver["cb"][:, method_index].toarray().ravel()
+            scores[:, column] = lcia_solver["solver"].solve(lcia_solver["A_T"], cb_method)
+            if lcia_solver["use_store"]:
+                store_array(method_file, scores[:, column])
+
+        if columns is not None:
+            columns[method_index] = column
+        lcia_solver["solved"].add(method_index)
+
+    return
+
+
+def lcia_scores(method_index_list):
+    """
+    This function returns the lcia scores of the selected system model for the given methods, calculating them
+    first if needed (see solve_methods). It works both with the full lcia-Matrix and with on-demand scores.
+
+    Required arguments:
+    - method_index_list: list of int, indices of the LCIA methods from the LCIA_index matrix
+
+    Returns:
+    - scores: numpy array with one row per product, holding the scores of the methods
+    - columns: list of int, the column of each method in scores, in the order of method_index_list
+        (e.g. scores[prod_index, columns[0]] is the score of the product for the first method)
+    """
+    solve_methods(method_index_list)
+    if lcia_solver["columns"] is None:
+        return lcia_solver["scores"], list(method_index_list)
+    return lcia_solver["scores"], [lcia_solver["columns"][method_index] for method_index in method_index_list]
+
+
+def characterization_factors(method_index):
+    """
+    This function returns the characterization factors of one method for all elementary exchanges of the selected
+    system model. The column is taken from the sparse c_array once and then kept per method.
+
+    Required arguments:
+    - method_index: int, index of the LCIA method from the LCIA_index matrix
+
+    Returns:
+    - numpy array with one characterization factor per row of ee_index
+    """
+    if method_index not in c_columns:
+        c_columns[method_index] = c_array[:, method_index].toarray().ravel()
+
+    return c_columns[method_index]
+
+
+def column_index(exchanges, n_columns):
+    """
+    This function sorts an exchange matrix by column and creates the column pointers of a CSC layout, so that all
+    the exchanges of one product are a slice instead of a scan of the whole matrix (see column_slice).
+    The sorting is stable, so the exchanges within one column keep their original order and index.
+
+    Required arguments:
+    - exchanges: dataframe with the columns 'row', 'column' and 'coefficient', e.g. A_public or B_public
+    - n_columns: int, the number of columns of the matrix, i.e. the number of products in ie_index
+
+    Returns:
+    - exchanges: the dataframe sorted by column
+    - indptr: numpy array of n_columns + 1 offsets, the exchanges of column j are at indptr[j]:indptr[j + 1]
+    """
+    exchanges = exchanges.sort_values("column", kind="mergesort")
+    indptr = np.searchsorted(exchanges["column"].values, np.arange(n_columns + 1))
+
+    return exchanges, indptr
+
+
+def column_slice(exchanges, indptr, column):
+    """
+    This function returns all the exchanges of one column (product) of a matrix sorted with the column_index function.
+
+    Required arguments:
+    - exchanges: dataframe sorted with the column_index function
+    - indptr: numpy array, the column pointers created with the column_index function
+    - column: int, the index of the product
+
+    Returns:
+    - dataframe with the exchanges of this column, same as exchanges[exchanges["column"] == column]
+    """
+    return exchanges.iloc[indptr[column]:indptr[column + 1]]
+
+
+def product_labels(ie_index):
+    """
+    This function creates the product names shown in the treemaps, where "[m]" is added in front of the products
+    of markets and "[mg]" in front of the products of market groups.
+
+    Required arguments:
+    - ie_index: dataframe with the activities and products
+
+    Returns:
+    - pandas series with the product labels, with the same index as ie_index
+    """
+    activity_names = ie_index["activityName"]
+    market = activity_names.str.contains("market for", regex=False, na=False)
+    market_group = ~market & activity_names.str.contains("market group", regex=False, na=False)
+
+    labels = ie_index["product"].copy()
+    labels[market] = "[m] " + labels[market]
+    labels[market_group] = "[mg] " + labels[market_group]
+
+    return labels
+
+
+def label_codes(labels):
+    """
+    This function numbers the labels in alphabetical order, so that exchanges can be grouped by label with arrays
+    instead of dataframes.
+
+    Required arguments:
+    - labels: pandas series with the labels, e.g. the product labels of ie_index or the names of ee_index
+
+    Returns:
+    - codes: numpy array of int with the code of each label (-1 for missing labels)
+    - names: numpy array with the label of each code
+    """
+    codes, names = pd.factorize(labels, sort=True)
+
+    return codes, np.asarray(names, dtype=object)
+
+
+def flow_compartments(ee_index):
+    """
+    This function classifies the elementary exchanges into the 'flow compartments' of the bar plots:
+    'Emissions to ...' by compartment, 'Inputs from environment' for natural resources and
+    'Inputs f. technosphere' for exchanges without compartment, which is also used for all the inputs.
+
+    Required arguments:
+    - ee_index: dataframe with the elementary exchanges
+
+    Returns:
+    - pandas categorical with the 'flow compartment' of each elementary exchange, the categories are sorted
+        alphabetically and always include 'Inputs f. technosphere'
+    """
+    compartments = ee_index["compartment"]
+    impact_cats = ("Emissions to " + compartments.astype(str)).where(compartments.notna(), technosphere_cat)
+    impact_cats = impact_cats.where(compartments != "natural resource", "Inputs from environment")
+
+    return pd.Categorical(impact_cats, categories=sorted(set(impact_cats) | {technosphere_cat}))
+
+
+# System models that have been loaded and solved so far, filled on first request by load_system_model
+loaded_models = {}
+# Name of the system model chosen with select_system_model
+selected_system_model = None
+
+
+def load_system_model(system_model):
+    """
+    This function imports the data and calculates the lcia scores for one system model the first time it is
+    requested. The result is kept in memory, so that later requests for the same system model are free.
+
+    Required arguments:
+    - system_model: string, one of either "cutoff", "apos" or "consequential"
+
+    Returns:
+    - a dictionary with all the matrices of the system model (A_public, A_public_cor and B_public sorted by column
+        with their column pointers A_public_indptr, A_public_cor_indptr and B_public_indptr, C_public,
+        ee_index with the 'flow compartments' of the bar plots (impact_cat), ie_index with the product labels of the
+        treemaps (product_label), LCIA_index, c_array, lcia,
+        lcia_df, lcia_solver, c_columns, the dense columns of c_array used so far, and the codes and names of the
+        product labels and emission names used to group the treemaps, see label_codes)
+    """
+    if system_model not in system_models:
+        raise ValueError(f"'{system_model}' is not a valid system model name.")
+
+    if system_model not in loaded_models:
+        A_public, B_public, C_public, ee_index, ie_index, LCIA_index = import_data(path, system_model)
+        A_public_cor, c_array, lcia, LCIA_index, lcia_df, lcia_solver = calculate_impact_scores(
+            A_public, B_public, C_public, ee_index, ie_index, LCIA_index, on_demand=lcia_on_demand)
+        A_public, A_public_indptr = column_index(A_public, len(ie_index))
+        A_public_cor, A_public_cor_indptr = column_index(A_public_cor, len(ie_index))
+        B_public, B_public_indptr = column_index(B_public, len(ie_index))
+        ie_index["product_label"] = product_labels(ie_index)
+        product_label_codes, product_label_names = label_codes(ie_index["product_label"])
+        emission_name_codes, emission_names = label_codes(ee_index["name"])
+        ee_index["impact_cat"] = flow_compartments(ee_index)
+        loaded_models[system_model] = {"A_public": A_public,
+                                       "A_public_indptr": A_public_indptr,
+                                       "A_public_cor": A_public_cor,
+                                       "A_public_cor_indptr": A_public_cor_indptr,
+                                       "B_public": B_public,
+                                       "B_public_indptr": B_public_indptr,
+                                       "C_public": C_public,
+                                       "ee_index": ee_index,
+                                       "ie_index": ie_index,
+                                       "LCIA_index": LCIA_index,
+                                       "c_array": c_array,
+                                       "lcia": lcia,
+                                       "lcia_df": lcia_df,
+                                       "lcia_solver": lcia_solver,
+                                       "c_columns": {},
+                                       "product_label_codes": product_label_codes,
+                                       "product_label_names": product_label_names,
+                                       "emission_name_codes": emission_name_codes,
+                                       "emission_names": emission_names}
+
+    return loaded_models[system_model]
+
+
+def select_system_model(system_model):
     """
     This function selects one of the three system models and assigns global variable names accordingly.
+    The system model is loaded on first use (see load_system_model).
 
     Required arguments:
     - system_model: string, one of either "cutoff", "apos" or "consequential"
-    - six matrices for each of the system models (A_public, B_public, C_public, ie_index, ee_index and LCIA_index)
-    - the C-Matrix in array form for each of the system models
-    - the lcia-Matrix with the scores of all the products for each of the system models
 
     Returns:
     - no returns, because the variable names are declared globally
     """
     global A_public
+    global A_public_indptr
     global A_public_cor
+    global A_public_cor_indptr
     global B_public
+    global B_public_indptr
     global C_public
     global ee_index
     global ie_index
@@ -203,41 +638,51 @@ def select_system_model(system_model, A_public_cutoff, A_public_apos, A_public_c
     global c_array
     global lcia
     global lcia_df
-
-    if system_model == "cutoff":
-        A_public = A_public_cutoff
-        A_public_cor = A_public_cor_cutoff
-        B_public = B_public_cutoff
-        C_public = C_public_cutoff
-        ee_index = ee_index_cutoff
-        ie_index = ie_index_cutoff
-        LCIA_index = LCIA_index_cutoff
-        c_array = c_array_cutoff
-        lcia = lcia_cutoff
-        lcia_df = lcia_df_cutoff
-
-    elif system_model == "apos":
-        A_public = A_public_apos
-        A_public_cor = A_public_cor_apos
-        B_public = B_public_apos
-        C_public = C_public_apos
-        ee_index = ee_index_apos
-        ie_index = ie_index_apos
-        LCIA_index = LCIA_index_apos
-        c_array = c_array_apos
-        lcia = lcia_apos
-        lcia_df = lcia_df_apos
-
-    elif system_model == "consequential":
-        A_public = A_public_consequential
-        A_public_cor = A_public_cor_consequential
-        B_public = B_public_consequential
-        C_public = C_public_consequential
-        ee_index = ee_index_consequential
-        ie_index = ie_index_consequential
-        LCIA_index = LCIA_index_consequential
-        c_array = c_array_consequential
-        lcia = lcia_consequential
-        lcia_df = lcia_df_consequential
+    global lcia_solver
+    global c_columns
+    global product_label_codes
+    global product_label_names
+    global emission_name_codes
+    global emission_names
+    global selected_system_model
+
+    model = load_system_model(system_model)
+    selected_system_model = system_model
+
+    A_public = model["A_public"]
+    A_public_indptr = model["A_public_indptr"]
+    A_public_cor = model["A_public_cor"]
+    A_public_cor_indptr = model["A_public_cor_indptr"]
+    B_public = model["B_public"]
+    B_public_indptr = model["B_public_indptr"]
+    C_public = model["C_public"]
+    ee_index = model["ee_index"]
+    ie_index = model["ie_index"]
+    LCIA_index = model["LCIA_index"]
+    c_array = model["c_array"]
+    if model["lcia"] is None:
+        # On-demand scores, reading lcia or lcia_df raises an error (see __getattr__)
+        globals().pop("lcia", None)
+        globals().pop("lcia_df", None)
+    else:
+        lcia = model["lcia"]
+        lcia_df = model["lcia_df"]
+    lcia_solver = model["lcia_solver"]
+    c_columns = model["c_columns"]
+    product_label_codes = model["product_label_codes"]
+    product_label_names = model["product_label_names"]
+    emission_name_codes = model["emission_name_codes"]
+    emission_names = model["emission_names"]
 
     return
+
+
+def __getattr__(name):
+    """
+    This function is called for the global variables that are not set. The lcia-Matrix (lcia, lcia_df) is not set
+    when the lcia scores are calculated on demand, so that no one reads the scores of a wrong method.
+    """
+    if name in ["lcia", "lcia_df"]:
+        raise AttributeError(f"{name} is only available after select_system_model and without lcia_on_demand, "
+                             f"use lcia_scores to read the lcia scores.")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
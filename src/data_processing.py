@@ -1,11 +1,24 @@
 # Import libraries
+from collections import OrderedDict
+import hashlib
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 
 import data_loading as dl
 
 hues_treemaps = dl.hues_treemaps
 
+# Groups of exchanges shown in the treemaps, in the order of the hues in hues_treemaps
+treemap_groups = ["inputs_pos", "emissions_pos", "inputs_neg", "emissions_neg"]
+
+# Least recently used cache of the unscaled treemap_arrays results by (system model, product, method),
+# shared by all levels and datasets of a run, and of the extracted exchanges by (system model, product)
+treemap_cache = OrderedDict()
+exchange_cache = OrderedDict()
+treemap_cache_size = 2000
+treemap_cache_stats = {"hits": 0, "misses": 0}
+
 
 # Bar plots
 def create_dfs_barplots(prod_index, method_index_list):
@@ -25,60 +38,40 @@ def create_dfs_barplots(prod_index, method_index_list):
         different types of data sets in the plotting function.
     """
     # Import the data set according to the selected system model
-    A_public_cor = dl.A_public_cor
-    B_public = dl.B_public
-    ee_index = dl.ee_index
-    ie_index = dl.ie_index
-    c_array = dl.c_array
-    lcia = dl.lcia
-
-    # Create auxiliary, empty DF
-    em_df = pd.DataFrame()
-    ip_df = pd.DataFrame()
+    lcia, columns = dl.lcia_scores(method_index_list)
+    impact_cats = dl.ee_index["impact_cat"].cat.categories
     chart_type_1 = ""
 
     # Extract information on inputs, emissions for each product
-    product_inputs = A_public_cor[A_public_cor["column"] == prod_index]
-    product_inputs_details = ie_index.iloc[product_inputs["row"]]
-    inputs_df = pd.merge(product_inputs_details, product_inputs,
-                         left_on="index", right_on="row")
-    product_emissions = B_public[B_public["column"] == prod_index]
-    product_emissions_details = ee_index.iloc[product_emissions["row"]]
-    emissions_df = pd.merge(product_emissions_details, product_emissions,
-                            left_on="index", right_on="row")
-
-    # Calculate impact scores in absolute and in % for each method for emissions and inputs
-    for meth in method_index_list:
-        score_by_meth = lcia[prod_index, meth]
-        # Emissions: Extract the impact_abs and impact_% for each method
-        em_scores_list = list(emissions_df["coefficient"] * c_array[emissions_df["row"], meth])
-        em_scores = pd.DataFrame(em_scores_list, columns=[str(meth) + '_impact_abs'])
-        em_scores[str(meth) + '_impact_%'] = em_scores[
-                                                 str(meth) + '_impact_abs'] / abs(score_by_meth)
-        em_df = pd.concat([em_df, em_scores], axis=1)
-        # Inputs: Extract the impact_abs and impact_% for each method
-        inputs_df_scores_list = list(-1 * inputs_df[
-            "coefficient"] * lcia[[inputs_df["row"]], meth][0])
-        inputs_df_scores = pd.DataFrame(inputs_df_scores_list,
-                                        columns=[str(meth) + '_impact_abs'])
-        inputs_df_scores[str(meth) + '_impact_%'] = inputs_df_scores[
-                                                        str(meth) + '_impact_abs'] / abs(score_by_meth)
-        ip_df = pd.concat([ip_df, inputs_df_scores], axis=1)
-
-    # Gather input and emissions in one DF with impact_abs and impact_%
-    clean_em_df = pd.concat([emissions_df, em_df], axis=1)
-    clean_ip_df = pd.concat([inputs_df, ip_df], axis=1)
-    clean_all_df = pd.concat([clean_ip_df, clean_em_df])
-
-    # Classifying each row into 'flow compartments'
-    clean_all_df['impact_cat'] = clean_all_df['compartment'].apply(
-        lambda x: 'Inputs from environment' if x == 'natural resource'
-        else 'Emissions to ' + str(x))
-    clean_all_df['impact_cat'] = clean_all_df['impact_cat'].apply(
-        lambda x: 'Inputs f. technosphere' if x == 'Emissions to nan'
-        else x)
-    # Group by and sum 'flow compartments' impact_% by method and round values
-    clean_all_df_grouped = clean_all_df.groupby(['impact_cat']).sum().reset_index()
+    product_inputs = dl.column_slice(dl.A_public_cor, dl.A_public_cor_indptr, prod_index)
+    product_emissions = dl.column_slice(dl.B_public, dl.B_public_indptr, prod_index)
+    input_rows = product_inputs["row"].values
+    emission_rows = product_emissions["row"].values
+
+    # 'Flow compartment' of each row: the inputs are from the technosphere, the emissions are classified in ee_index
+    cat_codes = np.concatenate([np.full(len(input_rows), impact_cats.get_loc(dl.technosphere_cat)),
+                                dl.ee_index["impact_cat"].cat.codes.values[emission_rows]])
+    present = np.bincount(cat_codes, minlength=len(impact_cats)) > 0
+    rows = np.concatenate([input_rows, emission_rows])
+
+    # Sum up the impact scores in absolute and in % for each method by 'flow compartment'
+    clean_all_df_grouped = pd.DataFrame({"impact_cat": np.asarray(impact_cats, dtype=object)[present],
+                                         "row": np.bincount(cat_codes, weights=rows,
+                                                            minlength=len(impact_cats))[present]})
+    for meth, column in zip(method_index_list, columns):
+        score_by_meth = lcia[prod_index, column]
+        scores = np.concatenate([-1 * product_inputs["coefficient"].values * lcia[input_rows, column],
+                                 product_emissions["coefficient"].values *
+                                 dl.characterization_factors(meth)[emission_rows]])
+        clean_all_df_grouped[str(meth) + '_impact_abs'] = np.bincount(cat_codes, weights=scores,
+                                                                      minlength=len(impact_cats))[present]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shares = scores / abs(score_by_meth)
+        clean_all_df_grouped[str(meth) + '_impact_%'] = np.bincount(cat_codes, weights=shares,
+                                                                    minlength=len(impact_cats))[present]
+    if not present.any():
+        # Data set is empty: the dummy row is created below
+        clean_all_df_grouped = pd.DataFrame()
     grouped = clean_all_df_grouped.copy()
     for meth in method_index_list:
         # Check if data set is not empty
@@ -145,33 +138,245 @@ def create_dfs_barplots(prod_index, method_index_list):
     return grouped_sorted, chart_type_1, chart_type_2
 
 
-def create_dfs_treemaps(prod_index, method_index):
+def create_dfs_barplots_batch(prod_index_list, method_index_list):
+    """
+    This function calculates the data of the bar plots for many products and methods at once. The impacts of
+    the 'flow compartments' are calculated with sparse matrix products of the inputs and emissions of all the
+    products with the 'flow compartment' membership of the elementary exchanges, instead of one product at a time.
+    The values are the same as the ones of create_dfs_barplots, the 'flow compartments' are precomputed in ee_index.
+
+    Required arguments:
+    - prod_index_list: list of int, indices of the products from the ie_index matrix
+    - method_index_list: list of int, indices of the LCIA methods from the LCIA_index matrix.
+        The most common ones are: [222, 485, 541] (or 540 in consequential).
+
+    Returns:
+    - a tidy dataframe with one row per product (ref_prod), 'flow compartment' (impact_cat) and method (method)
+        for all the 'flow compartments' the product has exchanges in, with the impact (impact_abs), the share of the
+        score in % (impact_%), the sign of impact_% (sign, NaN for zero), the rescaled values (scaled) and the sum
+        of the row indices of the exchanges (row), as in create_dfs_barplots
+    """
+    lcia, columns = dl.lcia_scores(method_index_list)
+    prod_index_list = np.asarray(prod_index_list, dtype=int)
+    n_products = len(dl.ie_index)
+    n_flows = len(dl.ee_index)
+
+    # Membership of the elementary exchanges in the 'flow compartments'
+    codes = dl.ee_index["impact_cat"].cat.codes.values
+    impact_cats = dl.ee_index["impact_cat"].cat.categories
+    technosphere = impact_cats.get_loc(dl.technosphere_cat)
+    impact_cats = np.asarray(impact_cats, dtype=object)
+    membership = sp.csr_matrix((np.ones(n_flows), (np.arange(n_flows), codes)), shape=(n_flows, len(impact_cats)))
+
+    # Inputs and emissions of the products, one row per product
+    A_public_cor = dl.A_public_cor
+    inputs = sp.csr_matrix((A_public_cor["coefficient"].values, (A_public_cor["column"].values,
+                                                                 A_public_cor["row"].values)),
+                           shape=(n_products, n_products))[prod_index_list]
+    B_public = dl.B_public
+    emissions = sp.csr_matrix((B_public["coefficient"].values, (B_public["column"].values, B_public["row"].values)),
+                              shape=(n_products, n_flows))[prod_index_list]
+    emissions_count = sp.csr_matrix((np.ones(len(B_public)), (B_public["column"].values, B_public["row"].values)),
+                                    shape=(n_products, n_flows))[prod_index_list]
+    emissions_rows = sp.csr_matrix((B_public["row"].values.astype(float), (B_public["column"].values,
+                                                                          B_public["row"].values)),
+                                   shape=(n_products, n_flows))[prod_index_list]
+
+    # Impacts by product, 'flow compartment' and method
+    c_array = dl.c_array[:, method_index_list]
+    impact_abs = np.zeros((len(prod_index_list), len(impact_cats), len(method_index_list)))
+    for cat in range(len(impact_cats)):
+        cat_flows = sp.diags(membership[:, cat].toarray().ravel())
+        impact_abs[:, cat, :] = (emissions @ cat_flows @ c_array).toarray()
+    impact_abs[:, technosphere, :] -= inputs @ lcia[:, columns]
+
+    # 'Flow compartments' with at least one exchange
+    present = (emissions_count @ membership).toarray() > 0
+    present[:, technosphere] |= np.diff(inputs.indptr) > 0
+    row_sums = (emissions_rows @ membership).toarray()
+    row_sums[:, technosphere] += np.bincount(A_public_cor["column"].values, weights=A_public_cor["row"].values,
+                                             minlength=n_products)[prod_index_list]
+
+    # Shares in % and rescaling if there are positive and negative values, as in create_dfs_barplots
+    with np.errstate(divide="ignore", invalid="ignore"):
+        impact_pct = np.round(impact_abs / abs(lcia[np.ix_(prod_index_list, columns)])[:, np.newaxis, :]
+                              * 100)
+    sign = np.where(present[:, :, np.newaxis], np.sign(impact_pct), 0)
+    sum_pos_imp = np.where(sign > 0, abs(impact_pct), 0).sum(axis=1)
+    sum_neg_imp = np.where(sign < 0, abs(impact_pct), 0).sum(axis=1)
+    rescale = (sum_pos_imp > 0) & (sum_neg_imp > 0)
+    max_sum_imp = np.where(sum_neg_imp < sum_pos_imp, sum_pos_imp, sum_neg_imp)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = np.where(rescale[:, np.newaxis, :],
+                          np.round(abs(impact_pct) / max_sum_imp[:, np.newaxis, :] * sign * 100), impact_pct)
+
+    # One row per product, present 'flow compartment' and method
+    prod_pos, cat_pos = np.nonzero(present)
+    n_methods = len(method_index_list)
+    return pd.DataFrame({"ref_prod": np.repeat(prod_index_list[prod_pos], n_methods),
+                         "impact_cat": np.repeat(impact_cats[cat_pos], n_methods),
+                         "method": np.tile(method_index_list, len(prod_pos)),
+                         "impact_abs": impact_abs[prod_pos, cat_pos].ravel(),
+                         "impact_%": impact_pct[prod_pos, cat_pos].ravel(),
+                         "sign": np.where(sign[prod_pos, cat_pos] == 0, np.nan, sign[prod_pos, cat_pos]).ravel(),
+                         "scaled": scaled[prod_pos, cat_pos].ravel(),
+                         "row": np.repeat(row_sums[prod_pos, cat_pos], n_methods)})
+
+
+def barplot_dfs(prod_index_list, method_index_list):
+    """
+    This function calculates the data of the bar plots of several products at once with create_dfs_barplots_batch
+    and converts it into the format of create_dfs_barplots, so that the bar plots of a chunk of products do not
+    need to extract and group the exchanges one product at a time.
+
+    Required arguments:
+    - prod_index_list: list of int, indices of the products from the ie_index matrix
+    - method_index_list: list of int, indices of the LCIA methods from the LCIA_index matrix
+
+    Returns:
+    - dictionary with the product indices as keys and the results of create_dfs_barplots (grouped_sorted,
+        chart_type_1, chart_type_2) as values. It is None for the products without exchanges or with a zero score,
+        whose data has to be created with create_dfs_barplots.
+    """
+    batch = create_dfs_barplots_batch(prod_index_list, method_index_list)
+    n_methods = len(method_index_list)
+    positions = batch.groupby("ref_prod", sort=False).indices
+    sort_columns = [str(meth) + '_impact_%' for meth in method_index_list[::-1]]
+
+    dfs = {}
+    for prod_index in prod_index_list:
+        if prod_index in dfs:
+            continue
+        product = batch.iloc[positions[prod_index]] if prod_index in positions else None
+        impact_pct = None if product is None else product["impact_%"].values.reshape(-1, n_methods)
+        if impact_pct is None or not np.isfinite(impact_pct).all():
+            dfs[prod_index] = None
+            continue
+        impact_abs = product["impact_abs"].values.reshape(-1, n_methods)
+        sign = product["sign"].values.reshape(-1, n_methods)
+        scaled = product["scaled"].values.reshape(-1, n_methods)
+
+        # Same columns, types and order as in create_dfs_barplots
+        grouped = pd.DataFrame({"impact_cat": product["impact_cat"].values[::n_methods],
+                                "row": product["row"].values[::n_methods]})
+        for i, meth in enumerate(method_index_list):
+            grouped[str(meth) + '_impact_abs'] = impact_abs[:, i]
+            grouped[str(meth) + '_impact_%'] = impact_pct[:, i].astype(np.int64)
+        rescaled = False
+        for i, meth in enumerate(method_index_list):
+            rescaled = bool((sign[:, i] > 0).any() and (sign[:, i] < 0).any())
+            grouped[str(meth) + '_abs'] = abs(grouped[str(meth) + '_impact_%'])
+            grouped[str(meth) + '_sign'] = sign[:, i]
+            grouped[str(meth) + '_scaled'] = scaled[:, i] if rescaled else grouped[str(meth) + '_impact_%']
+        grouped['ref_prod'] = prod_index
+        chart_type_1 = "2 - rescaled" if rescaled else '1 - normal'
+        chart_type_2 = "incl. negative" if (sign < 0).any() else "positive only"
+
+        dfs[prod_index] = (grouped.sort_values(by=sort_columns, ascending=False), chart_type_1, chart_type_2)
+
+    return dfs
+
+
+def treemap_arrays(prod_index, method_index):
     """
-    This function extracts all the required information for one product from the
-    matrices and converts it into the format used for plotting.
+    This function returns the arrays of the compute_treemap_arrays function for one product and one method.
+    The results are kept in a least recently used cache (treemap_cache), so that products that show up in the
+    drill-down of many datasets, e.g. markets for electricity or transport, are only processed once.
+    The cached arrays are shared and must not be changed.
 
     Required arguments:
     - prod_index: int, index of the product to be plotted from the ie_index matrix, e.g. 12759.
     - method_index: int, index of the LCIA method from the LCIA_index matrix.
         The most common ones are: 222, 485, 541 (or 540 in consequential).
-    
+
     Returns:
-    - nine new dataframes: with all the positive / negative inputs / emissions, grouped and ungrouped,
-        used to check if the positive or the negative maximum contributor needs to be
-        broken down to the next level.
+    - dictionary with the product_info and the arrays of the product, see compute_treemap_arrays.
     """
-    
-    # Import the data set according to the selected system model
-    A_public = dl.A_public
-    B_public = dl.B_public
-    ee_index = dl.ee_index
-    ie_index = dl.ie_index
-    c_array = dl.c_array
-    lcia = dl.lcia
+    key = (dl.selected_system_model, prod_index, method_index)
+    if key in treemap_cache:
+        treemap_cache.move_to_end(key)
+        treemap_cache_stats["hits"] += 1
+    else:
+        treemap_cache_stats["misses"] += 1
+        prefetch_treemap_arrays(prod_index, [method_index])
+
+    return treemap_cache[key]
+
+
+def prefetch_treemap_arrays(prod_index, method_index_list):
+    """
+    This function fills the treemap_cache for one product and several methods at once, so that the inputs and
+    emissions of the product are only extracted once and all the methods are scored in one step.
+
+    Required arguments:
+    - prod_index: int, index of the product to be plotted from the ie_index matrix, e.g. 12759.
+    - method_index_list: list of int, indices of the LCIA methods from the LCIA_index matrix.
+
+    Returns:
+    - no returns, the results are added to treemap_cache
+    """
+    missing_methods = [method_index for method_index in method_index_list
+                       if (dl.selected_system_model, prod_index, method_index) not in treemap_cache]
+    if not missing_methods:
+        return
+
+    for method_index, arrays in zip(missing_methods, compute_treemap_arrays(prod_index, missing_methods)):
+        cache_put(treemap_cache, (dl.selected_system_model, prod_index, method_index), arrays)
+
+    return
+
+
+def cache_put(cache, key, value):
+    """
+    This function adds an entry to one of the least recently used caches and drops the oldest entry once the cache
+    holds more than treemap_cache_size entries.
+
+    Required arguments:
+    - cache: OrderedDict, e.g. treemap_cache
+    - key: the key of the entry
+    - value: the entry to be cached
+
+    Returns:
+    - no returns, the entry is added to the cache
+    """
+    cache[key] = value
+    if len(cache) > treemap_cache_size:
+        cache.popitem(last=False)
+
+    return
+
+
+def treemap_cache_info():
+    """
+    This function reports the use of the treemap_arrays cache.
+
+    Returns:
+    - dictionary with the number of hits and misses and the current number of entries (size)
+    """
+    return {"hits": treemap_cache_stats["hits"], "misses": treemap_cache_stats["misses"],
+            "size": len(treemap_cache)}
+
+
+def extract_product_exchanges(prod_index):
+    """
+    This function extracts the information on one product and its inputs and emissions from the matrices, which is
+    the same for all the methods. The result is kept in a least recently used cache (exchange_cache).
+
+    Required arguments:
+    - prod_index: int, index of the product to be plotted from the ie_index matrix, e.g. 12759.
+
+    Returns:
+    - product_info: the row of ie_index for this product with the activity name shortened for plotting
+    - inputs: dictionary with the rows (indices in ie_index) and the coefficients of the inputs of the product
+    - emissions: dictionary with the rows (indices in ee_index) and the coefficients of the emissions of the product
+    """
+    key = (dl.selected_system_model, prod_index)
+    if key in exchange_cache:
+        exchange_cache.move_to_end(key)
+        return exchange_cache[key]
 
     # Gather information on the product
-    product_info_raw = ie_index.iloc[prod_index]
-    product_info = product_info_raw.copy()
+    product_info = dl.ie_index.iloc[prod_index].drop("product_label")
     if len(product_info["activityName"]) > 115:
         if " " in product_info["activityName"][105:115]:
             index = product_info["activityName"][105:115].index(" ")
@@ -179,242 +384,416 @@ def create_dfs_treemaps(prod_index, method_index):
         else:
             product_info["activityName"] = product_info["activityName"][:115] + "..."
 
-    # Gather information on the inputs for this product
-    product_inputs = A_public[A_public["column"] == prod_index]
-    product_inputs = product_inputs.drop(product_inputs[product_inputs["row"] == prod_index].index)
-    product_inputs_details = ie_index.iloc[product_inputs["row"]]
-    inputs_df = pd.merge(product_inputs_details, product_inputs, left_on="index", right_on="row")
-
-    # Calculate impact scores for these inputs
-    in_scores = -1 * inputs_df["coefficient"] * lcia[inputs_df["row"], method_index]
-    inputs_df["LCIAscore"] = in_scores
-    inputs_df["scaled_scores"] = inputs_df["LCIAscore"]
-    inputs_df["coefficient"] = abs(inputs_df["coefficient"])
-    inputs_df["next_coefficient"] = inputs_df["coefficient"]
-    inputs_df["chain"] = inputs_df["row"].astype(str)
-    inputs_df = inputs_df.sort_values("LCIAscore", ascending=False).reset_index(drop=True)
-    for i in range(len(inputs_df)):
-        if "market for" in inputs_df.loc[i, "activityName"]:
-            inputs_df.loc[i, "product"] = "[m] " + inputs_df.loc[i, "product"]
-        elif "market group" in inputs_df.loc[i, "activityName"]:
-            inputs_df.loc[i, "product"] = "[mg] " + inputs_df.loc[i, "product"]
-
-    # Split into positive and negative input scores
-    # for negative scores
-    inputs_df_neg = inputs_df[inputs_df["LCIAscore"] < 0].sort_values("LCIAscore").reset_index(drop=True)
-    inputs_df_neg["LCIAscore"] = abs(inputs_df_neg["LCIAscore"])
-    inputs_df_neg["scaled_scores"] = abs(inputs_df_neg["scaled_scores"])
-    inputs_df_neg_g = inputs_df_neg.groupby("product").sum().sort_values("LCIAscore", ascending=False).reset_index()
-    inputs_df_neg_g["hues"] = hues_treemaps[2]
-    # for positive scores
-    inputs_df_pos = inputs_df[inputs_df["LCIAscore"] >= 0].sort_values("LCIAscore", ascending=False).reset_index(
-        drop=True)
-    inputs_df_pos_g = inputs_df_pos.groupby("product").sum().sort_values("LCIAscore", ascending=False).reset_index()
-    inputs_df_pos_g["hues"] = hues_treemaps[0]
-
-    # Gather information on the emissions for this product
-    product_emissions = B_public[B_public["column"] == prod_index]
-    product_emissions_details = ee_index.iloc[product_emissions["row"]]
-    emissions_df = pd.merge(product_emissions_details, product_emissions, left_on="index", right_on="row")
-
-    # Extract impact scores for these emissions
-    em_scores = emissions_df["coefficient"] * c_array[product_emissions["row"], method_index]
-    emissions_df["LCIAscore"] = em_scores
-    emissions_df["scaled_scores"] = emissions_df["LCIAscore"]
-    emissions_df["coefficient"] = abs(emissions_df["coefficient"])
-
-    # Split into positive and negative emission scores
-    # for negative scores
-    em_df_neg = emissions_df[emissions_df["LCIAscore"] < 0].sort_values("LCIAscore").reset_index(drop=True)
-    em_df_neg["LCIAscore"] = abs(em_df_neg["LCIAscore"])
-    em_df_neg["scaled_scores"] = abs(em_df_neg["scaled_scores"])
-    em_df_neg_g = em_df_neg.groupby("name").sum().sort_values("LCIAscore", ascending=False).reset_index()
-    em_df_neg_g["hues"] = hues_treemaps[3]
-    # for positive scores
-    em_df_pos = emissions_df[emissions_df["LCIAscore"] >= 0].sort_values("LCIAscore", ascending=False).reset_index(
-        drop=True)
-    em_df_pos_g = em_df_pos.groupby("name").sum().sort_values("LCIAscore", ascending=False).reset_index()
-    em_df_pos_g["hues"] = hues_treemaps[1]
-
-    return (product_info, inputs_df_pos, inputs_df_pos_g, em_df_pos, em_df_pos_g,
-            inputs_df_neg, inputs_df_neg_g, em_df_neg, em_df_neg_g)
-
-
-def create_nextlevel_dfs(inputs_df_pos, inputs_df_pos_g, inputs_df_neg, inputs_df_neg_g,
-                         method_index, positives, negatives):
+    # Gather the inputs for this product, without the reference product itself
+    product_inputs = dl.column_slice(dl.A_public, dl.A_public_indptr, prod_index)
+    product_inputs = product_inputs[product_inputs["row"].values != prod_index]
+    inputs = {"row": product_inputs["row"].values, "coefficient": product_inputs["coefficient"].values}
+
+    # Gather the emissions for this product
+    product_emissions = dl.column_slice(dl.B_public, dl.B_public_indptr, prod_index)
+    emissions = {"row": product_emissions["row"].values, "coefficient": product_emissions["coefficient"].values}
+
+    cache_put(exchange_cache, key, (product_info, inputs, emissions))
+
+    return product_info, inputs, emissions
+
+
+def score_order(scores, ascending=True):
+    """
+    This function returns the order of the scores in the same way as pandas' sort_values does, so that products
+    with equal scores stay in the same order as in the plots made with dataframes.
+
+    Required arguments:
+    - scores: numpy array of float
+
+    Optional arguments:
+    - ascending: bool, sorting direction. Default is True.
+
+    Returns:
+    - numpy array with the indices that sort the scores
+    """
+    if ascending:
+        return scores.argsort(kind="quicksort")
+    reverse = np.arange(len(scores))[::-1]
+    return reverse[scores[::-1].argsort(kind="quicksort")][::-1]
+
+
+def group_scores(codes, scores, sort=True):
+    """
+    This function sums up the scores of all the exchanges with the same product or emission name (code), same as
+    groupby("product").sum() on a dataframe.
+
+    Required arguments:
+    - codes: numpy array of int, the codes of the product labels or emission names (see load_system_model)
+    - scores: numpy array of float, the scores of the exchanges
+
+    Optional arguments:
+    - sort: bool, if True, the groups are sorted by their score in descending order, else they stay in the
+        alphabetical order of their labels. Default is True.
+
+    Returns:
+    - two numpy arrays with the codes and the summed scores of the groups
+    """
+    valid = codes >= 0
+    group_codes, inverse = np.unique(codes[valid], return_inverse=True)
+    group_values = np.bincount(inverse, weights=scores[valid], minlength=len(group_codes))
+    if sort:
+        order = score_order(group_values, ascending=False)
+        group_codes = group_codes[order]
+        group_values = group_values[order]
+
+    return group_codes, group_values
+
+
+def compute_treemap_arrays(prod_index, method_index_list):
+    """
+    This function extracts all the required information for one product from the matrices and converts it into
+    arrays used for plotting, for several methods at once. The scores of the inputs and emissions are calculated
+    for all the methods in one step.
+
+    Required arguments:
+    - prod_index: int, index of the product to be plotted from the ie_index matrix, e.g. 12759.
+    - method_index_list: list of int, indices of the LCIA methods from the LCIA_index matrix.
+        The most common ones are: [222, 485, 541] (or 540 in consequential).
+
+    Returns:
+    - a list with one dictionary per method with the product_info and, for the positive / negative inputs and
+        emissions (inputs_pos, emissions_pos, inputs_neg, emissions_neg), a dictionary of arrays with the rows,
+        the label codes, the absolute coefficients and the absolute scores, sorted by score in descending order.
+    """
+    # Import the data set according to the selected system model
+    lcia, columns = dl.lcia_scores(method_index_list)
+
+    product_info, inputs, emissions = extract_product_exchanges(prod_index)
+
+    # Calculate impact scores for the inputs and emissions, one column per method
+    in_scores = -1 * inputs["coefficient"][:, np.newaxis] * lcia[np.ix_(inputs["row"], columns)]
+    em_scores = (emissions["coefficient"][:, np.newaxis] *
+                 np.column_stack([dl.characterization_factors(method_index)[emissions["row"]]
+                                  for method_index in method_index_list]))
+
+    inputs = {"row": inputs["row"], "code": dl.product_label_codes[inputs["row"]],
+              "coefficient": abs(inputs["coefficient"])}
+    emissions = {"row": emissions["row"], "code": dl.emission_name_codes[emissions["row"]],
+                 "coefficient": abs(emissions["coefficient"])}
+
+    arrays_by_method = []
+    for meth_ix in range(len(method_index_list)):
+        # Sort the inputs by score, then split into positive and negative scores
+        order = score_order(in_scores[:, meth_ix], ascending=False)
+        sorted_inputs = {name: values[order] for name, values in inputs.items()}
+        sorted_inputs["score"] = in_scores[order, meth_ix]
+
+        emissions_scored = dict(emissions, score=em_scores[:, meth_ix])
+
+        arrays_by_method.append({"product_info": product_info,
+                                 "inputs_pos": split_scores(sorted_inputs, positive=True),
+                                 "emissions_pos": split_scores(emissions_scored, positive=True),
+                                 "inputs_neg": split_scores(sorted_inputs, positive=False),
+                                 "emissions_neg": split_scores(emissions_scored, positive=False)})
+
+    return arrays_by_method
+
+
+def split_scores(exchanges, positive):
+    """
+    This function selects either the positive (including zero) or the negative scores of the exchanges and sorts
+    them by their absolute score in descending order.
+
+    Required arguments:
+    - exchanges: dictionary of arrays with the rows, codes, coefficients and scores of the exchanges
+    - positive: bool, if True, the positive scores are selected, else the negative ones
+
+    Returns:
+    - dictionary of arrays with the selected exchanges and their absolute scores
+    """
+    if positive:
+        selected = exchanges["score"] >= 0
+    else:
+        selected = exchanges["score"] < 0
+    exchanges = {name: values[selected] for name, values in exchanges.items()}
+    order = score_order(exchanges["score"], ascending=not positive)
+    exchanges = {name: values[order] for name, values in exchanges.items()}
+    exchanges["score"] = abs(exchanges["score"])
+
+    return exchanges
+
+
+def group_totals(groups):
+    """
+    This function sums up the grouped scores of the positive / negative inputs / emissions of one level once,
+    so that the totals do not need to be summed up again while plotting.
+
+    Required arguments:
+    - groups: dictionary with the codes and the grouped scores of the inputs and emissions of one level
+
+    Returns:
+    - dictionary with the total score of each group as float
+    """
+    return {name: float(values.sum()) for name, (codes, values) in groups.items()}
+
+
+def create_firstlevel_arrays(prod_index, method_index):
+    """
+    This function creates the first level of the treemap of one product.
+
+    Required arguments:
+    - prod_index: int, the index of the product to be plotted.
+    - method_index: int, the LCIA method used.
+
+    Returns:
+    - product_info: the row of ie_index for this product with the activity name shortened for plotting
+    - level: dictionary with the positive and negative inputs (inputs_pos, inputs_neg) as arrays with the rows,
+        codes, scaled scores and next coefficients, the grouped scores (groups) of the positive / negative
+        inputs / emissions as tuples of codes and values, and the total of each group (totals)
+    """
+    arrays = treemap_arrays(prod_index, method_index)
+
+    level = {"groups": {}}
+    for name in ["inputs_pos", "inputs_neg"]:
+        level[name] = {"row": arrays[name]["row"], "code": arrays[name]["code"],
+                       "scaled_scores": arrays[name]["score"], "next_coefficient": arrays[name]["coefficient"]}
+        level["groups"][name] = group_scores(arrays[name]["code"], arrays[name]["score"])
+    for name in ["emissions_pos", "emissions_neg"]:
+        level["groups"][name] = group_scores(arrays[name]["code"], arrays[name]["score"])
+    level["totals"] = group_totals(level["groups"])
+
+    return arrays["product_info"], level
+
+
+def create_nextlevel_arrays(level, method_index, positives, negatives, threshold=0.5):
     """
     This function checks if the positive or the negative maximum contributor needs to be
     broken down to the next level. Then it extracts the required information for all the
     grouped inputs that make up this maximum contributor.
 
     Required arguments:
-    - system_model: str, select one of the following: 'cutoff', 'consequential', 'apos'.
-    - four dataframes: inputs_df_pos, inputs_df_pos_g, inputs_df_neg, inputs_df_neg_g
-        from create_dfs_treemaps function.
-    - prod_index: int, the index of the product to be plotted.
+    - level: dictionary with the arrays of the previous level, from create_firstlevel_arrays or a previous use
+        of this function
     - method_index: int, the LCIA method used.
     - positives: the sum of all the positive values on whatever level the function is used from sum_values function.
     - negatives: the sum of all the negative values on whatever level the function is used from sum_values function.
 
+    Optional arguments:
+    - threshold: float, share above which the positive maximum contributor is broken down, else the negative
+        one is. Default is 0.5.
+
     Returns:
-    - eight new dataframes with all the positive / negative inputs / emissions to be used for
-        plotting the maximum contributor on the next level.
-    """
-    # Check that DF is not empty and if main contributor is positive and above 50%
-    if (not inputs_df_pos_g.empty and not inputs_df_pos_g["scaled_scores"][0] /
-            (positives + negatives + np.exp(-30)) < 0.5):
-        grouped_inputs = inputs_df_pos[inputs_df_pos["product"] == inputs_df_pos_g.iloc[0]["product"]
-                                       ]["chain"].tolist()
-        inputs_df_pos_2_list = []
-        em_df_pos_2_list = []
-        inputs_df_neg_2_list = []
-        em_df_neg_2_list = []
-
-        # For all subproducts run the create_dfs_treemaps function
-        for i in grouped_inputs:
-            # Uses a unique identifier via 'chain' from create_dfs_treemaps function to
-            # define the index of the max contributor
-            prod = inputs_df_pos[inputs_df_pos["chain"] == f"{i}"]["row"].tolist()
-            (product_info_2, inputs_df_pos_2, inputs_df_pos_g_2, em_df_pos_2,
-             em_df_pos_g_2, inputs_df_neg_2, inputs_df_neg_g_2, em_df_neg_2,
-             em_df_neg_g_2) = create_dfs_treemaps(prod[0], method_index)
-
-            # For positive inputs: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            inputs_df_pos_2["prev_coefficient"] = inputs_df_pos[inputs_df_pos["chain"] == f"{i}"
-                                                                ]["next_coefficient"].tolist() * len(inputs_df_pos_2)
-            inputs_df_pos_2["next_coefficient"] = inputs_df_pos_2["prev_coefficient"] * inputs_df_pos_2["coefficient"]
-            inputs_df_pos_2["scaled_scores"] = inputs_df_pos_2["LCIAscore"] * inputs_df_pos_2["prev_coefficient"]
-            inputs_df_pos_2["chain"] = inputs_df_pos_2["row"].astype(str) + "_" + str(i)
-
-            # For positive emissions: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            em_df_pos_2["prev_coefficient"] = inputs_df_pos[inputs_df_pos["chain"] == f"{i}"
-                                                            ]["next_coefficient"].tolist() * len(em_df_pos_2)
-            em_df_pos_2["next_coefficient"] = em_df_pos_2["prev_coefficient"] * em_df_pos_2["coefficient"]
-            em_df_pos_2["scaled_scores"] = em_df_pos_2["LCIAscore"] * em_df_pos_2["prev_coefficient"]
-            # Create lists for all positive input and emissions for all products that make up the max contributor
-            inputs_df_pos_2_list.append(inputs_df_pos_2)
-            em_df_pos_2_list.append(em_df_pos_2)
-
-            # For negative inputs: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            inputs_df_neg_2["prev_coefficient"] = inputs_df_pos[inputs_df_pos["chain"] == f"{i}"
-                                                                ]["next_coefficient"].tolist() * len(inputs_df_neg_2)
-            inputs_df_neg_2["next_coefficient"] = inputs_df_neg_2["prev_coefficient"] * inputs_df_neg_2["coefficient"]
-            inputs_df_neg_2["scaled_scores"] = inputs_df_neg_2["LCIAscore"] * inputs_df_neg_2["prev_coefficient"]
-            inputs_df_neg_2["chain"] = inputs_df_neg_2["row"].astype(str) + "_" + str(i)
-
-            # For negative emissions: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            em_df_neg_2["prev_coefficient"] = inputs_df_pos[inputs_df_pos["chain"] == f"{i}"
-                                                            ]["next_coefficient"].tolist() * len(em_df_neg_2)
-            em_df_neg_2["next_coefficient"] = em_df_neg_2["prev_coefficient"] * em_df_neg_2["coefficient"]
-            em_df_neg_2["scaled_scores"] = em_df_neg_2["LCIAscore"] * em_df_neg_2["prev_coefficient"]
-
-            # Create lists for all negative input and emissions for all products that make up the max contributor
-            inputs_df_neg_2_list.append(inputs_df_neg_2)
-            em_df_neg_2_list.append(em_df_neg_2)
-
-        # Add lists to DFs and define hue:
-        # for positive inputs:
-        inputs_df_pos_2 = pd.concat(inputs_df_pos_2_list)
-        inputs_df_pos_2 = inputs_df_pos_2.sort_values("scaled_scores", ascending=False).reset_index()
-        inputs_df_pos_g_2 = inputs_df_pos_2.groupby("product").sum("scaled_scores").sort_values(
-            "scaled_scores", ascending=False).reset_index()
-        inputs_df_pos_g_2["hues"] = hues_treemaps[0]
-        # for positive emissions:
-        em_df_pos_2 = pd.concat(em_df_pos_2_list)
-        em_df_pos_g_2 = em_df_pos_2.groupby("name").sum().reset_index()
-        em_df_pos_g_2["hues"] = hues_treemaps[1]
-        # for negative inputs:
-        inputs_df_neg_2 = pd.concat(inputs_df_neg_2_list)
-        inputs_df_neg_2 = inputs_df_neg_2.sort_values("scaled_scores", ascending=False).reset_index()
-        inputs_df_neg_g_2 = inputs_df_neg_2.groupby("product").sum("scaled_scores").sort_values(
-            "scaled_scores", ascending=False).reset_index()
-        inputs_df_neg_g_2["hues"] = hues_treemaps[2]
-        # for negative emissions:
-        em_df_neg_2 = pd.concat(em_df_neg_2_list)
-        em_df_neg_g_2 = em_df_neg_2.groupby("name").sum().reset_index()
-        em_df_neg_g_2["hues"] = hues_treemaps[3]
-
-    # Check if main contributor is negative
+    - dictionary with the arrays of the next level, same as create_firstlevel_arrays, and the indices of the
+        products that were broken down (expanded)
+    """
+    # Check that the inputs are not empty and if main contributor is positive and above the threshold,
+    # else take the negative
+    positive_groups = level["groups"]["inputs_pos"]
+    if (len(positive_groups[1]) and not positive_groups[1][0] /
+            (positives + negatives + np.exp(-30)) < threshold):
+        max_contributor = "inputs_pos"
     else:
-        grouped_inputs = inputs_df_neg[inputs_df_neg["product"] == inputs_df_neg_g.iloc[0]["product"]
-                                       ]["chain"].tolist()
-
-        inputs_df_pos_2_list = []
-        em_df_pos_2_list = []
-        inputs_df_neg_2_list = []
-        em_df_neg_2_list = []
-        # For all subproducts run the create_dfs_treemaps function
-        for i in grouped_inputs:
-            # Uses a unique identifier via 'chain' from create_dfs_treemaps function to define
-            # the index of the max contributor
-            prod = inputs_df_neg[inputs_df_neg["chain"] == f"{i}"]["row"].tolist()
-            (product_info_2, inputs_df_pos_2, inputs_df_pos_g_2, em_df_pos_2,
-             em_df_pos_g_2, inputs_df_neg_2, inputs_df_neg_g_2, em_df_neg_2,
-             em_df_neg_g_2) = create_dfs_treemaps(prod[0], method_index)
-
-            # For negative inputs: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            inputs_df_neg_2["prev_coefficient"] = inputs_df_neg[inputs_df_neg["chain"] == f"{i}"
-                                                                ]["next_coefficient"].tolist() * len(inputs_df_neg_2)
-            inputs_df_neg_2["next_coefficient"] = inputs_df_neg_2["prev_coefficient"] * inputs_df_neg_2["coefficient"]
-            inputs_df_neg_2["scaled_scores"] = inputs_df_neg_2["LCIAscore"] * inputs_df_neg_2["prev_coefficient"]
-            inputs_df_neg_2["chain"] = inputs_df_neg_2["row"].astype(str) + "_" + str(i)
-
-            # For negative emissions: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            em_df_neg_2["prev_coefficient"] = inputs_df_neg[inputs_df_neg["chain"] == f"{i}"
-                                                            ]["next_coefficient"].tolist() * len(em_df_neg_2)
-            em_df_neg_2["next_coefficient"] = em_df_neg_2["prev_coefficient"] * em_df_neg_2["coefficient"]
-            em_df_neg_2["scaled_scores"] = em_df_neg_2["LCIAscore"] * em_df_neg_2["prev_coefficient"]
-
-            # Create lists for all negative input and emissions for all products that make up the max contributor
-            inputs_df_neg_2_list.append(inputs_df_neg_2)
-            em_df_neg_2_list.append(em_df_neg_2)
-
-            # For positive inputs: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            inputs_df_pos_2["prev_coefficient"] = inputs_df_neg[inputs_df_neg["chain"] == f"{i}"
-                                                                ]["next_coefficient"].tolist() * len(inputs_df_pos_2)
-            inputs_df_pos_2["next_coefficient"] = inputs_df_pos_2["prev_coefficient"] * inputs_df_pos_2["coefficient"]
-            inputs_df_pos_2["scaled_scores"] = inputs_df_pos_2["LCIAscore"] * inputs_df_pos_2["prev_coefficient"]
-            inputs_df_pos_2["chain"] = inputs_df_pos_2["row"].astype(str) + "_" + str(i)
-
-            # For positive emissions: Add previous coefficients, next coefficients of the main contributor
-            # and scaled scores to the df_2
-            em_df_pos_2["prev_coefficient"] = inputs_df_neg[inputs_df_neg["chain"] == f"{i}"
-                                                            ]["next_coefficient"].tolist() * len(em_df_pos_2)
-            em_df_pos_2["next_coefficient"] = em_df_pos_2["prev_coefficient"] * em_df_pos_2["coefficient"]
-            em_df_pos_2["scaled_scores"] = em_df_pos_2["LCIAscore"] * em_df_pos_2["prev_coefficient"]
-
-            # Create lists for all positive input and emissions for all products that make up the max contributor
-            inputs_df_pos_2_list.append(inputs_df_pos_2)
-            em_df_pos_2_list.append(em_df_pos_2)
-
-        # Add lists to DFs and define hue:
-        # for negative inputs:
-        inputs_df_neg_2 = pd.concat(inputs_df_neg_2_list)
-        inputs_df_neg_2 = inputs_df_neg_2.sort_values("scaled_scores", ascending=False).reset_index()
-        inputs_df_neg_g_2 = inputs_df_neg_2.groupby("product").sum("scaled_scores").sort_values(
-            "scaled_scores", ascending=False).reset_index()
-        inputs_df_neg_g_2["hues"] = hues_treemaps[2]
-        # for negative emissions:
-        em_df_neg_2 = pd.concat(em_df_neg_2_list)
-        em_df_neg_g_2 = em_df_neg_2.groupby("name").sum().reset_index()
-        em_df_neg_g_2["hues"] = hues_treemaps[3]
-        # for positive inputs:
-        inputs_df_pos_2 = pd.concat(inputs_df_pos_2_list)
-        inputs_df_pos_2 = inputs_df_pos_2.sort_values("scaled_scores", ascending=False).reset_index()
-        inputs_df_pos_g_2 = inputs_df_pos_2.groupby("product").sum("scaled_scores").sort_values(
-            "scaled_scores", ascending=False).reset_index()
-        inputs_df_pos_g_2["hues"] = hues_treemaps[0]
-        # for positive emissions:
-        em_df_pos_2 = pd.concat(em_df_pos_2_list)
-        em_df_pos_g_2 = em_df_pos_2.groupby("name").sum().reset_index()
-        em_df_pos_g_2["hues"] = hues_treemaps[1]
-
-    return (inputs_df_pos_2, inputs_df_pos_g_2, em_df_pos_2, em_df_pos_g_2,
-            inputs_df_neg_2, inputs_df_neg_g_2, em_df_neg_2, em_df_neg_g_2)
+        max_contributor = "inputs_neg"
+    inputs = level[max_contributor]
+    grouped_inputs = inputs["code"] == level["groups"][max_contributor][0][0]
+
+    # For all subproducts that make up the max contributor, scale the arrays by the previous coefficients
+    parts = {"inputs_pos": [], "emissions_pos": [], "inputs_neg": [], "emissions_neg": []}
+    for prod, prev_coefficient in zip(inputs["row"][grouped_inputs], inputs["next_coefficient"][grouped_inputs]):
+        arrays = treemap_arrays(prod, method_index)
+        for name in parts:
+            parts[name].append({"row": arrays[name]["row"], "code": arrays[name]["code"],
+                                "scaled_scores": arrays[name]["score"] * prev_coefficient,
+                                "next_coefficient": prev_coefficient * arrays[name]["coefficient"]})
+
+    next_level = {"groups": {}, "expanded": inputs["row"][grouped_inputs]}
+    for name in parts:
+        exchanges = {column: np.concatenate([part[column] for part in parts[name]])
+                     for column in ["row", "code", "scaled_scores", "next_coefficient"]}
+        if name.startswith("inputs"):
+            # Inputs are sorted by score and grouped by product, with the max contributor first
+            order = score_order(exchanges["scaled_scores"], ascending=False)
+            exchanges = {column: values[order] for column, values in exchanges.items()}
+            next_level[name] = exchanges
+            next_level["groups"][name] = group_scores(exchanges["code"], exchanges["scaled_scores"])
+        else:
+            # Emissions are grouped by name and keep the alphabetical order
+            next_level["groups"][name] = group_scores(exchanges["code"], exchanges["scaled_scores"], sort=False)
+    next_level["totals"] = group_totals(next_level["groups"])
+
+    return next_level
+
+
+def product_costs(prod_index_list, method_index_list, max_levels=5, threshold=0.5):
+    """
+    This function estimates the relative cost of plotting the bar plot and the treemaps of several products, without
+    preparing them. The cost of a level is estimated from the number of exchanges (the column sizes in A and B) of
+    the product broken down at this level. The number of levels of a treemap is estimated from the share of the
+    largest input at the first level: a product with a share above the threshold is expected to be broken down,
+    the deeper the larger the share.
+
+    Required arguments:
+    - prod_index_list: list of int, indices of the products from the ie_index matrix
+    - method_index_list: list of int, indices of the LCIA methods
+
+    Optional arguments:
+    - max_levels: int, maximum number of levels of the treemaps. Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down. Default is 0.5.
+
+    Returns:
+    - costs: numpy array of float, the estimated cost of each product, in the order of prod_index_list
+    """
+    lcia, columns = dl.lcia_scores(method_index_list)
+    n_products = len(dl.ie_index)
+    prods = np.asarray(prod_index_list, dtype=int)
+    sizes = np.diff(dl.A_public_cor_indptr) + np.diff(dl.B_public_indptr)
+    inputs = dl.A_public_cor
+    emissions = dl.B_public
+
+    costs = np.zeros(len(prods))
+    for meth, column in zip(method_index_list, columns):
+        # Absolute scores of the inputs (as matrix, to find the largest one) and the emissions of all the products
+        input_scores = sp.csc_matrix((abs(inputs["coefficient"].values * lcia[inputs["row"].values, column]),
+                                      (inputs["row"].values, inputs["column"].values)),
+                                     shape=(n_products, n_products))
+        emission_scores = np.bincount(emissions["column"].values, minlength=n_products,
+                                      weights=abs(emissions["coefficient"].values *
+                                                  dl.characterization_factors(meth)[emissions["row"].values]))
+        total = np.asarray(input_scores.sum(axis=0)).ravel() + emission_scores
+        share = input_scores.max(axis=0).toarray().ravel() / (total + np.exp(-30))
+        max_contributor = np.asarray(input_scores.argmax(axis=0)).ravel()
+
+        levels = np.where(share >= threshold, 1 + (max_levels - 1) * np.minimum(share, 1), 1)
+        costs += 1 + sizes[prods] + (levels[prods] - 1) * (1 + sizes[max_contributor[prods]])
+
+    return costs
+
+
+def structure_costs(prod_index_list):
+    """
+    This function estimates the relative cost of plotting several products from integer quantities only: the number
+    of exchanges (the column sizes in A and B) of the product and of each of its inputs, as if every input was broken
+    down once. Unlike product_costs, the result does not depend on the lcia scores or on floating point rounding, so
+    that independent processes or machines compute the same costs (see pf.shard_products).
+
+    Required arguments:
+    - prod_index_list: list of int, indices of the products from the ie_index matrix
+
+    Returns:
+    - costs: numpy array of int, the estimated cost of each product, in the order of prod_index_list
+    """
+    n_products = len(dl.ie_index)
+    prods = np.asarray(prod_index_list, dtype=int)
+    sizes = (np.diff(dl.A_public_cor_indptr) + np.diff(dl.B_public_indptr)).astype(np.int64)
+
+    input_sizes = np.zeros(n_products, dtype=np.int64)
+    np.add.at(input_sizes, dl.A_public_cor["column"].values, 1 + sizes[dl.A_public_cor["row"].values])
+
+    return 1 + sizes[prods] + input_sizes[prods]
+
+
+# Fingerprints
+def update_fingerprint(sha, *values):
+    """
+    This function adds arrays or other values to a hash object (see barplot_fingerprint, treemap_fingerprint).
+    """
+    for value in values:
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            sha.update(np.ascontiguousarray(value).tobytes())
+        else:
+            sha.update(repr(np.asarray(value, dtype=object).tolist()).encode())
+        sha.update(b";")
+
+
+def barplot_fingerprint(prod_index, method_index_list):
+    """
+    This function calculates a fingerprint of all the data the bar plot of one product depends on: the column of
+    the product in A and B, the lcia scores of the product and its inputs, the characterization factors of its
+    emissions, their 'flow compartments' and the names of the product and the methods. The fingerprint only changes
+    between releases if the bar plot can change.
+
+    Required arguments:
+    - prod_index: int, index of the product from the ie_index matrix
+    - method_index_list: list of int, indices of the LCIA methods
+
+    Returns:
+    - string, sha256 hex digest
+    """
+    lcia, columns = dl.lcia_scores(method_index_list)
+    product_inputs = dl.column_slice(dl.A_public_cor, dl.A_public_cor_indptr, prod_index)
+    product_emissions = dl.column_slice(dl.B_public, dl.B_public_indptr, prod_index)
+    input_rows = product_inputs["row"].values
+    emission_rows = product_emissions["row"].values
+
+    sha = hashlib.sha256()
+    update_fingerprint(sha, dl.ie_index.iloc[prod_index][["activityName", "geography"]].values,
+                       dl.LCIA_index['method_long'].values[method_index_list],
+                       input_rows, product_inputs["coefficient"].values,
+                       emission_rows, product_emissions["coefficient"].values,
+                       dl.ee_index["impact_cat"].values[emission_rows],
+                       np.asarray(lcia[prod_index, columns]))
+    for meth, column in zip(method_index_list, columns):
+        update_fingerprint(sha, np.asarray(lcia[input_rows, column]),
+                           dl.characterization_factors(meth)[emission_rows])
+
+    return sha.hexdigest()
+
+
+def treemap_fingerprint(prod_index, method_index, used_products):
+    """
+    This function calculates a fingerprint of all the data the treemap of one product and method depends on: the
+    product, its inputs with their lcia scores and labels and its emissions with their characterization factors and
+    names, for the product and all the contributors that were broken down at the next levels, and the name of the
+    method. The fingerprint is calculated from the matrices directly, so that an unchanged treemap can be recognized
+    before its data is prepared. It only changes between releases if the treemap can change.
+
+    Required arguments:
+    - prod_index: int, index of the product from the ie_index matrix
+    - method_index: int, index of the LCIA method
+    - used_products: list of int, indices of the products broken down by sort_datasets
+
+    Returns:
+    - string, sha256 hex digest
+    """
+    lcia, (column,) = dl.lcia_scores([method_index])
+    characterization = dl.characterization_factors(method_index)
+
+    sha = hashlib.sha256()
+    update_fingerprint(sha, dl.LCIA_index.iloc[method_index].values)
+    for prod in [prod_index] + list(used_products):
+        product_inputs = dl.column_slice(dl.A_public_cor, dl.A_public_cor_indptr, prod)
+        product_emissions = dl.column_slice(dl.B_public, dl.B_public_indptr, prod)
+        input_rows = product_inputs["row"].values
+        emission_rows = product_emissions["row"].values
+        update_fingerprint(sha, int(prod), dl.ie_index.iloc[prod].values,
+                           input_rows, product_inputs["coefficient"].values, np.asarray(lcia[input_rows, column]),
+                           dl.product_label_names[dl.product_label_codes[input_rows]],
+                           emission_rows, product_emissions["coefficient"].values, characterization[emission_rows],
+                           dl.emission_names[dl.emission_name_codes[emission_rows]])
+
+    return sha.hexdigest()
+
+
+def group_labels(group, codes):
+    """
+    This function returns the labels of the grouped inputs or emissions.
+
+    Required arguments:
+    - group: str, one of treemap_groups, e.g. "inputs_pos"
+    - codes: numpy array of int, the codes of the groups from group_scores
+
+    Returns:
+    - list of strings, the product labels for inputs or the emission names for emissions
+    """
+    if group.startswith("inputs"):
+        return dl.product_label_names[codes].tolist()
+    return dl.emission_names[codes].tolist()
+
+
+def group_hue(group):
+    """
+    This function returns the color of the inputs or emissions in the treemaps.
+
+    Required arguments:
+    - group: str, one of treemap_groups, e.g. "inputs_pos"
+
+    Returns:
+    - str, the color from hues_treemaps
+    """
+    return hues_treemaps[treemap_groups.index(group)]
@@ -3,44 +3,42 @@ from itertools import chain
 
 
 # Helper functions for treemaps
-def plot_type_definition(inputs_df_pos_g, em_df_pos_g, inputs_df_neg_g, em_df_neg_g):
+def plot_type_definition(inputs_pos_total, em_pos_total, inputs_neg_total, em_neg_total):
     """
     This function evaluates what type of next level plotting is required.
-    It takes in the dataframes and checks if the total of all the values is negative,
+    It takes in the totals of the grouped scores and checks if the total of all the values is negative,
     positive or zero
 
     Required arguments:
-    - four dataframes: inputs_df_pos_g, em_df_pos_g, inputs_df_neg_g, em_df_neg_g
-        created in preprocess_dataset_groupsort or next_level_processing function
+    - four floats with the totals of the grouped scores: inputs_pos_total, em_pos_total, inputs_neg_total,
+        em_neg_total, created in create_firstlevel_arrays or create_nextlevel_arrays function
 
     Returns:
     - plot_type: string, one of the following: "zero", "pos", "neg"
     """
     plot_type = ""
+    positives = inputs_pos_total + em_pos_total
+    negatives = inputs_neg_total + em_neg_total
     # Check if 'zero'
-    if (sum(inputs_df_pos_g["scaled_scores"]) + sum(em_df_pos_g["scaled_scores"]) +
-            sum(inputs_df_neg_g["scaled_scores"]) + sum(em_df_neg_g["scaled_scores"]) == 0):
+    if positives + negatives == 0:
         plot_type = "zero"
     # Check if 'pos'
-    elif (sum(inputs_df_pos_g["scaled_scores"]) + sum(em_df_pos_g["scaled_scores"]) >=
-          sum(inputs_df_neg_g["scaled_scores"]) + sum(em_df_neg_g["scaled_scores"])):
+    elif positives >= negatives:
         plot_type = "pos"
     # Check if 'neg'
-    elif (sum(inputs_df_pos_g["scaled_scores"]) + sum(em_df_pos_g["scaled_scores"]) <
-          sum(inputs_df_neg_g["scaled_scores"]) + sum(em_df_neg_g["scaled_scores"])):
+    elif positives < negatives:
         plot_type = "neg"
 
     return plot_type
 
 
-def shorten_product_name(inputs_df_pos_g, positives, negatives, prev_labels):
+def shorten_product_name(inputs_g, positives, negatives, prev_labels):
     """
     This function caps the product name to a maximum number of characters depending
     on the size of the main contributor.
 
     Required arguments:
-    - four dataframes: inputs_df_pos_g, em_df_pos_g, inputs_df_neg_g, em_df_neg_g
-        created in preprocess_dataset_groupsort or next_level_processing function
+    - inputs_g: array with the grouped scores of the inputs of the previous level, with the main contributor first
     - total positive and negative values created with the sum_values function
     - prev_labels: list of strings, labels from the previous level
 
@@ -48,28 +46,24 @@ def shorten_product_name(inputs_df_pos_g, positives, negatives, prev_labels):
     - prev_labels: list of strings, labels from the previous level with the name of the
     max contributor capped to a maximum length
     """
-    # For non-empty DFs and main contributor over 90%, caps the product label to a maximum length of 130 char
-    if (not inputs_df_pos_g.empty and
-            inputs_df_pos_g.loc[0, "scaled_scores"] / (positives + negatives + np.exp(-30)) > 0.9):
+    # For non-empty inputs and main contributor over 90%, caps the product label to a maximum length of 130 char
+    if len(inputs_g) and inputs_g[0] / (positives + negatives + np.exp(-30)) > 0.9:
         if len(prev_labels[0]) > 130:
             prev_labels[0] = prev_labels[0][:125] + "..."
-    # For non-empty DFs and main contributor between 80-90%, caps the product label to a maximum length of 115 char
-    elif (not inputs_df_pos_g.empty and
-          inputs_df_pos_g.loc[0, "scaled_scores"] / (positives + negatives + np.exp(-30)) > 0.8):
+    # For non-empty inputs and main contributor between 80-90%, caps the product label to a maximum length of 115 char
+    elif len(inputs_g) and inputs_g[0] / (positives + negatives + np.exp(-30)) > 0.8:
         if len(prev_labels[0]) > 115:
             prev_labels[0] = prev_labels[0][:110] + "..."
-    # For non-empty DFs and main contributor between 70-80%, caps the product label to a maximum length of 90 char
-    elif (not inputs_df_pos_g.empty and
-          inputs_df_pos_g.loc[0, "scaled_scores"] / (positives + negatives + np.exp(-30)) > 0.7):
+    # For non-empty inputs and main contributor between 70-80%, caps the product label to a maximum length of 90 char
+    elif len(inputs_g) and inputs_g[0] / (positives + negatives + np.exp(-30)) > 0.7:
         if len(prev_labels[0]) > 90:
             prev_labels[0] = prev_labels[0][:85] + "..."
-    # For non-empty DFs and main contributor between 60-70%, caps the product label to a maximum length of 75 char
-    elif (not inputs_df_pos_g.empty and
-          inputs_df_pos_g.loc[0, "scaled_scores"] / (positives + negatives + np.exp(-30)) > 0.6):
+    # For non-empty inputs and main contributor between 60-70%, caps the product label to a maximum length of 75 char
+    elif len(inputs_g) and inputs_g[0] / (positives + negatives + np.exp(-30)) > 0.6:
         if len(prev_labels[0]) > 75:
             prev_labels[0] = prev_labels[0][:70] + "..."
-    # For other DF, caps the product label to a maximum length of 65 char
-    elif not inputs_df_pos_g.empty:
+    # For other inputs, caps the product label to a maximum length of 65 char
+    elif len(inputs_g):
         if len(prev_labels[0]) > 65:
             prev_labels[0] = prev_labels[0][:60] + "..."
     else:
@@ -138,62 +132,32 @@ def add_linebreaks(labels):
     return labels
 
 
-def sum_values(inputs_df_pos_g, em_df_pos_g,
-               inputs_df_pos_g_2=None, em_df_pos_g_2=None,
-               inputs_df_pos_g_3=None, em_df_pos_g_3=None,
-               inputs_df_pos_g_4=None, em_df_pos_g_4=None,
-               inputs_df_pos_g_5=None, em_df_pos_g_5=None):
+def sum_values(inputs_total, em_total, prev_summed_values=0, prev_inputs_g=None):
     """
     Function description:
     This function sums up either all the positive or all the negative values on all the levels, without duplicating
-    the values of the maximum contributors at each level.
+    the values of the maximum contributors at each level. The sum of the previous levels is carried over, so that
+    only the current level is added.
 
     Required arguments:
-    - inputs_df_pos_g: pandas dataframe containing either the positive or the negative inputs on the first level
-    - em_df_pos_g: pandas dataframe containing either the positive or the negative emissions on the first level
+    - inputs_total: float, the total of the grouped scores of either the positive or the negative inputs
+        on the current level
+    - em_total: float, the total of the grouped scores of either the positive or the negative emissions
+        on the current level
 
     Optional arguments:
-    - pandas dataframes for inputs on all other levels
-    - pandas dataframes for emissions on all other levels
+    - prev_summed_values: float, the result of this function for the previous level. Default is 0.
+    - prev_inputs_g: array with the grouped scores of the same inputs on the previous level, whose maximum
+        contributor is broken down on the current level. Default is None, for the first level.
 
     Returns:
     - the variable 'summed_values' which contains the sum of the scores of all the positive or negative
         inputs and emissions.
     """
-    summed_values = 0
-
-    if inputs_df_pos_g_5 is not None:
-        inputs_df_pos_g_4 = inputs_df_pos_g_4[1:]
-        if not inputs_df_pos_g_5.empty:
-            summed_values += sum(inputs_df_pos_g_5["scaled_scores"])
-        if not em_df_pos_g_5.empty:
-            summed_values += sum(em_df_pos_g_5["scaled_scores"])
-
-    if inputs_df_pos_g_4 is not None:
-        inputs_df_pos_g_3 = inputs_df_pos_g_3[1:]
-        if not inputs_df_pos_g_4.empty:
-            summed_values += sum(inputs_df_pos_g_4["scaled_scores"])
-        if not em_df_pos_g_4.empty:
-            summed_values += sum(em_df_pos_g_4["scaled_scores"])
-
-    if inputs_df_pos_g_3 is not None:
-        inputs_df_pos_g_2 = inputs_df_pos_g_2[1:]
-        if not inputs_df_pos_g_3.empty:
-            summed_values += sum(inputs_df_pos_g_3["scaled_scores"])
-        if not em_df_pos_g_3.empty:
-            summed_values += sum(em_df_pos_g_3["scaled_scores"])
-
-    if inputs_df_pos_g_2 is not None:
-        inputs_df_pos_g = inputs_df_pos_g[1:]
-        if not inputs_df_pos_g_2.empty:
-            summed_values += sum(inputs_df_pos_g_2["scaled_scores"])
-        if not em_df_pos_g_2.empty:
-            summed_values += sum(em_df_pos_g_2["scaled_scores"])
-
-    if not inputs_df_pos_g.empty:
-        summed_values += sum(inputs_df_pos_g["scaled_scores"])
-    if not em_df_pos_g.empty:
-        summed_values += sum(em_df_pos_g["scaled_scores"])
+    summed_values = prev_summed_values
+    if prev_inputs_g is not None and len(prev_inputs_g):
+        summed_values -= prev_inputs_g[0]
+    summed_values += inputs_total + em_total
 
     return summed_values
 
@@ -5,14 +5,30 @@ import helper_functions as hf
 
 
 # List preparation for treemaps
-def first_level_lists(product_info, inputs_df_pos_g, em_df_pos_g, inputs_df_neg_g, em_df_neg_g,
-                      positives, negatives):
+def plot_order(plot_type):
+    """
+    This function defines the order of the grouped inputs and emissions in the lists for plotting.
+
+    Required arguments:
+    - plot_type: string, one of the following: "zero", "pos", "neg", from the plot_type_definition function
+
+    Returns:
+    - list of strings, the groups (see treemap_groups), starting with the inputs of the sign of the plot type
+    """
+    if plot_type == "pos":
+        return ["inputs_pos", "emissions_pos", "inputs_neg", "emissions_neg"]
+    return ["inputs_neg", "emissions_neg", "inputs_pos", "emissions_pos"]
+
+
+def first_level_lists(product_info, groups, order, positives, negatives):
     """
     This function creates lists for plotting at the first level.
 
     Required arguments:
-    - five dataframes created before, either with the create_dfs_treemaps function: product_info,
-    inputs_df_pos_g, em_df_pos_g, inputs_df_neg_g, em_df_neg_g. The order varies depending on the plot type.
+    - product_info: the product to be plotted, from the create_firstlevel_arrays function
+    - groups: dictionary with the codes and the grouped scores of the inputs and emissions, created with the
+    create_firstlevel_arrays function
+    - order: list of strings, the order of the groups from the plot_order function
     - positives: the sum of all the positive values on the first level, created with the sum_values function
     - negatives: the sum of all the negative values on the first level, created with the sum_values function
 
@@ -20,20 +36,18 @@ def first_level_lists(product_info, inputs_df_pos_g, em_df_pos_g, inputs_df_neg_
     - five lists required for plotting: labels, ids, parents, values, colors
     - score: the LCIA score of the product
     """
-    values = ([positives + negatives] +
-              list(inputs_df_pos_g["scaled_scores"]) + list(em_df_pos_g["scaled_scores"]) +
-              list(inputs_df_neg_g["scaled_scores"]) + list(em_df_neg_g["scaled_scores"]))
-
-    labels = ([product_info["activityName"]] + list(inputs_df_pos_g["product"]) +
-              list(em_df_pos_g["name"]) + list(inputs_df_neg_g["product"]) + list(em_df_neg_g["name"]))
+    values = [positives + negatives]
+    labels = [product_info["activityName"]]
+    parents = [""]
+    colors = [""]
+    for group in order:
+        codes, scores = groups[group]
+        values += scores.tolist()
+        labels += dp.group_labels(group, codes)
+        parents += len(codes) * [0]
+        colors += len(codes) * [dp.group_hue(group)]
     labels[1:] = hf.add_linebreaks(labels[1:])
 
-    parents = ([""] + list((len(inputs_df_pos_g)) * [0]) + list((len(em_df_pos_g)) * [0]) +
-               list((len(inputs_df_neg_g)) * [0]) + list((len(em_df_neg_g)) * [0]))
-
-    colors = ([""] + list(inputs_df_pos_g["hues"]) + list(em_df_pos_g["hues"]) +
-              list(inputs_df_neg_g["hues"]) + list(em_df_neg_g["hues"]))
-
     ids = list(range(0, len(labels)))
 
     score = positives - negatives
@@ -41,27 +55,29 @@ def first_level_lists(product_info, inputs_df_pos_g, em_df_pos_g, inputs_df_neg_
     return labels, ids, parents, values, colors, score
 
 
-def append_nextlevel_lists(inputs_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2, inputs_df_neg_g_2, em_df_neg_g_2,
-                           values, prev_labels, parents, colors, level, positives, negatives,
-                           preprev_labels=None, first_labels=None, second_labels=None, third_labels=None):
+def append_nextlevel_lists(inputs_g, groups, totals, order, values, prev_labels, parents, colors, level, positives,
+                           negatives, max_contributors, preprev_labels=None):
     """
     This function takes the lists defined before in the first_level_lists function or in a previous use of this same
     function and appends the next level.
 
     Required arguments:
-    - five dataframes: inputs_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2, inputs_df_neg_g_2, em_df_neg_g_2 created
-    with the create_dfs_treemaps or the create_nextlevel_dfs function for plotting the previous and
-    the current level. The order varies depending on the plot_type.
+    - inputs_g: array with the grouped scores of the inputs of the previous level, of the same sign as the first
+    group in order
+    - groups: dictionary with the codes and the grouped scores of the inputs and emissions of the current level,
+    created with the create_nextlevel_arrays function
+    - totals: dictionary with the total of each group of the current level, created with the
+    create_nextlevel_arrays function
+    - order: list of strings, the order of the groups from the plot_order function
     - four lists created at the previous level: values, prev_labels, parents, colors
-    - level: int, the level at which the function currently is (between 2-6)
-    - positives: the sum of all the positive values on the first level, created with the sum_values function
-    - negatives: the sum of all the negative values on the first level, created with the sum_values function
+    - level: int, the level at which the function currently is (2 or more)
+    - positives: the sum of all the positive values on the previous level, created with the sum_values function
+    - negatives: the sum of all the negative values on the previous level, created with the sum_values function
+    - max_contributors: list of int, the positions in the lists of the maximum contributors of all the previous
+    levels, the last one being the parent of the current level
 
     Optional arguments:
-    - preprev_labels: list of strings, the labels created for plotting the level before the previous one.
-    - first_labels: list of strings, the labels created at the first level.
-    - second_labels: list of strings, the labels created at the second level.
-    - third_labels: list of strings, the labels created at the third level.
+    - preprev_labels: list of strings, the labels created for plotting the levels before the previous one.
 
     Returns:
     - current_labels: list of strings, the labels of only the current level
@@ -69,48 +85,16 @@ def append_nextlevel_lists(inputs_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2, in
     """
     if preprev_labels is None:
         preprev_labels = []
-    if first_labels is None:
-        first_labels = []
-    if second_labels is None:
-        second_labels = []
-    if third_labels is None:
-        third_labels = []
 
     # Values
-    for i in list(inputs_df_pos_g_2["scaled_scores"]):
-        values.append(i)
-    for i in list(em_df_pos_g_2["scaled_scores"]):
-        values.append(i)
-    for i in list(inputs_df_neg_g_2["scaled_scores"]):
-        values.append(i)
-    for i in list(em_df_neg_g_2["scaled_scores"]):
-        values.append(i)
+    for group in order:
+        values += groups[group][1].tolist()
 
-    if level == 2:
-        values[0] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[1] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-
-    elif level == 3:
-        values[0] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[1] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[len(first_labels)] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) +
-                                          sum(em_df_neg_g_2["scaled_scores"]))
-    elif level == 4:
-        values[0] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[1] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[len(first_labels)] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) +
-                                          sum(em_df_neg_g_2["scaled_scores"]))
-        values[len(second_labels)] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) +
-                                           sum(em_df_neg_g_2["scaled_scores"]))
-    elif level == 5:
-        values[0] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[1] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) + sum(em_df_neg_g_2["scaled_scores"]))
-        values[len(first_labels)] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) +
-                                          sum(em_df_neg_g_2["scaled_scores"]))
-        values[len(second_labels)] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) +
-                                           sum(em_df_neg_g_2["scaled_scores"]))
-        values[len(third_labels)] += 2 * (sum(inputs_df_neg_g_2["scaled_scores"]) +
-                                          sum(em_df_neg_g_2["scaled_scores"]))
+    # The credits of the current level are added to the root and all the maximum contributors above
+    credits = 2 * (totals[order[2]] + totals[order[3]])
+    values[0] += credits
+    for max_contributor in max_contributors:
+        values[max_contributor] += credits
 
     # Labels
     # Adjust line breaks
@@ -118,333 +102,148 @@ def append_nextlevel_lists(inputs_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2, in
         prev_labels[1] = prev_labels[1].replace("<br>", " ")
         prev_labels[1] = prev_labels[1].replace("[m]", "market for")
         prev_labels[1] = prev_labels[1].replace("[mg]", "market group for")
-        prev_labels[1:] = hf.shorten_product_name(inputs_df_pos_g, positives, negatives, prev_labels[1:])
+        prev_labels[1:] = hf.shorten_product_name(inputs_g, positives, negatives, prev_labels[1:])
     else:
         prev_labels[0] = prev_labels[0].replace("<br>", " ")
         prev_labels[0] = prev_labels[0].replace("[m]", "market for")
         prev_labels[0] = prev_labels[0].replace("[mg]", "market group for")
-        prev_labels = hf.shorten_product_name(inputs_df_pos_g, positives, negatives, prev_labels)
+        prev_labels = hf.shorten_product_name(inputs_g, positives, negatives, prev_labels)
 
-    current_labels = (hf.add_linebreaks(list(inputs_df_pos_g_2["product"])) +
-                      hf.add_linebreaks(list(em_df_pos_g_2["name"])) +
-                      hf.add_linebreaks(list(inputs_df_neg_g_2["product"])) +
-                      hf.add_linebreaks(list(em_df_neg_g_2["name"])))
+    current_labels = []
+    for group in order:
+        current_labels += hf.add_linebreaks(dp.group_labels(group, groups[group][0]))
 
     labels = list(preprev_labels) + list(prev_labels) + list(current_labels)
 
     # Parents
-    max_contr_index = [1, len(first_labels), len(second_labels), len(third_labels)]
-
-    i = 0
-    while i < len(inputs_df_pos_g_2):
-        parents.append(max_contr_index[level - 2])
-        i += 1
-    i = 0
-    while i < len(em_df_pos_g_2):
-        parents.append(max_contr_index[level - 2])
-        i += 1
-    i = 0
-    while i < len(inputs_df_neg_g_2):
-        parents.append(max_contr_index[level - 2])
-        i += 1
-    i = 0
-    while i < len(em_df_neg_g_2):
-        parents.append(max_contr_index[level - 2])
-        i += 1
+    parents += len(current_labels) * [max_contributors[-1]]
 
     # Colors
-    for i in list(inputs_df_pos_g_2["hues"]):
-        colors.append(i)
-    for i in list(em_df_pos_g_2["hues"]):
-        colors.append(i)
-    for i in list(inputs_df_neg_g_2["hues"]):
-        colors.append(i)
-    for i in list(em_df_neg_g_2["hues"]):
-        colors.append(i)
+    for group in order:
+        colors += len(groups[group][0]) * [dp.group_hue(group)]
 
     ids = list(range(0, len(labels)))
 
     return current_labels, labels, ids, parents, values, colors
 
 
-def sort_datasets(prod_index, method_index):
+def small_max_contributor(groups, positives, negatives, threshold):
+    """
+    This function checks if the plotting can stop at this level, because there are only emissions or the maximum
+    contributors of the positive and the negative inputs are small.
+
+    Required arguments:
+    - groups: dictionary with the codes and the grouped scores of the inputs and emissions of the level
+    - positives: the sum of all the positive values up to this level, created with the sum_values function
+    - negatives: the sum of all the negative values up to this level, created with the sum_values function
+    - threshold: float, share of the maximum contributor below which it is not broken down, e.g. 0.5
+
+    Returns:
+    - bool, True if neither of the maximum contributors needs to be broken down to the next level
+    """
+    inputs_pos_g = groups["inputs_pos"][1]
+    inputs_neg_g = groups["inputs_neg"][1]
+    return ((not len(inputs_pos_g) or inputs_pos_g[0] / (positives + negatives + np.exp(-30)) < threshold) and
+            (not len(inputs_neg_g) or inputs_neg_g[0] / (positives + negatives + np.exp(-30)) < threshold))
+
+
+def sort_datasets(prod_index, method_index, max_levels=5, threshold=0.5, last_threshold=None, used_products=None):
     """
     This function sorts the datasets based on different conditions and feeds them to the required
-    list creation function.
+    list creation function. The maximum contributor is broken down level by level until it is below the threshold
+    or the maximum number of levels is reached.
 
     Required inputs:
     - prod_index: int, the index of the product to be plotted
     - method_index: int, the index of the LCIA method to be used.
         Most common methods are 222, 485 and 541 (540 for IPCC in consequential).
 
+    Optional inputs:
+    - max_levels: int, the maximum number of levels plotted. Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down to the next level.
+        Default is 0.5.
+    - last_threshold: float, share of the maximum contributor on the last level above which the plot is marked
+        as too deep (level max_levels + 1). Default is threshold + 0.1 (at most 1).
+    - used_products: list, if given, the indices of the products broken down at the next levels are appended to it
+        (see treemap_fingerprint). Default is None.
+
     Returns:
     - five lists that are required for plotting this specific dataset. The list names are: labels, ids,
     parents, values, colors
-    - level: int, the level at which plotting takes place (between 1-6)
+    - level: int, the level at which plotting takes place (between 1 and max_levels + 1)
     - score: float, the LCIA score of the product
     - plot_type: string, refers to the last level of plotting, can be either "pos" for positive,
     "neg" for negative or "zero" for datasets which have no inputs / emissions or where all of them evaluate to zero.
-    - labels_5: list of strings, the labels used for the fifth/sixth level of plotting (if it applies,
+    - last_labels: list of strings, the labels used for the last level of plotting (if it applies,
     else a list with one empty string).
     """
-    labels_5 = [""]
+    last_labels = [""]
     level = 1  # Level 1
+    if last_threshold is None:
+        last_threshold = min(threshold + 0.1, 1.0)
 
-    (product_info, inputs_df_pos, inputs_df_pos_g, em_df_pos, em_df_pos_g, inputs_df_neg, inputs_df_neg_g,
-     em_df_neg, em_df_neg_g) = dp.create_dfs_treemaps(prod_index, method_index)
+    product_info, arrays = dp.create_firstlevel_arrays(prod_index, method_index)
+    groups = arrays["groups"]
+    totals = arrays["totals"]
 
-    positives_1 = hf.sum_values(inputs_df_pos_g, em_df_pos_g)
-    negatives_1 = hf.sum_values(inputs_df_neg_g, em_df_neg_g)
+    positives = hf.sum_values(totals["inputs_pos"], totals["emissions_pos"])
+    negatives = hf.sum_values(totals["inputs_neg"], totals["emissions_neg"])
 
-    plot_type = hf.plot_type_definition(inputs_df_pos_g, em_df_pos_g, inputs_df_neg_g, em_df_neg_g)
-
-    if plot_type == "pos":
-        labels_1, ids, parents, values, colors, score = first_level_lists(product_info,
-                                                                          inputs_df_pos_g, em_df_pos_g,
-                                                                          inputs_df_neg_g, em_df_neg_g,
-                                                                          positives_1, negatives_1)
-        first_labels = labels_1.copy()
-
-    elif plot_type == "neg":
-        labels_1, ids, parents, values, colors, score = first_level_lists(product_info,
-                                                                          inputs_df_neg_g, em_df_neg_g,
-                                                                          inputs_df_pos_g, em_df_pos_g,
-                                                                          positives_1, negatives_1)
-        first_labels = labels_1.copy()
+    plot_type = hf.plot_type_definition(totals["inputs_pos"], totals["emissions_pos"],
+                                        totals["inputs_neg"], totals["emissions_neg"])
 
-    else:
+    # If the LCIA score is 0:
+    if plot_type == "zero":
         values = [0, 0]
-        labels_1 = ["", ""]
+        labels = ["", ""]
         ids = [0, 1]
         parents = ["", 0]
         colors = ["white", "white"]
         score = values[0]
-        first_labels = labels_1.copy()
 
-    # If the LCIA score is 0:
-    if plot_type == "zero":
+        return labels, ids, parents, values, colors, level, score, plot_type, last_labels
 
-        values = values
-        labels = labels_1
-        parents = parents
-        colors = colors
-        ids = ids
-        score = score
-
-    # If the data frame has no negative scores, only emissions or the max contributor is small:
-    elif ((inputs_df_pos_g.empty or inputs_df_pos_g["scaled_scores"][0] /
-           (positives_1 + negatives_1 + np.exp(-30)) < 0.5) and
-          (inputs_df_neg_g.empty or inputs_df_neg_g["scaled_scores"][0] /
-           (positives_1 + negatives_1 + np.exp(-30)) < 0.5)):
-
-        values = values
-        labels = labels_1
-        parents = parents
-        colors = colors
-        ids = ids
-        score = score
-
-    # If there is no exception at first level:
-    else:
-        level += 1  # Level 2
+    labels, ids, parents, values, colors, score = first_level_lists(product_info, groups, plot_order(plot_type),
+                                                                    positives, negatives)
+
+    # One entry per level with the labels of the level and the position of its max contributor
+    levels = [{"labels": labels, "max_contributor": 1}]
+
+    # Break down the max contributor until it is small or the maximum number of levels is reached
+    while not small_max_contributor(groups, positives, negatives,
+                                    last_threshold if level == max_levels else threshold):
+        level += 1
+        if level > max_levels:
+            break
 
         # Process data for plotting
-        (inputs_df_pos_2, inputs_df_pos_g_2, em_df_pos_2, em_df_pos_g_2,
-         inputs_df_neg_2, inputs_df_neg_g_2, em_df_neg_2, em_df_neg_g_2
-         ) = dp.create_nextlevel_dfs(inputs_df_pos, inputs_df_pos_g, inputs_df_neg,
-                                     inputs_df_neg_g, method_index, positives_1, negatives_1)
-
-        positives_2 = hf.sum_values(inputs_df_pos_g, em_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2)
-        negatives_2 = hf.sum_values(inputs_df_neg_g, em_df_neg_g, inputs_df_neg_g_2, em_df_neg_g_2)
-
-        plot_type = hf.plot_type_definition(inputs_df_pos_g_2, em_df_pos_g_2, inputs_df_neg_g_2, em_df_neg_g_2)
-
-        if plot_type == "pos":
-
-            (labels_2, labels, ids, parents, values, colors
-             ) = append_nextlevel_lists(inputs_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2,
-                                        inputs_df_neg_g_2, em_df_neg_g_2,
-                                        values, labels_1, parents, colors, level,
-                                        positives_1, negatives_1)
-            second_labels = labels.copy()
-
-        else:
-            (labels_2, labels, ids, parents, values, colors
-             ) = append_nextlevel_lists(inputs_df_neg_g, inputs_df_neg_g_2, em_df_neg_g_2,
-                                        inputs_df_pos_g_2, em_df_pos_g_2,
-                                        values, labels_1, parents, colors, level,
-                                        positives_1, negatives_1)
-            second_labels = labels.copy()
-
-        # If the data frame has only emissions or a small max contributor:
-        if ((inputs_df_pos_g_2.empty or inputs_df_pos_g_2["scaled_scores"][0] /
-             (positives_2 + negatives_2 + np.exp(-30)) < 0.5) and
-                (inputs_df_neg_g_2.empty or inputs_df_neg_g_2["scaled_scores"][0] /
-                 (positives_2 + negatives_2 + np.exp(-30)) < 0.5)):
-
-            values = values
-            labels = labels
-            parents = parents
-            colors = colors
-            ids = ids
-            score = score
-
-        # If there is no exception at second level:
-        else:
-            level += 1  # Level 3
-
-            # Process data for plotting
-            (inputs_df_pos_3, inputs_df_pos_g_3, em_df_pos_3, em_df_pos_g_3,
-             inputs_df_neg_3, inputs_df_neg_g_3, em_df_neg_3, em_df_neg_g_3,
-             ) = dp.create_nextlevel_dfs(inputs_df_pos_2, inputs_df_pos_g_2, inputs_df_neg_2,
-                                         inputs_df_neg_g_2, method_index, positives_2, negatives_2)
-
-            positives_3 = hf.sum_values(inputs_df_pos_g, em_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2,
-                                        inputs_df_pos_g_3, em_df_pos_g_3)
-            negatives_3 = hf.sum_values(inputs_df_neg_g, em_df_neg_g, inputs_df_neg_g_2, em_df_neg_g_2,
-                                        inputs_df_neg_g_3, em_df_neg_g_3)
-
-            plot_type = hf.plot_type_definition(inputs_df_pos_g_3, em_df_pos_g_3, inputs_df_neg_g_3, em_df_neg_g_3)
-
-            if plot_type == "pos":
-                labels_3, labels, ids, parents, values, colors = append_nextlevel_lists(inputs_df_pos_g_2,
-                                                                                        inputs_df_pos_g_3,
-                                                                                        em_df_pos_g_3,
-                                                                                        inputs_df_neg_g_3,
-                                                                                        em_df_neg_g_3,
-                                                                                        values, labels_2, parents,
-                                                                                        colors,
-                                                                                        level, positives_2, negatives_2,
-                                                                                        labels_1, first_labels)
-                third_labels = labels.copy()
-
-            else:
-                labels_3, labels, ids, parents, values, colors = append_nextlevel_lists(inputs_df_neg_g_2,
-                                                                                        inputs_df_neg_g_3,
-                                                                                        em_df_neg_g_3,
-                                                                                        inputs_df_pos_g_3,
-                                                                                        em_df_pos_g_3,
-                                                                                        values, labels_2, parents,
-                                                                                        colors,
-                                                                                        level, positives_2, negatives_2,
-                                                                                        labels_1, first_labels)
-                third_labels = labels.copy()
-
-            # If only emissions or small max contributor:
-            if ((inputs_df_pos_g_3.empty or inputs_df_pos_g_3["scaled_scores"][0] /
-                 (positives_3 + negatives_3 + np.exp(-30)) < 0.5) and
-                    (inputs_df_neg_g_3.empty or inputs_df_neg_g_3["scaled_scores"][0] /
-                     (positives_3 + negatives_3 + np.exp(-30)) < 0.5)):
-
-                values = values
-                labels = labels
-                parents = parents
-                colors = colors
-                ids = ids
-                score = score
-
-            else:
-                level += 1  # Level 4
-
-                # Process data for plotting
-                (inputs_df_pos_4, inputs_df_pos_g_4, em_df_pos_4, em_df_pos_g_4,
-                 inputs_df_neg_4, inputs_df_neg_g_4, em_df_neg_4, em_df_neg_g_4,
-                 ) = dp.create_nextlevel_dfs(inputs_df_pos_3, inputs_df_pos_g_3, inputs_df_neg_3,
-                                             inputs_df_neg_g_3, method_index, positives_3, negatives_3)
-
-                positives_4 = hf.sum_values(inputs_df_pos_g, em_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2,
-                                            inputs_df_pos_g_3, em_df_pos_g_3, inputs_df_pos_g_4, em_df_pos_g_4)
-                negatives_4 = hf.sum_values(inputs_df_neg_g, em_df_neg_g, inputs_df_neg_g_2, em_df_neg_g_2,
-                                            inputs_df_neg_g_3, em_df_neg_g_3, inputs_df_neg_g_4, em_df_neg_g_4)
-
-                plot_type = hf.plot_type_definition(inputs_df_pos_g_4, em_df_pos_g_4,
-                                                    inputs_df_neg_g_4, em_df_neg_g_4)
-
-                if plot_type == "pos":
-                    (labels_4, labels, ids, parents, values, colors
-                     ) = append_nextlevel_lists(inputs_df_pos_g_3, inputs_df_pos_g_4, em_df_pos_g_4,
-                                                inputs_df_neg_g_4, em_df_neg_g_4,
-                                                values, labels_3, parents, colors,
-                                                level, positives_3, negatives_3,
-                                                labels_1 + labels_2, first_labels, second_labels)
-
-                else:
-                    (labels_4, labels, ids, parents, values, colors
-                     ) = append_nextlevel_lists(inputs_df_neg_g_3, inputs_df_neg_g_4, em_df_neg_g_4,
-                                                inputs_df_pos_g_4, em_df_pos_g_4,
-                                                values, labels_3, parents, colors,
-                                                level, positives_3, negatives_3,
-                                                labels_1 + labels_2, first_labels, second_labels)
-
-                    # If only emissions or small max contributor:
-                if ((inputs_df_pos_g_4.empty or inputs_df_pos_g_4["scaled_scores"][0] /
-                     (positives_4 + negatives_4 + np.exp(-30)) < 0.5) and
-                        (inputs_df_neg_g_4.empty or inputs_df_neg_g_4["scaled_scores"][0] /
-                         (positives_4 + negatives_4 + np.exp(-30)) < 0.5)):
-
-                    values = values
-                    labels = labels
-                    parents = parents
-                    colors = colors
-                    ids = ids
-                    score = score
-
-                else:
-                    level += 1  # Level 5
-
-                    # Process data for plotting
-                    (inputs_df_pos_5, inputs_df_pos_g_5, em_df_pos_5, em_df_pos_g_5,
-                     inputs_df_neg_5, inputs_df_neg_g_5, em_df_neg_5, em_df_neg_g_5,
-                     ) = dp.create_nextlevel_dfs(inputs_df_pos_4, inputs_df_pos_g_4, inputs_df_neg_4,
-                                                 inputs_df_neg_g_4, method_index, positives_4, negatives_4)
-
-                    positives_5 = hf.sum_values(inputs_df_pos_g, em_df_pos_g, inputs_df_pos_g_2, em_df_pos_g_2,
-                                                inputs_df_pos_g_3, em_df_pos_g_3, inputs_df_pos_g_4, em_df_pos_g_4,
-                                                inputs_df_pos_g_5, em_df_pos_g_5)
-                    negatives_5 = hf.sum_values(inputs_df_neg_g, em_df_neg_g, inputs_df_neg_g_2, em_df_neg_g_2,
-                                                inputs_df_neg_g_3, em_df_neg_g_3, inputs_df_neg_g_4, em_df_neg_g_4,
-                                                inputs_df_neg_g_5, em_df_neg_g_5)
-
-                    plot_type = hf.plot_type_definition(inputs_df_pos_g_5, em_df_pos_g_5,
-                                                        inputs_df_neg_g_5, em_df_neg_g_5)
-
-                    if plot_type == "pos":
-                        (labels_5, labels, ids, parents, values, colors
-                         ) = append_nextlevel_lists(inputs_df_pos_g_4, inputs_df_pos_g_5, em_df_pos_g_5,
-                                                    inputs_df_neg_g_5, em_df_neg_g_5,
-                                                    values, labels_4, parents, colors, level,
-                                                    positives_4, negatives_4, labels_1 + labels_2 + labels_3,
-                                                    first_labels, second_labels, third_labels)
-
-                    else:
-                        (labels_5, labels, ids, parents, values, colors
-                         ) = append_nextlevel_lists(inputs_df_neg_g_4, inputs_df_neg_g_5, em_df_neg_g_5,
-                                                    inputs_df_pos_g_5, em_df_pos_g_5,
-                                                    values, labels_4, parents, colors, level,
-                                                    positives_4, negatives_4, labels_1 + labels_2 + labels_3,
-                                                    first_labels, second_labels, third_labels)
-
-                    # If only emissions or small max contributor:
-                    if ((inputs_df_pos_g_5.empty or inputs_df_pos_g_5["scaled_scores"][0] /
-                         (positives_5 + negatives_5 + np.exp(-30)) < 0.6) and
-                            (inputs_df_neg_g_5.empty or inputs_df_neg_g_5["scaled_scores"][0] /
-                             (positives_5 + negatives_5 + np.exp(-30)) < 0.6)):
-
-                        values = values
-                        labels = labels
-                        parents = parents
-                        colors = colors
-                        ids = ids
-                        score = score
-
-                    else:
-                        level += 1  # Level 6
-
-                        values = values
-                        labels = labels
-                        parents = parents
-                        colors = colors
-                        ids = ids
-                        score = score
-
-    return labels, ids, parents, values, colors, level, score, plot_type, labels_5
+        prev_groups = groups
+        arrays = dp.create_nextlevel_arrays(arrays, method_index, positives, negatives, threshold)
+        groups = arrays["groups"]
+        totals = arrays["totals"]
+        if used_products is not None:
+            used_products.extend(arrays["expanded"].tolist())
+
+        # Running totals: the max contributors of the previous level are replaced by the current level
+        prev_positives = positives
+        prev_negatives = negatives
+        positives = hf.sum_values(totals["inputs_pos"], totals["emissions_pos"], prev_positives,
+                                  prev_groups["inputs_pos"][1])
+        negatives = hf.sum_values(totals["inputs_neg"], totals["emissions_neg"], prev_negatives,
+                                  prev_groups["inputs_neg"][1])
+
+        plot_type = hf.plot_type_definition(totals["inputs_pos"], totals["emissions_pos"],
+                                            totals["inputs_neg"], totals["emissions_neg"])
+        order = plot_order(plot_type)
+
+        current_labels, labels, ids, parents, values, colors = append_nextlevel_lists(
+            prev_groups[order[0]][1], groups, totals, order, values, levels[-1]["labels"], parents, colors, level,
+            prev_positives, prev_negatives, [level_info["max_contributor"] for level_info in levels],
+            sum([level_info["labels"] for level_info in levels[:-1]], []))
+        levels.append({"labels": current_labels, "max_contributor": len(labels) - len(current_labels)})
+
+    # Labels of the last level, starting with its max contributor (the first level also contains the product)
+    if len(levels) == max_levels:
+        last_labels = labels[levels[-1]["max_contributor"]:]
+
+    return labels, ids, parents, values, colors, level, score, plot_type, last_labels
@@ -2,11 +2,20 @@ import pandas as pd
 from plotly import graph_objects as go
 import plotly.io as pio
 import os
-from xlwt import Workbook
+import csv
+import json
+import sqlite3
+import hashlib
 from datetime import date
 import time
 import math
+import copy
 from random import sample
+from functools import partial
+from multiprocessing import Pool
+from collections import deque
+from queue import Queue
+from threading import Thread, Lock
 
 import data_loading as dl
 import data_processing as dp
@@ -14,25 +23,867 @@ import helper_functions as hf
 import list_preparation as lp
 
 
-def create_barplots(system_model, prod_list, n, method_index_list, save_fig=False, show_fig=False, verbose=True):
+def start_workers(system_model, method_index_list, workers=1):
     """
-    This function creates bar plots for several products based on the lists created before
-    (create_dfs_barplots function), optionally saves them as png and/or shows them and logs the progress.
+    This function calculates the lcia scores of the methods and starts the pool of worker processes used by
+    map_products. It has to be called from the main thread before any other thread is started (e.g. the stages of
+    run_pipeline), because forking a process while other threads hold locks can leave the workers deadlocked.
+
+    Required arguments:
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - method_index_list: list of int, indices of the LCIA methods to be used
+
+    Optional arguments:
+    - workers: int, number of worker processes. Default is 1.
+
+    Returns:
+    - the pool of worker processes, or None with only one worker
+    """
+    dl.solve_methods(method_index_list)
+    if workers > 1:
+        return Pool(workers, initializer=dl.select_system_model, initargs=(system_model,))
+    return None
+
+
+def map_products(plot_product, prod_list, system_model, method_index_list, workers=1, pool=None):
+    """
+    This function applies a plotting function to all the products, either one after the other or spread across a
+    pool of worker processes. The lcia scores of the methods are calculated before the pool is started, so that the
+    workers share the loaded system model (copy-on-write after fork, or the binary cache and the memory mapped score
+    store when the workers are spawned) instead of calculating it again.
+
+    Required arguments:
+    - plot_product: function that takes a product index and returns its log row(s), e.g. barplot or treemaps with
+        all the other arguments fixed
+    - prod_list: list of int, indices of the products to be plotted
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - method_index_list: list of int, indices of the LCIA methods to be used
+
+    Optional arguments:
+    - workers: int, number of worker processes. With 1 the products are plotted in this process. Default is 1.
+    - pool: the pool of worker processes started before with start_workers, e.g. when the generator is consumed
+        in another thread. It is left open. Default is None, the pool is started and closed here.
+
+    Returns:
+    - generator of the results of plot_product, in the order of prod_list
+    """
+    if pool is None:
+        if workers > 1:
+            with start_workers(system_model, method_index_list, workers) as pool:
+                yield from map_products(plot_product, prod_list, system_model, method_index_list, workers, pool)
+            return
+        dl.solve_methods(method_index_list)
+
+    if pool is not None:
+        chunksize = max(1, len(prod_list) // (workers * 20))
+        for result in pool.imap(plot_product, prod_list, chunksize):
+            yield result
+    else:
+        for prod_index in prod_list:
+            yield plot_product(prod_index)
+
+
+# Image export
+# Pool of warm export processes, only used by the process that started it (see start_renderer)
+renderer = {"pool": None, "pid": None, "pending": deque(), "jobs": {}, "max_pending": 0, "errors": []}
+
+
+def warm_renderer():
+    """
+    This function starts the image export engine of a renderer process by exporting an empty figure, so that the
+    first real figure does not wait for the engine to start. An error of the engine is not raised here (the pool would
+    restart the process endlessly), it comes back with the result of render_figure instead.
+    """
+    try:
+        pio.to_image(go.Figure(), format="png", width=10, height=10)
+    except Exception:
+        pass
+
+
+def render_figure(fig_dict, fig_path, formats):
+    """
+    This function writes one figure to all the given image formats. It is run in the renderer processes.
+
+    Required arguments:
+    - fig_dict: dictionary of the figure, created with fig.to_dict()
+    - fig_path: string, path of the image without the file extension
+    - formats: list of strings, the image formats, e.g. ["png", "svg", "pdf"]
+
+    Returns:
+    - None if all the images are written, else a string with the path and the error message
+    """
+    try:
+        for image_format in formats:
+            pio.write_image(fig_dict, f"{fig_path}.{image_format}", format=image_format, validate=False)
+    except Exception as e:
+        return f"{fig_path}: {e}"
+    return None
+
+
+def start_renderer(render_workers=0, max_pending=None):
+    """
+    This function starts a pool of renderer processes that export the figures in the background while the next
+    figures are prepared. Without render_workers the figures are exported by export_figure directly.
+
+    Optional arguments:
+    - render_workers: int, number of renderer processes. Default is 0.
+    - max_pending: int, maximum number of figures waiting to be exported before export_figure blocks.
+        Default is 4 figures per renderer process.
+    """
+    stop_renderer()
+    if render_workers < 1:
+        return
+    renderer["pool"] = Pool(render_workers, initializer=warm_renderer)
+    renderer["pid"] = os.getpid()
+    renderer["max_pending"] = max_pending or 4 * render_workers
+
+
+def collect_export(job):
+    """
+    This function waits for one queued export and keeps its error message, if any.
+
+    Required arguments:
+    - job: dictionary with the fig_path, the result of the renderer, the error message and whether it is done,
+        queued by export_figure
+    """
+    if job["done"]:
+        return
+    try:
+        error_message = job["result"].get()
+    except Exception as e:
+        error_message = f"{job['fig_path']}: {e}"
+    job["error_message"] = error_message
+    job["done"] = True
+    if error_message is not None:
+        renderer["errors"].append(error_message)
+
+
+def export_result(fig_path, wait=True):
+    """
+    This function returns the result of the export of one figure. Figures queued to the renderer processes of this
+    process (see export_figure) may still be exported, all the other figures were exported (or failed with an
+    exception) before export_figure returned.
+
+    Required arguments:
+    - fig_path: string, path of the image, or None if the figure was not exported
+
+    Optional arguments:
+    - wait: bool, if True, the function waits for a queued export to finish. Default is True.
+
+    Returns:
+    - finished: bool, False if the figure is still being exported (only without wait)
+    - error_message: string with the path and the error of a failed export, else None
+    """
+    if fig_path is None:
+        return True, None
+    job = renderer["jobs"].get(os.path.splitext(fig_path)[0])
+    if job is None:
+        return True, None
+    if not job["done"]:
+        if not wait and not job["result"].ready():
+            return False, None
+        collect_export(job)
+    renderer["jobs"].pop(job["fig_path"], None)
+    return True, job["error_message"]
+
+
+def export_figure(fig, fig_path, formats=None):
+    """
+    This function exports a figure to all the image formats. If a renderer was started in this process, the figure is
+    queued to the renderer processes and the function only blocks while the queue is full (the result is read with
+    export_result); else the images are written before the function returns.
+
+    Required arguments:
+    - fig: plotly figure
+    - fig_path: string, path of the image, the file extension (if any) is replaced by the image formats
+
+    Optional arguments:
+    - formats: list of strings, the image formats. Default is dl.image_formats.
+    """
+    if formats is None:
+        formats = dl.image_formats
+    fig_path = os.path.splitext(fig_path)[0]
+
+    if renderer["pool"] is None or renderer["pid"] != os.getpid():
+        for image_format in formats:
+            fig.write_image(f"{fig_path}.{image_format}", format=image_format)
+        return
+
+    while len(renderer["pending"]) >= renderer["max_pending"]:
+        collect_export(renderer["pending"].popleft())
+    job = {"fig_path": fig_path, "result": renderer["pool"].apply_async(render_figure,
+                                                                         (fig.to_dict(), fig_path, list(formats))),
+           "error_message": None, "done": False}
+    renderer["jobs"][fig_path] = job
+    renderer["pending"].append(job)
+
+
+def stop_renderer():
+    """
+    This function waits for all the queued figures to be exported and shuts the renderer processes down.
+
+    Returns:
+    - errors: list of strings, the error messages of the figures that could not be exported
+    """
+    while renderer["pending"]:
+        collect_export(renderer["pending"].popleft())
+    if renderer["pool"] is not None and renderer["pid"] == os.getpid():
+        renderer["pool"].close()
+        renderer["pool"].join()
+    renderer["pool"] = None
+    renderer["pid"] = None
+    renderer["jobs"] = {}
+    errors = renderer["errors"]
+    renderer["errors"] = []
+    return errors
+
+
+# Pipeline
+# Bounded queues in front of the stages of the running pipeline, see pipeline_depths
+pipeline_queues = {}
+
+
+def pipeline_depths():
+    """
+    This function returns the number of items waiting in front of each stage of the running pipeline, e.g. to tune
+    the queue size and the concurrency of the stages. A full queue means that its stage is the bottleneck.
+
+    Returns:
+    - dictionary with the stage names as keys and the number of waiting items as values
+    """
+    return {name: queue.qsize() for name, queue in pipeline_queues.items()}
+
+
+def run_pipeline(source, stages, queue_size=8):
+    """
+    This function runs items through a sequence of stages connected by bounded queues, so that the stages work at
+    the same time (e.g. data preparation in worker processes, figure building and image export). Each stage runs in
+    its own threads; a stage blocks when the queue in front of the next stage is full.
+
+    Required arguments:
+    - source: iterable of the items to be processed, e.g. the generator of map_products (the prep stage). It is
+        consumed in a thread, so worker processes have to be started before (see start_workers).
+    - stages: list of tuples (name, function, concurrency). Each function takes the result of the previous stage,
+        concurrency is the number of threads of the stage.
+
+    Optional arguments:
+    - queue_size: int, maximum number of items waiting in front of each stage. Default is 8.
+
+    Returns:
+    - generator of the results of the last stage, in the order of source
+    """
+    queues = [Queue(queue_size) for _ in stages] + [Queue()]
+    pipeline_queues.clear()
+    pipeline_queues.update({name: queue for (name, _, _), queue in zip(stages, queues)})
+    running = [concurrency for _, _, concurrency in stages]
+    lock = Lock()
+
+    def close_stage(i):
+        # The last thread of a stage tells all the threads of the next stage to stop
+        with lock:
+            running[i] -= 1
+            last = running[i] == 0
+        if last:
+            for _ in range(stages[i + 1][2] if i + 1 < len(stages) else 1):
+                queues[i + 1].put(None)
+
+    def feed():
+        try:
+            for seq, item in enumerate(source):
+                queues[0].put((seq, item))
+        except Exception as e:
+            queues[-1].put((-1, e))
+        for _ in range(stages[0][2]):
+            queues[0].put(None)
+
+    def work(i, function):
+        while True:
+            job = queues[i].get()
+            if job is None:
+                break
+            seq, item = job
+            try:
+                queues[i + 1].put((seq, function(item)))
+            except Exception as e:
+                # Failed items skip the remaining stages and are raised in the order of source
+                queues[-1].put((seq, e))
+        close_stage(i)
+
+    threads = [Thread(target=feed, daemon=True)]
+    for i, (_, function, concurrency) in enumerate(stages):
+        threads += [Thread(target=work, args=(i, function), daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    finished = {}
+    failed = {}
+    next_seq = 0
+    while True:
+        job = queues[-1].get()
+        if job is None:
+            break
+        seq, result = job
+        if isinstance(result, Exception):
+            if seq < 0:
+                raise result
+            failed[seq] = result
+        else:
+            finished[seq] = result
+        while next_seq in finished or next_seq in failed:
+            if next_seq in failed:
+                raise failed.pop(next_seq)
+            yield finished.pop(next_seq)
+            next_seq += 1
+
+    pipeline_queues.clear()
+
+
+# Figure templates
+# Layouts and trace styles that are the same for many figures, see figure_template
+figure_templates = {}
+
+
+def figure_template(key, create_template):
+    """
+    This function returns a copy of the template of a kind of figure, e.g. the layout of the treemaps with a
+    specific set of annotations. The template is created only once per key, so that the figures only need to be
+    patched with the data of the dataset. The template itself is a plain dictionary: each figure is still fully
+    validated by plotly when it is created with go.Figure.
+
+    Required arguments:
+    - key: tuple, identifies the kind of figure, e.g. ("treemap", "normal") or ("barplot", "bars", method names)
+    - create_template: function without arguments that creates the template (a dictionary) if it is not cached
+
+    Returns:
+    - a deep copy of the template, which can be changed without changing the cached template
+    """
+    if key not in figure_templates:
+        figure_templates[key] = create_template()
+    return copy.deepcopy(figure_templates[key])
+
+
+# Logging
+def log_value(value):
+    """
+    This function converts a logged value to a python type that can be written to any of the log formats
+    (e.g. numpy integers to int).
+    """
+    return value.item() if hasattr(value, "item") else value
+
+
+def open_log(name, columns, log_format=None):
+    """
+    This function opens an append-only log in the logs folder. Every row is written to disk as soon as it is logged,
+    so that the log of an interrupted run is kept and there is no limit on the number of rows.
+
+    Required arguments:
+    - name: string, the beginning of the file name, e.g. "treemaps_cutoff"
+    - columns: list of strings, the names of the logged data points. A first column "number" is added.
+
+    Optional arguments:
+    - log_format: string, one of "csv", "jsonl", "sqlite". Default is dl.log_format.
+
+    Returns:
+    - log: dictionary with the path, the format, the columns, the open file or database connection and the number
+        of rows, used by write_log_row and close_log
+    """
+    if log_format is None:
+        log_format = dl.log_format
+    if log_format not in ["csv", "jsonl", "sqlite"]:
+        raise ValueError(f"'{log_format}' is not a valid log format, use one of 'csv', 'jsonl', 'sqlite'.")
+    os.makedirs("../logs", exist_ok=True)
+
+    log = {"path": f"../logs/{name}_{date.today().strftime('%d-%m-%Y')}_\
+{time.strftime('%H:%M:%S', time.localtime())}.{log_format}",
+           "format": log_format, "columns": ["number"] + list(columns), "rows": 0}
+    if log_format == "sqlite":
+        log["connection"] = sqlite3.connect(log["path"])
+        log["connection"].execute("PRAGMA journal_mode=WAL")
+        log["connection"].execute(f"CREATE TABLE log ({', '.join(log['columns'])})")
+        log["connection"].commit()
+    else:
+        log["file"] = open(log["path"], "w", newline="")
+        if log_format == "csv":
+            log["writer"] = csv.writer(log["file"])
+            log["writer"].writerow(log["columns"])
+            log["file"].flush()
+
+    return log
+
+
+def write_log_row(log, log_row):
+    """
+    This function appends one row to a log opened with the open_log function and writes it to disk.
+
+    Required arguments:
+    - log: dictionary, created with the open_log function
+    - log_row: list of the logged data points, in the order of the columns of the log
+    """
+    log["rows"] += 1
+    row = [log["rows"]] + [log_value(value) for value in log_row]
+    if log["format"] == "sqlite":
+        log["connection"].execute(f"INSERT INTO log VALUES ({', '.join('?' * len(row))})", row)
+        log["connection"].commit()
+    else:
+        if log["format"] == "csv":
+            log["writer"].writerow(row)
+        else:
+            log["file"].write(json.dumps(dict(zip(log["columns"], row)), default=str) + "\n")
+        log["file"].flush()
+
+
+def finish_rows(log, pending_rows, wait=False):
+    """
+    This function writes the log rows of the figures whose export is finished, in the order they were plotted.
+    The result of the export is handed to the on_done function of the row first, which writes a failed export to
+    the log row or records the item in the manifest.
+
+    Required arguments:
+    - log: dictionary, created with the open_log function
+    - pending_rows: deque of tuples (log_row, fig_path, on_done), fig_path is None if the figure was not exported
+        and on_done is called with the log row and the error message of the export (None if it was exported)
+
+    Optional arguments:
+    - wait: bool, if True, all the rows are written, waiting for their exports. Default is False.
+    """
+    while pending_rows:
+        log_row, fig_path, on_done = pending_rows[0]
+        finished, error_message = export_result(fig_path, wait)
+        if not finished:
+            break
+        pending_rows.popleft()
+        on_done(log_row, error_message)
+        write_log_row(log, log_row)
+
+
+def read_log(path):
+    """
+    This function reads a log written with the write_log_row function, in any of the log formats.
+
+    Required arguments:
+    - path: string, path of the log
+
+    Returns:
+    - pandas DataFrame with one row per logged row
+    """
+    if path.endswith(".sqlite"):
+        with sqlite3.connect(path) as connection:
+            return pd.read_sql("SELECT * FROM log", connection)
+    if path.endswith(".jsonl"):
+        return pd.read_json(path, lines=True)
+    return pd.read_csv(path)
+
+
+def close_log(log, export_xlsx=False):
+    """
+    This function closes a log opened with the open_log function and optionally exports it to excel.
+
+    Required arguments:
+    - log: dictionary, created with the open_log function
+
+    Optional arguments:
+    - export_xlsx: bool, if True, the log is also saved as xlsx file next to it (requires openpyxl).
+        Default is False.
+
+    Returns:
+    - path: string, path of the log
+    """
+    if log["format"] == "sqlite":
+        log["connection"].close()
+    else:
+        log["file"].close()
+    if export_xlsx:
+        read_log(log["path"]).to_excel(os.path.splitext(log["path"])[0] + ".xlsx", index=False)
+
+    return log["path"]
+
+
+# Checkpoints
+# Serializes the writes of several export threads to the manifest, see record_item
+manifest_lock = Lock()
+
+
+def open_manifest(path=None):
+    """
+    This function opens the manifest of the plotted items, a sqlite database with one row per
+    (system_model, kind, prod_index, method) that is committed as soon as the item is plotted, so that it survives
+    interrupted runs. For treemaps, the products broken down at the next levels are stored as well (used_products),
+    so that the fingerprint can be checked again without preparing the data (see pending_treemaps).
+
+    Optional arguments:
+    - path: string, path of the manifest. Default is dl.manifest_path.
+
+    Returns:
+    - manifest: sqlite3 connection to the manifest
+    """
+    if path is None:
+        path = dl.manifest_path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    manifest = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    manifest.execute("PRAGMA journal_mode=WAL")
+    manifest.execute("CREATE TABLE IF NOT EXISTS items (system_model, kind, prod_index, method, input_hash, time, "
+                     "used_products, PRIMARY KEY (system_model, kind, prod_index, method))")
+    # Manifests written before used_products was stored
+    if "used_products" not in [column[1] for column in manifest.execute("PRAGMA table_info(items)")]:
+        manifest.execute("ALTER TABLE items ADD COLUMN used_products")
+    manifest.commit()
+    return manifest
+
+
+def input_hash(kind, prod_index, method, settings, fingerprint):
+    """
+    This function calculates the hash of everything one plotted item depends on: the item, the settings of the plot
+    and the fingerprint of the data (see dp.barplot_fingerprint, dp.treemap_fingerprint). As the fingerprint only
+    covers the data used by the plot, the hash stays the same between releases unless the plot can change.
+
+    Required arguments:
+    - kind: string, "barplot" or "treemap"
+    - prod_index: int, index of the product
+    - method: int or string, the method of a treemap or the list of methods of a bar plot
+    - settings: dictionary of the settings the plot depends on, e.g. max_levels and the image formats
+    - fingerprint: string, the fingerprint of the data of the plot
+
+    Returns:
+    - string, sha256 hex digest
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps([kind, int(prod_index), str(method), settings, fingerprint], sort_keys=True,
+                          default=str).encode())
+    return sha.hexdigest()
+
+
+def record_item(manifest, system_model, kind, prod_index, method, item_hash, used_products=None):
+    """
+    This function records one plotted item in the manifest.
+
+    Required arguments:
+    - manifest: sqlite3 connection, created with the open_manifest function
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - kind: string, "barplot" or "treemap"
+    - prod_index: int, index of the product
+    - method: int or string, the method of a treemap or the list of methods of a bar plot
+    - item_hash: string, created with the input_hash function
+
+    Optional arguments:
+    - used_products: list of int, the products broken down in a treemap (see dp.treemap_fingerprint).
+        Default is None.
+    """
+    if used_products is not None:
+        used_products = json.dumps([int(prod) for prod in used_products])
+    with manifest_lock:
+        manifest.execute("INSERT OR REPLACE INTO items (system_model, kind, prod_index, method, input_hash, time, "
+                         "used_products) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (system_model, kind, int(prod_index), str(method), item_hash,
+                          time.strftime("%d-%m-%Y %H:%M:%S", time.localtime()), used_products))
+        manifest.commit()
+
+
+def completed_items(manifest, system_model, kind):
+    """
+    This function reads the items of one system model and kind of plot from the manifest.
+
+    Required arguments:
+    - manifest: sqlite3 connection, created with the open_manifest function
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - kind: string, "barplot" or "treemap"
+
+    Returns:
+    - dictionary with (prod_index, method) as keys and the input hash as values
+    """
+    rows = manifest.execute("SELECT prod_index, method, input_hash FROM items WHERE system_model = ? AND kind = ?",
+                            (system_model, kind))
+    return {(prod_index, method): item_hash for prod_index, method, item_hash in rows}
+
+
+def images_exist(fig_path):
+    """
+    This function checks if a figure was exported to all the image formats (see dl.image_formats).
+
+    Required arguments:
+    - fig_path: string, path of the image, the file extension (if any) is replaced by the image formats
+    """
+    fig_path = os.path.splitext(fig_path)[0]
+    return all(os.path.exists(f"{fig_path}.{image_format}") for image_format in dl.image_formats)
+
+
+def unchanged_item(done, prod_index, method, item_hash, fig_path):
+    """
+    This function checks if an item was plotted before with the same input hash and all its images exist, so that
+    it does not need to be plotted again.
+
+    Required arguments:
+    - done: dictionary, created with the completed_items function
+    - prod_index: int, index of the product
+    - method: int or string, the method of a treemap or the list of methods of a bar plot
+    - item_hash: string, created with the input_hash function
+    - fig_path: string, path of the image
+    """
+    return done.get((int(prod_index), str(method))) == item_hash and images_exist(fig_path)
+
+
+def barplot_hash(prod_index, method_index_list, settings):
+    """
+    This function calculates the input hash of the bar plot of one product (see input_hash).
+    """
+    return input_hash("barplot", prod_index, method_index_list, settings,
+                      dp.barplot_fingerprint(prod_index, method_index_list))
+
+
+def pending_barplots(manifest, system_model, prod_list, method_index_list, settings):
+    """
+    This function selects the products whose bar plots need to be plotted, either because an interrupted run is
+    resumed or because only the bar plots that changed since the last release are plotted again.
+
+    Required arguments:
+    - manifest: sqlite3 connection, created with the open_manifest function
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - prod_list: list of int, indices of the products to be plotted
+    - method_index_list: list of int, indices of the LCIA methods
+    - settings: dictionary of the settings the plots depend on (see input_hash)
+
+    Returns:
+    - list of int, the products of prod_list that need to be plotted
+    """
+    done = completed_items(manifest, system_model, "barplot")
+    return [prod_index for prod_index in prod_list
+            if not unchanged_item(done, prod_index, method_index_list,
+                                  barplot_hash(prod_index, method_index_list, settings),
+                                  f"../plots/{barplot_name(system_model, prod_index, method_index_list)}")]
+
+
+def pending_treemaps(manifest, system_model, prod_list, method_index_list, settings):
+    """
+    This function selects the products with at least one treemap that needs to be plotted. The fingerprints of the
+    treemaps in the manifest are calculated again from the stored used_products, so that the unchanged products are
+    skipped before their data is prepared.
+
+    Required arguments:
+    - manifest: sqlite3 connection, created with the open_manifest function
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - prod_list: list of int, indices of the products to be plotted
+    - method_index_list: list of int, indices of the LCIA methods
+    - settings: dictionary of the settings the treemaps depend on (see input_hash)
+
+    Returns:
+    - list of int, the products of prod_list that need to be plotted
+    """
+    rows = manifest.execute("SELECT prod_index, method, input_hash, used_products FROM items "
+                            "WHERE system_model = ? AND kind = 'treemap' AND used_products IS NOT NULL",
+                            (system_model,))
+    done = {(prod_index, method): (item_hash, json.loads(used_products))
+            for prod_index, method, item_hash, used_products in rows}
+
+    def unchanged_treemap(prod_index, method_index):
+        if (int(prod_index), str(method_index)) not in done:
+            return False
+        item_hash, used_products = done[(int(prod_index), str(method_index))]
+        fingerprint = dp.treemap_fingerprint(prod_index, method_index, used_products)
+        return (input_hash("treemap", prod_index, method_index, settings, fingerprint) == item_hash and
+                images_exist(treemap_path(system_model, prod_index, method_index)))
+
+    return [prod_index for prod_index in prod_list
+            if not all(unchanged_treemap(prod_index, method_index) for method_index in method_index_list)]
+
+
+# Scheduling
+def schedule_products(prod_list, method_index_list, max_levels=5, threshold=0.5):
+    """
+    This function orders the products by their estimated cost (see dp.product_costs), the most expensive first, so
+    that the worker processes do not end the run waiting for a few slow datasets that were started last.
+
+    Required arguments:
+    - prod_list: list of int, indices of the products to be plotted
+    - method_index_list: list of int, indices of the LCIA methods
+
+    Optional arguments:
+    - max_levels: int, maximum number of levels of the treemaps. Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down. Default is 0.5.
+
+    Returns:
+    - list of int, the products of prod_list ordered by decreasing cost, ties in the order of prod_list
+    """
+    costs = dp.product_costs(prod_list, method_index_list, max_levels, threshold)
+    return [prod_list[position] for position in sorted(range(len(prod_list)), key=lambda i: (-costs[i], i))]
+
+
+# Sharding
+def partition_products(prod_list, costs, shard_count):
+    """
+    This function splits the products into shards with about the same total cost. The products are assigned from
+    the most to the least expensive, each to the shard with the lowest total cost so far. The result only depends on
+    the products and their costs, so that independent processes or machines compute the same partition as long as
+    the costs are integers (see dp.structure_costs).
+
+    Required arguments:
+    - prod_list: list of int, indices of the products
+    - costs: list of int, estimated cost of each product, e.g. from dp.structure_costs
+    - shard_count: int, number of shards
+
+    Returns:
+    - shards: list with one list of product indices per shard, each in the order of prod_list
+    """
+    shard_totals = [0] * shard_count
+    shard_positions = [[] for _ in range(shard_count)]
+    # Most expensive first, ties in the order of prod_list
+    for position in sorted(range(len(prod_list)), key=lambda i: (-costs[i], i)):
+        shard = shard_totals.index(min(shard_totals))
+        shard_totals[shard] += costs[position]
+        shard_positions[shard].append(position)
+
+    return [[prod_list[position] for position in sorted(positions)] for positions in shard_positions]
+
+
+def check_shard(shard_index, shard_count):
+    """
+    This function checks that a shard is selected with both of its arguments and that it exists.
+
+    Required arguments:
+    - shard_index: int, the shard of this process, from 0 to shard_count - 1
+    - shard_count: int, number of shards
+    """
+    if shard_index is None or shard_count is None:
+        raise ValueError("shard_index and shard_count must be given together.")
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"shard_index must be between 0 and shard_count - 1, got {shard_index} of {shard_count}.")
+
+
+def shard_products(prod_list, shard_index, shard_count):
+    """
+    This function selects the products of one shard, see partition_products and dp.structure_costs. The costs only
+    depend on the structure of the matrices, so that every shard computes the same partition.
+
+    Required arguments:
+    - prod_list: list of int, indices of all the products to be plotted
+    - shard_index: int, the shard of this process, from 0 to shard_count - 1
+    - shard_count: int, number of shards
+
+    Returns:
+    - list of int, indices of the products of the shard
+    """
+    check_shard(shard_index, shard_count)
+    costs = dp.structure_costs(prod_list)
+    return partition_products(list(prod_list), costs.tolist(), shard_count)[shard_index]
+
+
+def write_work_lists(prod_list, shard_count, name):
+    """
+    This function writes the products of each shard to a work-list file in the logs folder, one product index per
+    line, e.g. to hand the shards to different machines (see read_work_list).
+
+    Required arguments:
+    - prod_list: list of int, indices of all the products to be plotted
+    - shard_count: int, number of shards
+    - name: string, the beginning of the file names, e.g. "cutoff"
+
+    Returns:
+    - paths: list of strings, the paths of the work lists
+    """
+    os.makedirs("../logs", exist_ok=True)
+    costs = dp.structure_costs(prod_list)
+    paths = []
+    for shard_index, shard in enumerate(partition_products(list(prod_list), costs.tolist(), shard_count)):
+        paths.append(f"../logs/{name}_shard{shard_index}of{shard_count}.txt")
+        with open(paths[-1], "w") as work_list:
+            work_list.writelines(f"{int(prod_index)}\n" for prod_index in shard)
+    return paths
+
+
+def read_work_list(path):
+    """
+    This function reads a work-list file with one product index per line. Empty lines and lines starting with '#'
+    are ignored.
+
+    Required arguments:
+    - path: string, path of the work list
+
+    Returns:
+    - list of int, indices of the products
+    """
+    with open(path) as work_list:
+        return [int(line) for line in (line.strip() for line in work_list) if line and not line.startswith("#")]
+
+
+def merge_logs(paths, path):
+    """
+    This function combines the logs of several shards into one log, numbered again from 1 in the order of the
+    products. The format of the combined log is taken from the file extension ("csv", "jsonl" or "sqlite").
+
+    Required arguments:
+    - paths: list of strings, paths of the logs of the shards (see read_log)
+    - path: string, path of the combined log
+
+    Returns:
+    - merged: pandas DataFrame with the combined log
+    """
+    merged = pd.concat([read_log(log_path) for log_path in paths], ignore_index=True)
+    sort_columns = [column for column in ["prod_index", "method_index", "number"] if column in merged.columns]
+    merged = merged.sort_values(sort_columns, kind="mergesort").reset_index(drop=True)
+    merged["number"] = range(1, len(merged) + 1)
+
+    if path.endswith(".sqlite"):
+        with sqlite3.connect(path) as connection:
+            merged.to_sql("log", connection, if_exists="replace", index=False)
+    elif path.endswith(".jsonl"):
+        merged.to_json(path, orient="records", lines=True)
+    else:
+        merged.to_csv(path, index=False)
+
+    return merged
+
+
+def merge_manifests(paths, path=None):
+    """
+    This function adds the items of the manifests of several shards to one manifest, so that a later run can be
+    resumed from the work of all the shards.
+
+    Required arguments:
+    - paths: list of strings, paths of the manifests of the shards
+
+    Optional arguments:
+    - path: string, path of the combined manifest. Default is dl.manifest_path.
+    """
+    manifest = open_manifest(path)
+    for shard_path in paths:
+        with sqlite3.connect(shard_path) as shard_manifest:
+            shard_columns = [column[1] for column in shard_manifest.execute("PRAGMA table_info(items)")]
+            rows = shard_manifest.execute("SELECT system_model, kind, prod_index, method, input_hash, time, " +
+                                          ("used_products" if "used_products" in shard_columns else "NULL") +
+                                          " FROM items").fetchall()
+        manifest.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        manifest.commit()
+    manifest.close()
+
+
+def barplot_name(system_model, prod_index, method_index_list):
+    """
+    This function returns the file name of the bar plot of one product.
+    """
+    return f"barplot_s{system_model}_p{prod_index}_m{method_index_list}.png"
+
+
+def barplot(system_model, prod_index, n, method_index_list, save_fig=False, show_fig=False, data=None):
+    """
+    This function creates the bar plot for one product based on the data created with the create_dfs_barplots
+    function and optionally saves it as png and/or shows it.
 
     Required arguments:
     - system_model: string, the name of the system model to be used.
         Possible options are: "cutoff", "apos", "consequential"
-    - prod_list: list of int, list of indices of the product to plot from the ie_index matrix, e.g. 12759
+    - prod_index: int, index of the product to plot from the ie_index matrix, e.g. 12759
+    - n: int, determines after how many words the method names are split into lines
     - method_index_list: list of int, list of indices of the LCIA method from the LCIA_index matrix
         The most common ones are: [222, 485, 541] (or 540 in consequential).
 
     Optional arguments:
-    - save_fig: bool, if True, figures are saved to the defined folder. Default is True.
-    - show_fig: bool, if True, figures are shown in a separate browser window. Default is False.
+    - save_fig: bool, if True, the figure is saved to the defined folder. Default is False.
+    - show_fig: bool, if True, the figure is shown in a separate browser window. Default is False.
+    - data: tuple, the result of create_dfs_barplots for this product if it was calculated before, e.g. with
+        dp.barplot_dfs (see barplot_batch). Default is None, the data is created here.
 
     Returns:
-    - figures that can be shown in a browser window, saved to a folder or both.
-    - an excel file which logs the progress of the plotting
+    - log_row: list with the data points logged for this product (prod_index, method_index_list, system_model,
+        plot_type_1, plot_type_2, fig_name, time, title_name, error_message). The error_message of a figure that is
+        exported in the background is set once the export is finished (see create_barplots).
     """
     # Settings for plot size, annotation locations:
     font_type = dl.font_type
@@ -56,353 +907,774 @@ def create_barplots(system_model, prod_list, n, method_index_list, save_fig=Fals
     y_space1 = -0.22
     y_space2 = -0.31
 
-    # Set up the logging / plots folder
-    if not os.path.exists("../logs"):
-        os.mkdir("../logs")
-    if not os.path.exists("../plots"):
-        os.mkdir("../plots")
-    # Set up logging
-    it = 1
-    start_time = time.time()
-    today = date.today()
-
-    wb = Workbook()
-    sheet1 = wb.add_sheet('Sheet 1')
-    sheet1.write(0, 0, "number")
-    sheet1.write(0, 1, "prod_index")
-    sheet1.write(0, 2, "method_index_list")
-    sheet1.write(0, 3, "system_model")
-    sheet1.write(0, 4, "plot_type_1")
-    sheet1.write(0, 5, "plot_type_2")
-    sheet1.write(0, 6, "fig_name")
-    sheet1.write(0, 7, "time")
-    sheet1.write(0, 8, "title_name")
-
-    # Import DF per product index:
-    for prod_index in prod_list:
-        grouped_sorted, chart_type_1, chart_type_2 = dp.create_dfs_barplots(prod_index, method_index_list)
-        fig_name = f"barplot_s{system_model}_p{prod_index}_m{method_index_list}.png"
-
-        # split title into 1,2,3 lines depending on the total length
-        ie_index = dl.ie_index
-        title_simple = ["Main impact sources by method for '" + str(
-            ie_index.iloc[grouped_sorted["ref_prod"][0]]['activityName']) + " (" + str(
-            ie_index.iloc[grouped_sorted["ref_prod"][0]]['geography']) + ")'"]
-        title_len = len(title_simple[0].split(' '))
-        title_split2 = hf.split_method_name(title_len // 2, title_simple)
-        title_split3 = hf.split_method_name(title_len // 3, title_simple)
-        if title_len > 12:
-            title_name = "<b>" + title_split3[0] + "</b>"
-            title_height = 0.95
-        elif title_len > 4:
-            title_name = "<b>" + title_split2[0] + "</b>"
-            title_height = 0.93
+    if data is None:
+        data = dp.create_dfs_barplots(prod_index, method_index_list)
+    grouped_sorted, chart_type_1, chart_type_2 = data
+    fig_name = barplot_name(system_model, prod_index, method_index_list)
+
+    # split title into 1,2,3 lines depending on the total length
+    ie_index = dl.ie_index
+    title_simple = ["Main impact sources by method for '" + str(
+        ie_index.iloc[grouped_sorted["ref_prod"][0]]['activityName']) + " (" + str(
+        ie_index.iloc[grouped_sorted["ref_prod"][0]]['geography']) + ")'"]
+    title_len = len(title_simple[0].split(' '))
+    title_split2 = hf.split_method_name(title_len // 2, title_simple)
+    title_split3 = hf.split_method_name(title_len // 3, title_simple)
+    if title_len > 12:
+        title_name = "<b>" + title_split3[0] + "</b>"
+        title_height = 0.95
+    elif title_len > 4:
+        title_name = "<b>" + title_split2[0] + "</b>"
+        title_height = 0.93
+    else:
+        title_name = "<b>" + title_simple[0] + "</b>"
+        title_height = 0.93
+
+    # Create y_data arrays, split method name after n_words
+    method_names = dl.LCIA_index['method_long'].values
+    create_y_data_array = []
+    for meth in method_index_list:
+        create_y_data = method_names[meth]
+        create_y_data_array.append(create_y_data)
+    y_data_w_breaks = hf.split_method_name(n, create_y_data_array)
+    y_data = y_data_w_breaks
+
+    def create_template(kind):
+        # Layout and method labels shared by all the bar plots of the same kind with the same methods
+        layout = dict(
+            xaxis=dict(showgrid=False, showline=True, showticklabels=False, zeroline=False, domain=[0.15, 1]),
+            yaxis=dict(visible=True, showgrid=False, showline=True, showticklabels=False, zeroline=True),
+            autosize=False, width=f_width, height=f_height, barmode='relative', paper_bgcolor=white_orig,
+            plot_bgcolor=white_orig, margin=dict(l=margin_l, r=margin_r, t=margin_t, b=margin_b),
+            showlegend=False,
+            title={'x': 0.5, 'xanchor': 'center', 'yanchor': 'top',
+                   'font': dict(family=font_type, size=t_size, color=black_orig)})
+        if kind == "bars":
+            # Add vertical line (axis) to separate positive and negative values
+            layout["shapes"] = [{"type": "line", "xref": "x", "yref": "paper",
+                                 "x0": 0, "y0": 0, "x1": 0, "y1": 1,
+                                 "line": dict(color=grey3_orig, width=3, )}]
+        y_labels = [dict(xref='paper', yref='y', x=0.14, y=yd,
+                         xanchor='right', text=str(yd),
+                         font=dict(family=font_type, size=y_size, color=black_orig),
+                         showarrow=False, align='right') for yd in y_data]
+        return {"layout": layout, "y_labels": y_labels}
+
+    # Check for empty, semi-empty and zero score data sets and logs them:
+    list_of_sums = []
+    for meth in method_index_list:
+        list_of_sums.append(grouped_sorted[str(meth) + '_impact_abs'].sum())
+    if all(list_of_sums) == 0:
+        list_of_sums_fil = len([sum_meth for sum_meth in list_of_sums if sum_meth == 0])
+        if len(list_of_sums) > 1:
+            if not len([sum_meth for sum_meth in list_of_sums if sum_meth == 0]) & list_of_sums_fil > 2:
+                chart_type_1 = '3 - semi-empty'
+            else:
+                if math.isnan(grouped_sorted.row[0]):
+                    chart_type_1 = '5 - no data'
+                else:
+                    chart_type_1 = '4 - zero score'
         else:
-            title_name = "<b>" + title_simple[0] + "</b>"
-            title_height = 0.93
+            chart_type_1 = 'check'
+
+    # For empty data sets, plot empty plot
+    if math.isnan(grouped_sorted.row[0]) | any(list_of_sums) == 0:
+        template = figure_template(("barplot", "empty", tuple(y_data)), partial(create_template, "empty"))
+        layout = template["layout"]
+        layout["title"].update({'text': title_name, 'y': title_height})
+        annotations = []
+        annotations.append({'y': 0.5, 'x': 0.9, 'xref': 'paper', 'yref': 'paper',
+                            "text": '<i>This product has no impact scores</i>', "width": 250, "showarrow": False,
+                            "font": {"family": font_type, "size": 14, "color": black_orig}})
+        annotations += template["y_labels"]
+        layout["annotations"] = annotations
+        fig = go.Figure(data=[{"type": "bar", "y": [yd], "orientation": 'h'} for yd in y_data], layout=layout)
+
+        # Save plot as png if selected
+        if save_fig:
+            export_figure(fig, f"../plots/" + str(fig_name))
+
+        # Show plot in browser if selected
+        if show_fig:
+            pio.renderers.default = 'browser'
+            fig.show()
+        else:
+            pass
 
-        # Create y_data arrays, split method name after n_words
-        lcia_df = dl.lcia_df
-        create_y_data_array = []
-        for meth in method_index_list:
-            create_y_data = lcia_df.iloc[:, meth].name
-            create_y_data_array.append(create_y_data)
-        y_data_w_breaks = hf.split_method_name(n, create_y_data_array)
-        y_data = y_data_w_breaks
+    # Plot bar chart for normal, rescaled, semi-empty data sets:
+    else:
+        # List 'flow compartments', needed for annotations later
+        top_label_list = []
+        [top_label_list.append(cat) for cat in grouped_sorted['impact_cat'].values]
 
-        # Check for empty, semi-empty and zero score data sets and logs them:
-        list_of_sums = []
+        # Chose color scale for the 'flow compartments'
+        hues_barplots = hues_barplots
+
+        # Import x_data form DF from create_dfs_barplots function and round data
+        create_x_data_array = []
         for meth in method_index_list:
-            list_of_sums.append(grouped_sorted[str(meth) + '_impact_abs'].sum())
-        if all(list_of_sums) == 0:
-            list_of_sums_fil = len([sum_meth for sum_meth in list_of_sums if sum_meth == 0])
-            if len(list_of_sums) > 1:
-                if not len([sum_meth for sum_meth in list_of_sums if sum_meth == 0]) & list_of_sums_fil > 2:
-                    chart_type_1 = '3 - semi-empty'
-                else:
-                    if math.isnan(grouped_sorted.row[0]):
-                        chart_type_1 = '5 - no data'
-                    else:
-                        chart_type_1 = '4 - zero score'
-            else:
-                chart_type_1 = 'check'
-
-        # For empty data sets, plot empty plot
-        if math.isnan(grouped_sorted.row[0]) | any(list_of_sums) == 0:
-            fig = go.Figure()
-            fig.update_layout(
-                xaxis=dict(showgrid=False, showline=True, showticklabels=False, zeroline=False, domain=[0.15, 1]),
-                yaxis=dict(visible=True, showgrid=False, showline=True, showticklabels=False, zeroline=True, ),
-                autosize=False, width=f_width, height=f_height, barmode='relative', paper_bgcolor=white_orig,
-                plot_bgcolor=white_orig, margin=dict(l=margin_l, r=margin_r, t=margin_t, b=margin_b),
-                showlegend=False,
-                title={'text': title_name,
-                       'y': title_height, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top',
-                       'font': dict(family=font_type, size=t_size, color=black_orig)})
-            annotations = []
-            annotations.append({'y': 0.5, 'x': 0.9, 'xref': 'paper', 'yref': 'paper',
-                                "text": '<i>This product has no impact scores</i>', "width": 250, "showarrow": False,
-                                "font": {"family": font_type, "size": 14, "color": black_orig}})
-            for yd in y_data:
-                fig.add_trace(go.Bar(y=[yd], orientation='h'))
-                annotations.append(dict(xref='paper', yref='y', x=0.14, y=yd,
-                                        xanchor='right', text=str(yd),
+            create_x_data = grouped_sorted[str(meth) + '_scaled'].tolist()
+            create_x_data_round = [int(val) for val in create_x_data]
+            create_x_data_array.append(create_x_data_round)
+        x_data = create_x_data_array
+
+        # Traces of the figure, one per method and 'flow compartment'
+        traces = []
+        for i in range(0, len(x_data[0])):
+            for xd, yd in zip(x_data, y_data):
+                traces.append({"type": "bar", "x": [xd[i]], "y": [yd], "orientation": 'h', "width": 0.8,
+                               "marker": dict(color=hues_barplots[i], line=dict(color=hues_barplots[i], width=0.5))})
+        template = figure_template(("barplot", "bars", tuple(y_data)), partial(create_template, "bars"))
+        layout = template["layout"]
+        layout["title"].update({'text': title_name, 'y': title_height})
+
+        # Add labels and %-values
+        annotations = []
+        for ix_l, (yd, xd) in enumerate(zip(y_data, x_data)):
+            # Labeling the y-axis
+            annotations.append(template["y_labels"][ix_l])
+
+            # Comment annotation for 'semi-empty' plots: (x=0.14 for overlapping h-line, otherwise x=0.18)
+            if list_of_sums[ix_l] == 0:
+                annotations.append(dict(xref='paper', yref='y', x=0.18, y=yd, bgcolor=white_orig,
+                                        width=300, height=80,
+                                        text="<i>no impacts based on this method</i>",
                                         font=dict(family=font_type, size=y_size, color=black_orig),
-                                        showarrow=False, align='right'))
-            fig.update_layout(annotations=annotations)
-
-            # Save plot as png if selected
-            if save_fig:
-                fig.write_image(f"../plots/" + str(fig_name))
-
-            # Collect data points required for logging
-            sheet1.write(it, 0, it)
-            sheet1.write(it, 1, int(prod_index))
-            sheet1.write(it, 2, str(method_index_list))
-            sheet1.write(it, 3, system_model)
-            sheet1.write(it, 4, chart_type_1)
-            sheet1.write(it, 5, chart_type_2)
-            sheet1.write(it, 6, fig_name)
-            sheet1.write(it, 7, time.strftime('%H:%M:%S', time.localtime()))
-            sheet1.write(it, 8, title_name)
-            if verbose:
-                if it % 500 == 0:
-                    print(f"{it} barplots done")
-            it += 1
-
-            # Show plot in browser if selected
-            if show_fig:
-                pio.renderers.default = 'browser'
-                fig.show()
+                                        showarrow=False, align='center'))
             else:
                 pass
 
-        # Plot bar chart for normal, rescaled, semi-empty data sets:
-        else:
-            # List 'flow compartments', needed for annotations later
-            top_label_list = []
-            [top_label_list.append(cat) for cat in grouped_sorted['impact_cat'].values]
-
-            # Chose color scale for the 'flow compartments'
-            hues_barplots = hues_barplots
-
-            # Import x_data form DF from create_dfs_barplots function and round data
-            create_x_data_array = []
-            for meth in method_index_list:
-                create_x_data = grouped_sorted[str(meth) + '_scaled'].tolist()
-                create_x_data_round = [int(val) for val in create_x_data]
-                create_x_data_array.append(create_x_data_round)
-            x_data = create_x_data_array
-
-            # Create and format figure, adding one trace per method
-            fig = go.Figure()
-            for i in range(0, len(x_data[0])):
-                for xd, yd in zip(x_data, y_data):
-                    fig.add_trace(go.Bar(x=[xd[i]], y=[yd], orientation='h', width=0.8,
-                                         marker=dict(color=hues_barplots[i],
-                                                     line=dict(color=hues_barplots[i], width=0.5))))
-            fig.update_layout(
-                xaxis=dict(showgrid=False, showline=True, showticklabels=False, zeroline=False, domain=[0.15, 1]),
-                yaxis=dict(visible=True, showgrid=False, showline=True, showticklabels=False, zeroline=True),
-                autosize=False, width=f_width, height=f_height, barmode='relative', paper_bgcolor=white_orig,
-                plot_bgcolor=white_orig, margin=dict(l=margin_l, r=margin_r, t=margin_t, b=margin_b),
-                showlegend=False,
-                title={'text': title_name,
-                       'y': title_height, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top',
-                       'font': dict(family=font_type, size=t_size, color=black_orig)},
-                # Add vertical line (axis) to separate positive and negative values
-                shapes=[{"type": "line", "xref": "x", "yref": "paper",
-                         "x0": 0, "y0": 0, "x1": 0, "y1": 1,
-                         "line": dict(color=grey3_orig, width=3, )}])
-
-            # Add labels and %-values
-            annotations = []
-            for ix_l, (yd, xd) in enumerate(zip(y_data, x_data)):
-                # Labeling the y-axis
-                annotations.append(dict(xref='paper', yref='y', x=0.14, y=yd,
-                                        xanchor='right', text=str(yd),
-                                        font=dict(family=font_type, size=y_size, color=black_orig),
-                                        showarrow=False, align='right'))
-
-                # Comment annotation for 'semi-empty' plots: (x=0.14 for overlapping h-line, otherwise x=0.18)
-                if list_of_sums[ix_l] == 0:
-                    annotations.append(dict(xref='paper', yref='y', x=0.18, y=yd, bgcolor=white_orig,
-                                            width=300, height=80,
-                                            text="<i>no impacts based on this method</i>",
-                                            font=dict(family=font_type, size=y_size, color=black_orig),
-                                            showarrow=False, align='center'))
+            # Dividing into positive and negative datasets (x-axis), sorting, chosing top_n values
+            pos_xd = [pos for pos in xd if (pos >= 5)]
+            neg_xd = [neg for neg in xd if (neg < -5)]
+            if len(pos_xd + neg_xd) <= 2:
+                pos_xd = [pos for pos in xd if (pos >= 10)]
+                neg_xd = [neg for neg in xd if (neg < -10)]
+            else:
+                pass
+            xd_pos_sor = sorted([x for x in pos_xd], reverse=True)
+            xd_neg_sor = sorted([x for x in neg_xd])
+            # Showing only the top n_values depending on the available space
+            top_4_pos = xd_pos_sor[:4]
+            top_3_pos = xd_pos_sor[:3]
+            top_2_pos = xd_pos_sor[:2]
+            top_4_neg = xd_neg_sor[:4]
+            top_3_neg = xd_neg_sor[:3]
+            top_2_neg = xd_neg_sor[:2]
+            # Create DF for isin_function for top_n values
+            pos_xd_df = pd.DataFrame(pos_xd)
+            neg_xd_df = pd.DataFrame(neg_xd)
+            # Preparation for available space
+            sum_pos = sum(pos_xd)
+            count_pos = sum(1 for item in pos_xd if item > 0)
+            sum_neg = sum(neg_xd)
+            count_neg = sum(1 for item in neg_xd if item < 0)
+            # Set threshold for number of %-labels per space
+            threshold1 = 45
+            threshold2 = 40
+
+            # Chose %-labels to be shown based on available space
+            # For positive values
+            if count_pos == 0:
+                top_pos_val = []
+            else:
+                if sum_pos / count_pos > threshold1:
+                    top_pos_val = top_4_pos
+                elif sum_pos / count_pos > threshold2:
+                    top_pos_val = top_3_pos
                 else:
-                    pass
-
-                # Dividing into positive and negative datasets (x-axis), sorting, chosing top_n values
-                pos_xd = [pos for pos in xd if (pos >= 5)]
-                neg_xd = [neg for neg in xd if (neg < -5)]
-                if len(pos_xd + neg_xd) <= 2:
-                    pos_xd = [pos for pos in xd if (pos >= 10)]
-                    neg_xd = [neg for neg in xd if (neg < -10)]
+                    top_pos_val = top_2_pos
+            # For negative values
+            if count_neg == 0:
+                top_neg_val = []
+            else:
+                if -sum_neg / count_neg > threshold1:
+                    top_neg_val = top_4_neg
+                elif -sum_neg / count_neg > threshold2:
+                    top_neg_val = top_3_neg
                 else:
+                    top_neg_val = top_2_neg
+
+            # Check for empty (positive / negative) lists
+            if not any(top_pos_val):
+                check_pos = []
+            else:
+                check_pos = pos_xd_df[0].isin(top_pos_val)
+            if not any(top_neg_val):
+                check_neg = []
+            else:
+                check_neg = neg_xd_df[0].isin(top_neg_val)
+
+            # Set labeling start to zero
+            space_pos = 0
+            space_neg = 0
+
+            # Label top %-values for bars (x_axis) for positive values
+            for a0 in range(0, len(pos_xd)):
+                # don't show if 0%
+                if pos_xd[a0] == 0:
                     pass
-                xd_pos_sor = sorted([x for x in pos_xd], reverse=True)
-                xd_neg_sor = sorted([x for x in neg_xd])
-                # Showing only the top n_values depending on the available space
-                top_4_pos = xd_pos_sor[:4]
-                top_3_pos = xd_pos_sor[:3]
-                top_2_pos = xd_pos_sor[:2]
-                top_4_neg = xd_neg_sor[:4]
-                top_3_neg = xd_neg_sor[:3]
-                top_2_neg = xd_neg_sor[:2]
-                # Create DF for isin_function for top_n values
-                pos_xd_df = pd.DataFrame(pos_xd)
-                neg_xd_df = pd.DataFrame(neg_xd)
-                # Preparation for available space
-                sum_pos = sum(pos_xd)
-                count_pos = sum(1 for item in pos_xd if item > 0)
-                sum_neg = sum(neg_xd)
-                count_neg = sum(1 for item in neg_xd if item < 0)
-                # Set threshold for number of %-labels per space
-                threshold1 = 45
-                threshold2 = 40
-
-                # Chose %-labels to be shown based on available space
-                # For positive values
-                if count_pos == 0:
-                    top_pos_val = []
                 else:
-                    if sum_pos / count_pos > threshold1:
-                        top_pos_val = top_4_pos
-                    elif sum_pos / count_pos > threshold2:
-                        top_pos_val = top_3_pos
+                    if check_pos[a0] & any(check_pos.to_list()):
+                        annotations.append(dict(xref='x', yref='y', x=space_pos + (pos_xd[a0] / 2), y=yd,
+                                                text=str(pos_xd[a0]) + '%',
+                                                # texttemplate = "%{pos_xd[a0]:.%}",
+                                                font=dict(family=font_type,
+                                                          size=y_size, color=white_orig), showarrow=False))
+                        space_pos += pos_xd[a0]
                     else:
-                        top_pos_val = top_2_pos
-                # For negative values
-                if count_neg == 0:
-                    top_neg_val = []
+                        space_pos += pos_xd[a0]
+            # Label top %-values for bars (x_axis) for negative values
+            for b0 in range(0, len(neg_xd)):
+                if check_neg[b0] & any(check_neg.to_list()):
+                    annotations.append(dict(xref='x', yref='y', x=space_neg + (neg_xd[b0] / 2), y=yd,
+                                            text=str(neg_xd[b0]) + '%', font=dict(family=font_type,
+                                                                                  size=y_size, color=white_orig),
+                                            showarrow=False))
+                    space_neg += neg_xd[b0]
                 else:
-                    if -sum_neg / count_neg > threshold1:
-                        top_neg_val = top_4_neg
-                    elif -sum_neg / count_neg > threshold2:
-                        top_neg_val = top_3_neg
-                    else:
-                        top_neg_val = top_2_neg
+                    space_neg += neg_xd[b0]
+
+        # Count number of labels and divided into 1st and 2nd line 'flow compartment' labels
+        top_label_ix1 = len(top_label_list) // 2
+        top_label_list1 = top_label_list[0:top_label_ix1]
+        top_label_list2 = top_label_list[top_label_ix1:]
+        # Loop for 1st line 'flow compartment' labels
+        x_space1 = x_sp_start
+        for ix, (cat1) in enumerate(top_label_list1):
+            annotations.append(
+                {'y': y_space1, 'x': x_space1, 'xref': 'paper', 'yref': 'paper',
+                 "text": str(cat1), "bgcolor": hues_barplots[ix], "width": an_width, "showarrow": False,
+                 "font": {"family": font_type, "size": y_size, "color": white_orig}})
+            x_space1 -= x_sp_diff1
+        # Loop for 2nd line 'flow compartment' labels
+        # in case of 3 labels:
+        if len(top_label_list2) > 2:
+            x_space2 = -0.33
+            for ix, (cat2) in enumerate(top_label_list2):
+                annotations.append(
+                    {'y': y_space2, 'x': x_space2, 'xref': 'paper', 'yref': 'paper',
+                     "text": str(cat2), "bgcolor": hues_barplots[ix + top_label_ix1], "width": an_width,
+                     "showarrow": False,
+                     "font": {"family": font_type, "size": y_size, "color": white_orig}})
+                x_space2 -= x_sp_diff2
+        else:
+            x_space2 = x_sp_start
+            for ix, (cat2) in enumerate(top_label_list2):
+                annotations.append({'y': y_space2, 'x': x_space2, 'xref': 'paper', 'yref': 'paper',
+                                    "text": str(cat2), "bgcolor": hues_barplots[ix + top_label_ix1],
+                                    "width": an_width,
+                                    "showarrow": False,
+                                    "font": {"family": font_type, "size": y_size, "color": white_orig}})
+                x_space2 -= x_sp_diff1
+
+        # X_axis title annotation:
+        annotations.append(
+            {'y': -0.1, 'x': 0.55, 'xref': 'paper', 'yref': 'paper',
+             "text": "Flow Compartments", "showarrow": False,
+             "font": {"family": font_type, "size": y_size, "color": black_orig}})
+
+        # Create the figure at once from the template, the traces and the annotations
+        layout["annotations"] = annotations
+        fig = go.Figure(data=traces, layout=layout)
+
+        # Save plot as png if selected
+        if save_fig:
+            export_figure(fig, f"../plots/" + str(fig_name))
+
+        # Show plot in browser if selected
+        if show_fig:
+            pio.renderers.default = 'browser'
+            fig.show()
+        else:
+            pass
 
-                # Check for empty (positive / negative) lists
-                if not any(top_pos_val):
-                    check_pos = []
-                else:
-                    check_pos = pos_xd_df[0].isin(top_pos_val)
-                if not any(top_neg_val):
-                    check_neg = []
-                else:
-                    check_neg = neg_xd_df[0].isin(top_neg_val)
+    # Collect data points required for logging
+    log_row = [int(prod_index), str(method_index_list), system_model, chart_type_1, chart_type_2, fig_name,
+               time.strftime('%H:%M:%S', time.localtime()), title_name, "None"]
 
-                # Set labeling start to zero
-                space_pos = 0
-                space_neg = 0
+    return log_row
 
-                # Label top %-values for bars (x_axis) for positive values
-                for a0 in range(0, len(pos_xd)):
-                    # don't show if 0%
-                    if pos_xd[a0] == 0:
-                        pass
-                    else:
-                        if check_pos[a0] & any(check_pos.to_list()):
-                            annotations.append(dict(xref='x', yref='y', x=space_pos + (pos_xd[a0] / 2), y=yd,
-                                                    text=str(pos_xd[a0]) + '%',
-                                                    # texttemplate = "%{pos_xd[a0]:.%}",
-                                                    font=dict(family=font_type,
-                                                              size=y_size, color=white_orig), showarrow=False))
-                            space_pos += pos_xd[a0]
-                        else:
-                            space_pos += pos_xd[a0]
-                # Label top %-values for bars (x_axis) for negative values
-                for b0 in range(0, len(neg_xd)):
-                    if check_neg[b0] & any(check_neg.to_list()):
-                        annotations.append(dict(xref='x', yref='y', x=space_neg + (neg_xd[b0] / 2), y=yd,
-                                                text=str(neg_xd[b0]) + '%', font=dict(family=font_type,
-                                                                                      size=y_size, color=white_orig),
-                                                showarrow=False))
-                        space_neg += neg_xd[b0]
-                    else:
-                        space_neg += neg_xd[b0]
-
-            # Count number of labels and divided into 1st and 2nd line 'flow compartment' labels
-            top_label_ix1 = len(top_label_list) // 2
-            top_label_list1 = top_label_list[0:top_label_ix1]
-            top_label_list2 = top_label_list[top_label_ix1:]
-            # Loop for 1st line 'flow compartment' labels
-            x_space1 = x_sp_start
-            for ix, (cat1) in enumerate(top_label_list1):
-                annotations.append(
-                    {'y': y_space1, 'x': x_space1, 'xref': 'paper', 'yref': 'paper',
-                     "text": str(cat1), "bgcolor": hues_barplots[ix], "width": an_width, "showarrow": False,
-                     "font": {"family": font_type, "size": y_size, "color": white_orig}})
-                x_space1 -= x_sp_diff1
-            # Loop for 2nd line 'flow compartment' labels
-            # in case of 3 labels:
-            if len(top_label_list2) > 2:
-                x_space2 = -0.33
-                for ix, (cat2) in enumerate(top_label_list2):
-                    annotations.append(
-                        {'y': y_space2, 'x': x_space2, 'xref': 'paper', 'yref': 'paper',
-                         "text": str(cat2), "bgcolor": hues_barplots[ix + top_label_ix1], "width": an_width,
-                         "showarrow": False,
-                         "font": {"family": font_type, "size": y_size, "color": white_orig}})
-                    x_space2 -= x_sp_diff2
-            else:
-                x_space2 = x_sp_start
-                for ix, (cat2) in enumerate(top_label_list2):
-                    annotations.append({'y': y_space2, 'x': x_space2, 'xref': 'paper', 'yref': 'paper',
-                                        "text": str(cat2), "bgcolor": hues_barplots[ix + top_label_ix1],
-                                        "width": an_width,
-                                        "showarrow": False,
-                                        "font": {"family": font_type, "size": y_size, "color": white_orig}})
-                    x_space2 -= x_sp_diff1
-
-            # X_axis title annotation:
-            annotations.append(
-                {'y': -0.1, 'x': 0.55, 'xref': 'paper', 'yref': 'paper',
-                 "text": "Flow Compartments", "showarrow": False,
-                 "font": {"family": font_type, "size": y_size, "color": black_orig}})
-
-            fig.update_layout(annotations=annotations)
-
-            # Save plot as png if selected
-            if save_fig:
-                fig.write_image(f"../plots/" + str(fig_name))
-
-            # Collect data points required for logging
-            sheet1.write(it, 0, it)
-            sheet1.write(it, 1, int(prod_index))
-            sheet1.write(it, 2, str(method_index_list))
-            sheet1.write(it, 3, system_model)
-            sheet1.write(it, 4, chart_type_1)
-            sheet1.write(it, 5, chart_type_2)
-            sheet1.write(it, 6, fig_name)
-            sheet1.write(it, 7, time.strftime('%H:%M:%S', time.localtime()))
-            sheet1.write(it, 8, title_name)
+
+def barplot_batch(system_model, prod_list, n, method_index_list, save_fig=False, show_fig=False):
+    """
+    This function creates the bar plots of a chunk of products, with the data of all of them calculated at once
+    (see dp.barplot_dfs).
+
+    Required arguments:
+    - system_model: string, the name of the system model to be used.
+        Possible options are: "cutoff", "apos", "consequential"
+    - prod_list: list of int, indices of the products of the chunk
+    - n: int, determines after how many words the method names are split into lines
+    - method_index_list: list of int, list of indices of the LCIA method from the LCIA_index matrix
+
+    Optional arguments:
+    - save_fig: bool, if True, the figures are saved to the defined folder. Default is False.
+    - show_fig: bool, if True, the figures are shown in a separate browser window. Default is False.
+
+    Returns:
+    - log_rows: list with the log row of each product (see barplot), in the order of prod_list
+    """
+    dfs = dp.barplot_dfs(prod_list, method_index_list)
+    return [barplot(system_model, prod_index, n, method_index_list, save_fig, show_fig, data=dfs[prod_index])
+            for prod_index in prod_list]
+
+
+def create_barplots(system_model, prod_list, n, method_index_list, save_fig=False, show_fig=False, verbose=True,
+                    workers=1, render_workers=0, log_format=None, export_xlsx=False, resume=False, log_name=None,
+                    largest_first=True):
+    """
+    This function creates bar plots for several products based on the lists created before
+    (create_dfs_barplots function, calculated for chunks of products at once with barplot_batch), optionally saves
+    them as png and/or shows them and logs the progress.
+
+    Required arguments:
+    - system_model: string, the name of the system model to be used.
+        Possible options are: "cutoff", "apos", "consequential"
+    - prod_list: list of int, list of indices of the product to plot from the ie_index matrix, e.g. 12759
+    - method_index_list: list of int, list of indices of the LCIA method from the LCIA_index matrix
+        The most common ones are: [222, 485, 541] (or 540 in consequential).
+
+    Optional arguments:
+    - save_fig: bool, if True, figures are saved to the defined folder. Default is True.
+    - show_fig: bool, if True, figures are shown in a separate browser window. Default is False.
+    - workers: int, number of processes the products are spread across (see map_products). Default is 1.
+    - render_workers: int, number of renderer processes that export the figures in the background
+        (see start_renderer). Only used with workers=1. Default is 0.
+    - log_format: string, format of the log, one of "csv", "jsonl", "sqlite" (see open_log).
+        Default is dl.log_format.
+    - export_xlsx: bool, if True, the log is also saved as xlsx file at the end. Default is False.
+    - resume: bool, if True, the products already plotted with the same inputs are skipped (see pending_barplots),
+        e.g. to continue an interrupted run or to plot only the bar plots that changed since the last release.
+        Default is False.
+    - log_name: string, the beginning of the name of the log, e.g. with the shard. Default is "barplots_" followed by
+        the system model.
+    - largest_first: bool, if True and the products are spread across several workers, the most expensive products
+        are plotted first (see schedule_products) and the log follows this order. Default is True.
+
+    Returns:
+    - figures that can be shown in a browser window, saved to a folder or both.
+    - a log file which logs the progress of the plotting, written while plotting
+    - the saved figures are recorded in the manifest (see open_manifest)
+    """
+    # Set up the plots folder
+    if not os.path.exists("../plots"):
+        os.mkdir("../plots")
+    # Skip the products that were plotted before
+    settings = {"n": n, "image_formats": dl.image_formats}
+    manifest = open_manifest()
+    if resume:
+        n_products = len(prod_list)
+        prod_list = pending_barplots(manifest, system_model, prod_list, method_index_list, settings)
+        if verbose:
+            print(f"Resuming: {n_products - len(prod_list)} barplots are already done and unchanged")
+    if largest_first and workers > 1:
+        prod_list = schedule_products(list(prod_list), method_index_list)
+    # Set up logging
+    start_time = time.time()
+    log = open_log(log_name or f"barplots_{system_model}",
+                   ["prod_index", "method_index_list", "system_model", "plot_type_1", "plot_type_2", "fig_name",
+                    "time", "title_name", "error_message"], log_format)
+
+    # Plot per chunk of products and log. The data of the bar plots of a chunk is calculated at once, with several
+    # workers the chunks are smaller, so that each worker gets a few of them
+    plot_chunk = partial(barplot_batch, system_model, n=n, method_index_list=method_index_list,
+                         save_fig=save_fig, show_fig=show_fig)
+    chunk_size = max(1, min(dl.barplot_batch_size, math.ceil(len(prod_list) / (workers * 4))))
+    chunks = [prod_list[i:i + chunk_size] for i in range(0, len(prod_list), chunk_size)]
+    def finish_barplot(log_row, error_message):
+        # The log row is written and the bar plot recorded once its export is finished
+        if error_message is not None:
+            log_row[8] = error_message
+        elif save_fig:
+            record_item(manifest, system_model, "barplot", log_row[0], method_index_list,
+                        barplot_hash(log_row[0], method_index_list, settings))
+
+    start_renderer(render_workers if workers == 1 else 0)
+    pending_rows = deque()
+    it = 0
+    for log_rows in map_products(plot_chunk, chunks, system_model, method_index_list, workers):
+        for log_row in log_rows:
+            pending_rows.append((log_row, f"../plots/{log_row[5]}" if save_fig else None, finish_barplot))
+            it += 1
             if verbose:
                 if it % 500 == 0:
                     print(f"{it} barplots done")
-            it += 1
+        finish_rows(log, pending_rows)
+    finish_rows(log, pending_rows, wait=True)
+    for error_message in stop_renderer():
+        print(f"Export failed for {error_message}")
 
-            # Show plot in browser if selected
-            if show_fig:
-                pio.renderers.default = 'browser'
-                fig.show()
-            else:
-                pass
-
-    wb.save(f"../logs/barplots_{system_model}_{today.strftime('%d-%m-%Y')}_\
-{time.strftime('%H:%M:%S', time.localtime())}.xls")
+    close_log(log, export_xlsx)
+    manifest.close()
 
     # Print time required for running the script
     if verbose:
         print("--- {0} seconds --- for {1} datasets".format(time.time() - start_time, len(prod_list)))
 
 
-def create_treemaps(system_model, product_index_list, method_index_list, save_fig=True, show_fig=False, verbose=True):
+def treemap_lists(system_model, prod_index, method_index_list, max_levels=5, threshold=0.5):
+    """
+    This function prepares the data of the treemaps of one product for several methods (prep stage), using the
+    sort_datasets function.
+
+    Required arguments:
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - prod_index: int, index of the product to be plotted
+    - method_index_list: list of int, contains indices of LCIA methods to be used
+
+    Optional arguments:
+    - max_levels: int, maximum number of levels of the treemaps (see sort_datasets). Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down. Default is 0.5.
+
+    Returns:
+    - items: list with one dictionary per method with the keys system_model, prod_index, method_index and either
+        lists (the results of sort_datasets), fingerprint (see dp.treemap_fingerprint) and used_products or
+        error_message
+    """
+    # Extract the product once and score it for all the methods together, an error is logged for each method below
+    prefetch_error = None
+    try:
+        dp.prefetch_treemap_arrays(prod_index, method_index_list)
+    except Exception as e:
+        prefetch_error = str(e)
+
+    items = []
+    for method_index in method_index_list:
+        item = {"system_model": system_model, "prod_index": int(prod_index), "method_index": method_index}
+        if prefetch_error is not None:
+            item["error_message"] = prefetch_error
+            items.append(item)
+            continue
+        try:
+            used_products = []
+            item["lists"] = lp.sort_datasets(prod_index, method_index, max_levels, threshold,
+                                             used_products=used_products)
+            item["fingerprint"] = dp.treemap_fingerprint(prod_index, method_index, used_products)
+            item["used_products"] = used_products
+        except Exception as e:
+            item["error_message"] = str(e)
+        items.append(item)
+
+    return items
+
+
+def treemap_template(annotation_set):
+    """
+    This function creates the template of the treemaps with one set of annotations: the layout without the title text
+    and the style of the treemap trace without the data (see figure_template).
+
+    Required arguments:
+    - annotation_set: string, one of the following: "zero" for plots without impacts or credits, "deep" for plots
+        that did not reach optimum depth (the text of the last annotation contains {last_label}), else "normal"
+
+    Returns:
+    - dictionary with the keys layout and trace
     """
-    This function plots treemaps based on the lists created before and logs the progress.
+    hues_treemaps = dl.hues_treemaps
+    annotations = [{"x": -0.0035, "y": 0.995, "xref": 'x domain', "yref": 'y domain',
+                    "text": 'For this assessment method there are no impacts or credits. \
+Therefore no plot is rendered.',
+                    "font": {"family": dl.font_type, "size": 16, "color": 'black'},
+                    "showarrow": False},
+                   {"x": 0.01, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
+                    "text": 'Impact from inputs',
+                    "font": {"family": dl.font_type, "size": 12, "color": 'white'},
+                    "bgcolor": hues_treemaps[0],
+                    "width": 135,
+                    "height": 13,
+                    "showarrow": False},
+                   {"x": 0.18, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
+                    "text": 'Impact from emissions',
+                    "font": {"family": dl.font_type, "size": 12, "color": 'black'},
+                    "bgcolor": hues_treemaps[1],
+                    "width": 135,
+                    "height": 13,
+                    "showarrow": False},
+                   {"x": 0.433, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
+                    "text": 'Credits from inputs',
+                    "font": {"family": dl.font_type, "size": 12, "color": 'white'},
+                    "bgcolor": hues_treemaps[2],
+                    "width": 135,
+                    "height": 13,
+                    "showarrow": False},
+                   {"x": 0.603, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
+                    "text": 'Credits from emissions',
+                    "font": {"family": dl.font_type, "size": 12, "color": 'black'},
+                    "bgcolor": hues_treemaps[3],
+                    "width": 135,
+                    "height": 13,
+                    "showarrow": False},
+                   {"x": 0.01, "y": -0.1, "xref": 'x domain', "yref": 'y domain',
+                    "text": 'For plots containing credits the impact score equals the impact minus \
+the credits.',
+                    "font": {"family": dl.font_type, "size": 12, "color": 'black'},
+                    "showarrow": False},
+                   {"x": 0.01, "y": -0.18, "xref": 'x domain', "yref": 'y domain', "align": "left",
+                    "text": 'Plotting of the production chain may not have reached optimum depth due \
+to space constraints. For further information on the maximum contributor<br>check the \
+following dataset: {last_label}.',
+                    "font": {"family": dl.font_type, "size": 12, "color": 'black'},
+                    "showarrow": False},
+                   ]
+
+    if annotation_set == "zero":
+        annot = annotations[0:1]
+    elif annotation_set == "deep":
+        annot = annotations[1:7]
+    else:
+        annot = annotations[1:6]
+
+    trace = {"type": "treemap",
+             "marker": {"depthfade": True,
+                        "pad": {"t": 25, "l": 4, "r": 4, "b": 4},
+                        "line": {"color": "white", "width": 1}},
+             "branchvalues": "total",
+             "textfont": {"family": dl.font_type, "size": 16},
+             "texttemplate": "%{label}<br>%{value:.2e} | %{percentRoot}",
+             "outsidetextfont": {"color": "black"},
+             "root": {"color": "rgb(226, 226, 226)"},
+             "tiling": {"packing": "squarify", "squarifyratio": 1, "pad": 0}}
+
+    layout = {"uniformtext": {"minsize": 16, "mode": 'hide'},
+              "title": {'y': 0.88,
+                        'x': 0.08,
+                        'xanchor': 'left',
+                        'yanchor': 'top',
+                        "font": {"color": "black", "family": dl.font_type, "size": 18}},
+              "autosize": False,
+              "width": 1000,
+              "height": 600,
+              "annotations": annot}
+
+    return {"layout": layout, "trace": trace}
+
+
+def treemap_figure(item, max_levels=5):
+    """
+    This function builds the treemap of one product and method (build stage) from the data prepared with the
+    treemap_lists function.
+
+    Required arguments:
+    - item: dictionary of one method, created with the treemap_lists function
+
+    Optional arguments:
+    - max_levels: int, maximum number of levels of the treemaps, as used in treemap_lists. Default is 5.
+
+    Returns:
+    - fig: plotly figure, None if the data could not be prepared or the figure could not be built
+    - log_row: list of the data points logged (prod_index, method_index, system_model, level, plot_type,
+        error_message, time)
+    """
+    prod_index = item["prod_index"]
+    method_index = item["method_index"]
+    fig = None
+    try:
+        if "error_message" in item:
+            raise Exception(item["error_message"])
+        labels, ids, parents, values, colors, level, score, plot_type, last_labels = item["lists"]
+
+        if plot_type == "zero":
+            annotation_set = "zero"
+        elif level > max_levels:
+            annotation_set = "deep"
+        else:
+            annotation_set = "normal"
+        template = figure_template(("treemap", annotation_set), partial(treemap_template, annotation_set))
+
+        # Patch the template with the data of the dataset
+        trace = template["trace"]
+        trace.update({"labels": labels, "ids": ids, "parents": parents, "values": values})
+        trace["marker"]["colors"] = colors
+
+        LCIA_index = dl.LCIA_index
+        layout = template["layout"]
+        layout["title"]["text"] = f"LCIA method: {LCIA_index.iloc[method_index]['method']}, \
+{LCIA_index.iloc[method_index]['category']}, {LCIA_index.iloc[method_index]['indicator']} | Score: {score:,.2e}"
+        if annotation_set == "deep":
+            layout["annotations"][-1]["text"] = layout["annotations"][-1]["text"].format(
+                last_label=last_labels[0].replace("<br>", " "))
+
+        fig = go.Figure(data=[trace], layout=layout)
+        error_message = "None"
+
+    except Exception as e:
+        fig = None
+        error_message = str(e)
+        level = 0
+        plot_type = "error"
+
+    log_row = [prod_index, method_index, item["system_model"], level, plot_type, error_message,
+               time.strftime("%H:%M:%S", time.localtime())]
+
+    return fig, log_row
+
+
+def treemap_path(system_model, prod_index, method_index):
+    """
+    This function returns the path of the treemap image of one product and method, without the file extension.
+    """
+    return f"../plots/treemap_{system_model}_p{prod_index}_m{method_index}"
+
+
+def output_figure(fig, log_row, fig_path, save_fig=True, show_fig=False):
+    """
+    This function exports a figure (export stage) and/or shows it. If the export fails, the error is written to the
+    log row of the figure.
+
+    Required arguments:
+    - fig: plotly figure, or None if there is nothing to export
+    - log_row: list of the data points logged, created with the treemap_figure function
+    - fig_path: string, path of the image without the file extension
+
+    Optional arguments:
+    - save_fig: bool, if True, the figure is exported (see export_figure). Default is True.
+    - show_fig: bool, if True, the figure is shown in a separate browser window. Default is False.
+
+    Returns:
+    - log_row: list of the data points logged
+    """
+    if fig is None:
+        return log_row
+    try:
+        if save_fig:
+            # create image folder
+            if not os.path.exists("../plots"):
+                os.makedirs("../plots", exist_ok=True)
+
+            export_figure(fig, fig_path)
+
+        if show_fig:
+            pio.renderers.default = 'browser'
+            fig.show()
+
+    except Exception as e:
+        log_row[3:6] = [0, "error", str(e)]
+
+    return log_row
+
+
+def finish_treemap(log_row, error_message, manifest=None, save_fig=True, item_hash=None, used_products=None):
+    """
+    This function completes the log row of a treemap once its export is finished (see finish_rows): a failed export
+    is written to the log row, an exported treemap is recorded in the manifest.
+
+    Required arguments:
+    - log_row: list of the data points logged, created with the treemap_figure function
+    - error_message: string, the error of the export, or None if the treemap was exported or not exported at all
+
+    Optional arguments:
+    - manifest: sqlite3 connection, if given, the saved treemaps are recorded in it (see record_item).
+        Default is None.
+    - save_fig: bool, if True, the treemap was saved. Default is True.
+    - item_hash, used_products: the input hash and the products broken down, see build_treemaps
+    """
+    if error_message is not None:
+        log_row[3:6] = [0, "error", error_message]
+    elif manifest is not None and save_fig and log_row[5] == "None":
+        record_item(manifest, log_row[2], "treemap", log_row[0], log_row[1], item_hash, used_products)
+
+
+def treemaps(system_model, prod_index, method_index_list, save_fig=True, show_fig=False, max_levels=5, threshold=0.5):
+    """
+    This function plots the treemaps of one product for several methods based on the lists created with the
+    sort_datasets function, running the prep, build and export stages one after the other.
+
+    Required arguments:
+    - system_model: string, one of "cutoff", "apos", "consequential"
+    - prod_index: int, index of the product to be plotted
+    - method_index_list: list of int, contains indices of LCIA methods to be used; most common are: 222, 485, 541
+    (or 540 for IPCC in consequential)
+
+    Optional arguments:
+    - save_fig: bool, if True, figures are saved to the defined folder. Default is True.
+    - show_fig: bool, if True, figures are shown in a separate browser window. Default is False.
+    - max_levels: int, maximum number of levels of the treemaps (see sort_datasets). Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down. Default is 0.5.
+
+    Returns:
+    - log_rows: list with one list per method of the data points logged (prod_index, method_index, system_model,
+        level, plot_type, error_message, time)
+    """
+    log_rows = []
+    for item in treemap_lists(system_model, prod_index, method_index_list, max_levels, threshold):
+        fig, log_row = treemap_figure(item, max_levels)
+        fig_path = treemap_path(system_model, item["prod_index"], item["method_index"])
+        log_row = output_figure(fig, log_row, fig_path, save_fig, show_fig)
+        finish_treemap(log_row, export_result(fig_path if save_fig and fig is not None else None)[1])
+        log_rows.append(log_row)
+
+    return log_rows
+
+
+def build_treemaps(items, max_levels=5, settings=None, done=None):
+    """
+    This function is the build stage of the treemap pipeline: it builds the figures of all the methods of one product.
+    Treemaps that were plotted before with the same input hash are not built again.
+
+    Required arguments:
+    - items: list of dictionaries, created with the treemap_lists function
+
+    Optional arguments:
+    - max_levels: int, maximum number of levels of the treemaps. Default is 5.
+    - settings: dictionary of the settings the treemaps depend on (see input_hash). Default is None.
+    - done: dictionary of the treemaps plotted before, created with the completed_items function.
+        Default is None, all the treemaps are built.
+
+    Returns:
+    - list of tuples (fig, log_row, fig_path, item_hash, used_products), one per method. The fig of the unchanged
+        treemaps is None and the error_message of their log_row is "unchanged".
+    """
+    built = []
+    for item in items:
+        fig_path = treemap_path(item["system_model"], item["prod_index"], item["method_index"])
+        item_hash = input_hash("treemap", item["prod_index"], item["method_index"], settings, item.get("fingerprint"))
+        if done and "fingerprint" in item and unchanged_item(done, item["prod_index"], item["method_index"],
+                                                             item_hash, fig_path):
+            level, plot_type = item["lists"][5], item["lists"][7]
+            log_row = [item["prod_index"], item["method_index"], item["system_model"], level, plot_type, "unchanged",
+                       time.strftime("%H:%M:%S", time.localtime())]
+            built.append((None, log_row, fig_path, item_hash, item["used_products"]))
+            continue
+        fig, log_row = treemap_figure(item, max_levels)
+        built.append((fig, log_row, fig_path, item_hash, item.get("used_products")))
+    return built
+
+
+def export_treemaps(built, save_fig=True, show_fig=False):
+    """
+    This function is the export stage of the treemap pipeline: it exports and/or shows the figures of one product.
+    Figures exported in the background may still be exported when the function returns (see export_result).
+
+    Required arguments:
+    - built: list of tuples (fig, log_row, fig_path, item_hash, used_products), created with the build_treemaps
+        function
+
+    Optional arguments:
+    - save_fig: bool, if True, figures are saved to the defined folder. Default is True.
+    - show_fig: bool, if True, figures are shown in a separate browser window. Default is False.
+
+    Returns:
+    - list of tuples (log_row, fig_path, item_hash, used_products), one per method. The fig_path is None if the
+        figure was not exported.
+    """
+    exported = []
+    for fig, log_row, fig_path, item_hash, used_products in built:
+        log_row = output_figure(fig, log_row, fig_path, save_fig, show_fig)
+        exported.append((log_row, fig_path if save_fig and log_row[5] == "None" else None, item_hash,
+                         used_products))
+    return exported
+
+
+def create_treemaps(system_model, product_index_list, method_index_list, save_fig=True, show_fig=False, verbose=True,
+                    workers=1, max_levels=5, threshold=0.5, render_workers=0, build_workers=1, export_workers=1,
+                    queue_size=8, log_format=None, export_xlsx=False, resume=False, log_name=None,
+                    largest_first=True):
+    """
+    This function plots treemaps based on the lists created before and logs the progress. The data preparation
+    (treemap_lists), the figure building (build_treemaps) and the image export (export_treemaps) run as the stages of
+    a pipeline (see run_pipeline), so that preparing the next products overlaps with building and exporting the
+    figures of the previous ones.
 
     Required arguments:
     - product_index_list: list of int, contains indices of the products to be plotted
@@ -413,161 +1685,91 @@ def create_treemaps(system_model, product_index_list, method_index_list, save_fi
     Optional arguments:
     - save_fig: bool, if True, figures are saved to the defined folder. Default is True.
     - show_fig: bool, if True, figures are shown in a separate browser window. Default is False.
+    - workers: int, number of processes the products are spread across (see map_products). Default is 1.
+    - max_levels: int, maximum number of levels of the treemaps, e.g. 3 for quick previews. Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down. Default is 0.5.
+    - render_workers: int, number of renderer processes that export the figures in the background
+        (see start_renderer). With workers > 1 and no render_workers, one renderer process per worker is started,
+        so that the figures are still exported in parallel. Default is 0.
+    - build_workers: int, number of threads building the figures. Default is 1.
+    - export_workers: int, number of threads of the export stage. Default is 1.
+    - queue_size: int, maximum number of products waiting in front of the build and the export stage.
+        The queue depths are printed with verbose (see pipeline_depths). Default is 8.
+    - log_format: string, format of the log, one of "csv", "jsonl", "sqlite" (see open_log).
+        Default is dl.log_format.
+    - export_xlsx: bool, if True, the log is also saved as xlsx file at the end. Default is False.
+    - resume: bool, if True, the treemaps plotted before with the same inputs are not plotted again, e.g. to continue
+        an interrupted run or to plot only the treemaps that changed since the last release. The products whose
+        treemaps are all unchanged are skipped before their data is prepared (see pending_treemaps), the unchanged
+        treemaps of the other products are not built and exported again (see build_treemaps). Default is False.
+    - log_name: string, the beginning of the name of the log, e.g. with the shard. Default is "treemaps_" followed by
+        the system model.
+    - largest_first: bool, if True and the products are spread across several workers, the products with the most
+        expensive treemaps are plotted first (see schedule_products) and the log follows this order. Default is True.
 
     Returns:
     - figures that can be shown in a browser window, saved to a folder or both.
-    - an excel file which logs the progress of the plotting
+    - a log file which logs the progress of the plotting, written while plotting
+    - the saved figures are recorded in the manifest (see open_manifest)
     """
-    hues_treemaps = dl.hues_treemaps
+    # Skip the products that were plotted before
+    settings = {"max_levels": max_levels, "threshold": threshold, "image_formats": dl.image_formats}
+    manifest = open_manifest()
+    done = None
+    if resume:
+        n_products = len(product_index_list)
+        product_index_list = pending_treemaps(manifest, system_model, product_index_list, method_index_list, settings)
+        done = completed_items(manifest, system_model, "treemap")
+        if verbose:
+            print(f"Resuming: the treemaps of {n_products - len(product_index_list)} datasets are already done and "
+                  f"unchanged")
+    if largest_first and workers > 1:
+        product_index_list = schedule_products(list(product_index_list), method_index_list, max_levels, threshold)
 
     # Set up the logging
-    i = 1
-    wb = Workbook()
-    sheet1 = wb.add_sheet('Sheet 1')
-    sheet1.write(0, 0, "number")
-    sheet1.write(0, 1, "prod_index")
-    sheet1.write(0, 2, "method_index")
-    sheet1.write(0, 3, "system_model")
-    sheet1.write(0, 4, "level")
-    sheet1.write(0, 5, "plot_type")
-    sheet1.write(0, 6, "error_message")
-    sheet1.write(0, 7, "time")
+    log = open_log(log_name or f"treemaps_{system_model}",
+                   ["prod_index", "method_index", "system_model", "level", "plot_type", "error_message", "time"],
+                   log_format)
 
     # Plot and log
-    for prod_index in product_index_list:
-        for method_index in method_index_list:
-            try:
-                (labels, ids, parents, values, colors, level, score, plot_type, labels_5
-                 ) = lp.sort_datasets(prod_index, method_index)
-
-                annotations = [{"x": -0.0035, "y": 0.995, "xref": 'x domain', "yref": 'y domain',
-                                "text": 'For this assessment method there are no impacts or credits. \
-Therefore no plot is rendered.',
-                                "font": {"family": dl.font_type, "size": 16, "color": 'black'},
-                                "showarrow": False},
-                               {"x": 0.01, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
-                                "text": 'Impact from inputs',
-                                "font": {"family": dl.font_type, "size": 12, "color": 'white'},
-                                "bgcolor": hues_treemaps[0],
-                                "width": 135,
-                                "height": 13,
-                                "showarrow": False},
-                               {"x": 0.18, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
-                                "text": 'Impact from emissions',
-                                "font": {"family": dl.font_type, "size": 12, "color": 'black'},
-                                "bgcolor": hues_treemaps[1],
-                                "width": 135,
-                                "height": 13,
-                                "showarrow": False},
-                               {"x": 0.433, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
-                                "text": 'Credits from inputs',
-                                "font": {"family": dl.font_type, "size": 12, "color": 'white'},
-                                "bgcolor": hues_treemaps[2],
-                                "width": 135,
-                                "height": 13,
-                                "showarrow": False},
-                               {"x": 0.603, "y": -0.052, "xref": 'x domain', "yref": 'y domain',
-                                "text": 'Credits from emissions',
-                                "font": {"family": dl.font_type, "size": 12, "color": 'black'},
-                                "bgcolor": hues_treemaps[3],
-                                "width": 135,
-                                "height": 13,
-                                "showarrow": False},
-                               {"x": 0.01, "y": -0.1, "xref": 'x domain', "yref": 'y domain',
-                                "text": 'For plots containing credits the impact score equals the impact minus \
-the credits.',
-                                "font": {"family": dl.font_type, "size": 12, "color": 'black'},
-                                "showarrow": False},
-                               {"x": 0.01, "y": -0.18, "xref": 'x domain', "yref": 'y domain', "align": "left",
-                                "text": f'Plotting of the production chain may not have reached optimum depth due \
-to space constraints. For further information on the maximum contributor<br>check the \
-following dataset: {labels_5[0].replace("<br>", " ")}.',
-                                "font": {"family": dl.font_type, "size": 12, "color": 'black'},
-                                "showarrow": False},
-                               ]
-
-                if plot_type == "zero":
-                    annot = annotations[0:1]
-                elif level == 6:
-                    annot = annotations[1:7]
-                else:
-                    annot = annotations[1:6]
-
-                fig = go.Figure(go.Treemap(
-                    labels=labels,
-                    ids=ids,
-                    parents=parents,
-                    values=values,
-                    marker_colors=colors,
-                    marker={"depthfade": True},
-                    branchvalues="total",
-                    textfont={"family": dl.font_type, "size": 16},
-                    texttemplate="%{label}<br>%{value:.2e} | %{percentRoot}",
-                    outsidetextfont={"color": "black"},
-                    root={"color": "rgb(226, 226, 226)"},
-                    tiling={"packing": "squarify", "squarifyratio": 1, "pad": 0},
-                    marker_pad={"t": 25, "l": 4, "r": 4, "b": 4},
-                    marker_line={"color": "white", "width": 1}
-                    ))
-
-                LCIA_index = dl.LCIA_index
-                fig.update_layout(uniformtext={"minsize": 16, "mode": 'hide'},
-                                  title={
-                                      'text': f"LCIA method: {LCIA_index.iloc[method_index]['method']}, \
-{LCIA_index.iloc[method_index]['category']}, {LCIA_index.iloc[method_index]['indicator']} | Score: {score:,.2e}",
-                                      'y': 0.88,
-                                      'x': 0.08,
-                                      'xanchor': 'left',
-                                      'yanchor': 'top',
-                                      "font": {"color": "black", "family": dl.font_type, "size": 18}},
-                                  autosize=False,
-                                  width=1000,
-                                  height=600,
-                                  annotations=annot
-                                  )
-                error_message = "None"
-
-                if save_fig:
-                    # create image folder
-                    if not os.path.exists("../plots"):
-                        os.mkdir("../plots")
-
-                    fig.write_image(f"../plots/treemap_{system_model}_p{prod_index}_m{method_index}.png")
-
-                if show_fig:
-                    pio.renderers.default = 'browser'
-                    fig.show()
-
-            except Exception as e:
-                error_message = str(e)
-                level = 0
-                plot_type = "error"
-
-            sheet1.write(i, 0, i)
-            sheet1.write(i, 1, int(prod_index))
-            sheet1.write(i, 2, method_index)
-            sheet1.write(i, 3, system_model)
-            sheet1.write(i, 4, level)
-            sheet1.write(i, 5, plot_type)
-            sheet1.write(i, 6, error_message)
-            sheet1.write(i, 7, time.strftime("%H:%M:%S", time.localtime()))
-            if verbose:
-                if i % 500 == 0:
-                    print(f"{i} treemaps done")
-            i = i + 1
-
-    if not os.path.exists("../logs"):
-        os.mkdir("../logs")
-
-    today = date.today()
-    wb.save(f"../logs/treemaps_{system_model}_{today.strftime('%d-%m-%Y')}_\
-{time.strftime('%H:%M:%S', time.localtime())}.xls")
+    prep_product = partial(treemap_lists, system_model, method_index_list=method_index_list, max_levels=max_levels,
+                           threshold=threshold)
+    stages = [("build", partial(build_treemaps, max_levels=max_levels, settings=settings, done=done), build_workers),
+              ("export", partial(export_treemaps, save_fig=save_fig, show_fig=show_fig), export_workers)]
+    # The worker pool is started here, before the threads of the pipeline, so that no thread is forked
+    pool = start_workers(system_model, method_index_list, workers)
+    # The figures are built in this process, so with several workers the export is spread across renderer processes
+    start_renderer(render_workers or (workers if workers > 1 else 0), queue_size)
+    pending_rows = deque()
+    plotted = 0
+    try:
+        for exported in run_pipeline(map_products(prep_product, product_index_list, system_model, method_index_list,
+                                                  workers, pool), stages, queue_size):
+            for log_row, fig_path, item_hash, used_products in exported:
+                pending_rows.append((log_row, fig_path, partial(finish_treemap, manifest=manifest, save_fig=save_fig,
+                                                                item_hash=item_hash, used_products=used_products)))
+                plotted += 1
+                if verbose:
+                    if plotted % 500 == 0:
+                        print(f"{plotted} treemaps done, queue depths: {pipeline_depths()}")
+            finish_rows(log, pending_rows)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    finish_rows(log, pending_rows, wait=True)
+    for error_message in stop_renderer():
+        print(f"Export failed for {error_message}")
+
+    close_log(log, export_xlsx)
+    manifest.close()
     if verbose:
         print(f"Plotting of treemaps for {len(product_index_list)} datasets is complete.")
 
 
 def pdf_plotting(system_model, method_index_list, sample_size=None, product_index_list=None,
-                 save_fig=True, show_fig=False, verbose=True):
+                 save_fig=True, show_fig=False, verbose=True, workers=1, max_levels=5, threshold=0.5,
+                 render_workers=0, log_format=None, export_xlsx=False, resume=False, shard_index=None,
+                 shard_count=None, work_list=None, largest_first=True):
     """
     This function combines all the previous functions to select the system model
     and plot barplots and treemaps with one command.
@@ -582,44 +1784,69 @@ def pdf_plotting(system_model, method_index_list, sample_size=None, product_inde
     - save_fig: bool, if True, figures are saved to the defined folder. Default is True.
     - show_fig: bool, if True, figures are shown in a separate browser window. Default is False.
     - verbose: bool, if True, print statements on the progress of the plotting are shown. Default is True.
-
-    If products are specified, this selection overrides the sample size.
+    - workers: int, number of processes the datasets are spread across. Default is 1.
+    - max_levels: int, maximum number of levels of the treemaps, e.g. 3 for quick previews. Default is 5.
+    - threshold: float, share of the maximum contributor above which it is broken down in the treemaps.
+        Default is 0.5.
+    - render_workers: int, number of renderer processes that export the figures while the next ones are prepared.
+        The bar plots only use them with workers=1 (else each worker exports its own), the treemaps start one
+        renderer process per worker if not given (see create_treemaps). Default is 0.
+    - log_format: string, format of the logs, one of "csv", "jsonl", "sqlite". Default is dl.log_format.
+    - export_xlsx: bool, if True, the logs are also saved as xlsx files at the end. Default is False.
+    - resume: bool, if True, the plots recorded in the manifest with the same inputs whose images exist are skipped.
+        This continues an interrupted run, or after a new release, only plots the datasets whose data changed.
+        Default is False.
+    - shard_index, shard_count: int, if specified, only the shard_index-th of shard_count shards of the datasets is
+        plotted, e.g. on one of several machines. The shards have about the same estimated cost (see shard_products)
+        and are the same in every process. The logs of the shards are combined with merge_logs.
+    - work_list: string, path of a file with the indices of the products to be plotted (see read_work_list).
+    - largest_first: bool, if True and workers > 1, the most expensive datasets are plotted first
+        (see schedule_products). Default is True.
+
+    If products are specified, this selection overrides the sample size, and a work list overrides both.
     If neither of these arguments is specified, all the datasets for the specific
         system model are plotted.
 
     Returns:
     - barplots and treemaps that can be shown in a browser window, saved to a folder or both.
-    - two excel files which log the progress of the plotting of barplots and treemaps
+    - two log files which log the progress of the plotting of barplots and treemaps
     """
-    try:
-        dl.select_system_model(system_model, dl.A_public_cutoff, dl.A_public_apos, dl.A_public_consequential,
-                               dl.A_public_cor_cutoff, dl.A_public_cor_apos, dl.A_public_cor_consequential,
-                               dl.B_public_cutoff, dl.B_public_apos, dl.B_public_consequential,
-                               dl.C_public_cutoff, dl.C_public_apos, dl.C_public_consequential,
-                               dl.ee_index_cutoff, dl.ee_index_apos, dl.ee_index_consequential,
-                               dl.ie_index_cutoff, dl.ie_index_apos, dl.ie_index_consequential,
-                               dl.LCIA_index_cutoff, dl.LCIA_index_apos, dl.LCIA_index_consequential,
-                               dl.c_array_cutoff, dl.c_array_apos, dl.c_array_consequential,
-                               dl.lcia_cutoff, dl.lcia_apos, dl.lcia_consequential,
-                               dl.lcia_df_cutoff, dl.lcia_df_apos, dl.lcia_df_consequential)
-
-        ie_index = dl.ie_index
-
-        if product_index_list is None:
-            if sample_size is not None:
-                product_index_list = sample(list(ie_index.index.values), sample_size)
-            else:
-                product_index_list = list(ie_index.index.values)
+    if shard_index is not None or shard_count is not None:
+        check_shard(shard_index, shard_count)
 
-        # Create the plots
-        l_break = dl.l_break
-        if verbose:
-            print(f"Creating barplots for {len(product_index_list)} datasets")
-        create_barplots(system_model, product_index_list, l_break, method_index_list, save_fig, show_fig, verbose)
-        if verbose:
-            print(f"Creating treemaps for {len(product_index_list)} datasets in {len(method_index_list)} different methods")
-        create_treemaps(system_model, product_index_list, method_index_list, save_fig, show_fig, verbose)
-
-    except NameError:
+    if system_model not in dl.system_models:
         print(f"Error: '{system_model}' is not a valid system model name.")
         print("Please select one of the following: 'cutoff', 'apos', 'consequential'.")
+        return
+    dl.select_system_model(system_model)
+
+    ie_index = dl.ie_index
+
+    if work_list is not None:
+        product_index_list = read_work_list(work_list)
+    if product_index_list is None:
+        if sample_size is not None:
+            if shard_count is not None:
+                print("Error: random samples differ between the shards, use product_index_list or work_list.")
+                return
+            product_index_list = sample(list(ie_index.index.values), sample_size)
+        else:
+            product_index_list = list(ie_index.index.values)
+
+    # Select the datasets of this shard
+    log_names = [None, None]
+    if shard_count is not None:
+        product_index_list = shard_products(product_index_list, shard_index, shard_count)
+        log_names = [f"{kind}_{system_model}_shard{shard_index}of{shard_count}" for kind in ["barplots", "treemaps"]]
+
+    # Create the plots
+    l_break = dl.l_break
+    if verbose:
+        print(f"Creating barplots for {len(product_index_list)} datasets")
+    create_barplots(system_model, product_index_list, l_break, method_index_list, save_fig, show_fig, verbose,
+                    workers, render_workers, log_format, export_xlsx, resume, log_names[0], largest_first)
+    if verbose:
+        print(f"Creating treemaps for {len(product_index_list)} datasets in {len(method_index_list)} different methods")
+    create_treemaps(system_model, product_index_list, method_index_list, save_fig, show_fig, verbose, workers,
+                    max_levels, threshold, render_workers, log_format=log_format, export_xlsx=export_xlsx,
+                    resume=resume, log_name=log_names[1], largest_first=largest_first)
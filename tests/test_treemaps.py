@@ -0,0 +1,214 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+import data_loading as dl
+import data_processing as dp
+import list_preparation as lp
+
+# Results of the pandas implementation of sort_datasets and create_dfs_barplots (before the port to arrays) for the
+# test model, see write_test_model
+expected_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "treemap_results.json")
+
+
+def write_test_model(path):
+    """
+    This function writes a small synthetic system model (see benchmark.generate_system_model) with a few datasets
+    that cover the special cases of the treemaps and bar plots: two inputs with exactly the same score (ties) on
+    the first and on the second level, a method with only negative characterization factors and a dataset
+    without any exchanges.
+
+    Required arguments:
+    - path: string, path to where the csv files are stored in folders by system model
+
+    Returns:
+    - cases: dictionary with the indices of the special datasets
+    """
+    benchmark.generate_system_model(path, n_activities=160, n_flows=60, n_methods=6, seed=1)
+    folder = f"{path}/cutoff"
+    A_public = pd.read_csv(f"{folder}/A_public.csv", sep=";")
+    B_public = pd.read_csv(f"{folder}/B_public.csv", sep=";")
+    C_public = pd.read_csv(f"{folder}/C_public.csv", sep=";")
+    ie_index = pd.read_csv(f"{folder}/ie_index.csv", sep=";", index_col="index", encoding="latin1")
+
+    # Two producers of different products with the same emissions and no inputs have exactly the same score
+    tie_1 = len(ie_index) - 1
+    tie_2 = int(np.flatnonzero(ie_index["product"].values != ie_index["product"].values[tie_1])[-1])
+    # The first level of tie_parent consists of the two ties, the second level of tie_grandparent as well
+    tie_parent, tie_grandparent, empty = [i for i in range(len(ie_index) - 2, 0, -1) if i not in (tie_1, tie_2)][:3]
+    cases = {"tie_1": tie_1, "tie_2": tie_2, "tie_parent": tie_parent, "tie_grandparent": tie_grandparent,
+             "empty": empty, "negative_method": 1}
+
+    changed = [tie_1, tie_2, tie_parent, tie_grandparent, empty]
+    A_public = A_public[~A_public["column"].isin(changed) | (A_public["row"] == A_public["column"])]
+    A_public = pd.concat([A_public, pd.DataFrame({"row": [tie_1, tie_2, tie_parent],
+                                                  "column": [tie_parent, tie_parent, tie_grandparent],
+                                                  "coefficient": [-0.25, -0.25, -0.9]})])
+    B_public = B_public[~B_public["column"].isin(changed)]
+    B_public = pd.concat([B_public, pd.DataFrame({"row": [0, 1, 0, 1, 2, 3],
+                                                  "column": [tie_1, tie_1, tie_2, tie_2, tie_parent, tie_grandparent],
+                                                  "coefficient": [1.0, 0.5, 1.0, 0.5, 0.01, 0.001]})])
+    # Only negative characterization factors
+    negative = C_public["row"] == cases["negative_method"]
+    C_public.loc[negative, "coefficient"] = -C_public.loc[negative, "coefficient"].abs()
+
+    A_public.sort_values(["column", "row"]).to_csv(f"{folder}/A_public.csv", sep=";", index=False)
+    B_public.sort_values(["column", "row"]).to_csv(f"{folder}/B_public.csv", sep=";", index=False)
+    C_public.to_csv(f"{folder}/C_public.csv", sep=";", index=False)
+
+    return cases
+
+
+@pytest.fixture(scope="module")
+def expected():
+    with open(expected_path) as expected_file:
+        return json.load(expected_file)
+
+
+@pytest.fixture(scope="module")
+def test_model(tmp_path_factory):
+    # The test model replaces the cutoff system model, the settings and a model loaded before are restored at the end
+    path = tmp_path_factory.mktemp("test_model")
+    cases = write_test_model(str(path / "raw"))
+    settings = {"path": dl.path, "cache_path": dl.cache_path, "score_path": dl.score_path,
+                "lcia_on_demand": dl.lcia_on_demand}
+    loaded_model = dl.loaded_models.pop("cutoff", None)
+    selected_system_model = dl.selected_system_model
+
+    dl.path = str(path / "raw")
+    dl.cache_path = str(path / "cache")
+    dl.score_path = str(path / "scores")
+    dl.lcia_on_demand = False
+    dp.treemap_cache.clear()
+    dp.exchange_cache.clear()
+    dl.select_system_model("cutoff")
+    yield cases
+
+    for name, value in settings.items():
+        setattr(dl, name, value)
+    dl.loaded_models.pop("cutoff", None)
+    if loaded_model is not None:
+        dl.loaded_models["cutoff"] = loaded_model
+    dp.treemap_cache.clear()
+    dp.exchange_cache.clear()
+    if selected_system_model is not None:
+        dl.select_system_model(selected_system_model)
+    else:
+        dl.selected_system_model = None
+
+
+def assert_same(result, expected_result, key):
+    # Strings, integers and the structure have to be the same, floats up to rounding
+    if isinstance(expected_result, float):
+        assert result == pytest.approx(expected_result, rel=1e-9, abs=1e-15), key
+    elif isinstance(expected_result, list):
+        assert len(result) == len(expected_result), key
+        for item, expected_item in zip(result, expected_result):
+            assert_same(item, expected_item, key)
+    else:
+        assert result == expected_result, key
+
+
+def plain(value):
+    # Numpy values and arrays as python values and lists, as in the json file
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [plain(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# Sorting and grouping
+@pytest.mark.parametrize("ascending", [True, False])
+def test_score_order_ties(ascending):
+    rng = np.random.default_rng(0)
+    for scores in [rng.integers(-3, 4, 200).astype(float), -rng.integers(1, 4, 50).astype(float), np.zeros(7),
+                   np.array([2.0, 1.0, 2.0, 1.0, 2.0])]:
+        expected_order = pd.Series(scores).sort_values(ascending=ascending).index.values
+        assert dp.score_order(scores, ascending).tolist() == expected_order.tolist()
+
+
+@pytest.mark.parametrize("sort", [True, False])
+def test_group_scores(sort):
+    rng = np.random.default_rng(1)
+    for codes, scores in [(rng.integers(-1, 12, 300), rng.integers(-3, 4, 300).astype(float)),
+                          (rng.integers(0, 5, 40), -rng.random(40)),
+                          (np.array([3, 1, 3, 2, 1, 2]), np.array([1.0, 0.5, 1.0, 2.0, 1.5, 0.0]))]:
+        valid = codes >= 0
+        grouped = pd.DataFrame({"code": codes[valid], "score": scores[valid]}).groupby("code")["score"].sum()
+        if sort:
+            grouped = grouped.sort_values(ascending=False)
+        group_codes, group_values = dp.group_scores(codes, scores, sort)
+        assert group_codes.tolist() == grouped.index.tolist()
+        assert group_values == pytest.approx(grouped.values, rel=1e-12)
+
+
+# Treemaps
+def test_cases_are_covered(test_model, expected):
+    assert test_model == expected["cases"]
+    results = expected["treemaps"]
+    assert {result[5] for result in results.values()} == {1, 2, 3, 4, 5, 6}
+    assert {result[7] for result in results.values()} == {"pos", "neg", "zero"}
+
+    # The two inputs of tie_parent have the same score for every method, so do the inputs of its max contributor
+    for method_index in range(len(dl.LCIA_index)):
+        lcia, (column,) = dl.lcia_scores([method_index])
+        assert lcia[test_model["tie_1"], column] == lcia[test_model["tie_2"], column]
+    negative = [result for key, result in results.items()
+                if int(key.split(",")[1]) == test_model["negative_method"] and result[7] == "neg"]
+    assert negative
+
+
+def test_sort_datasets(test_model, expected):
+    for key, expected_result in expected["treemaps"].items():
+        prod_index, method_index = map(int, key.split(","))
+        assert_same(plain(lp.sort_datasets(prod_index, method_index)), expected_result, key)
+
+
+@pytest.mark.parametrize("max_levels", [1, 2, 3, 4, 5])
+def test_sort_datasets_max_levels(test_model, expected, max_levels):
+    truncated = 0
+    for key, expected_result in expected["treemaps"].items():
+        prod_index, method_index = map(int, key.split(","))
+        result = plain(lp.sort_datasets(prod_index, method_index, max_levels))
+        level = result[5]
+        expected_level = expected_result[5]
+
+        # The boxes up to max_levels are the same as in the treemap with all the levels. Their labels and values can
+        # differ, because the max contributor of the last level is not broken down.
+        for i in [1, 2, 4]:
+            assert_same(result[i], expected_result[i][:len(result[i])], key)
+        assert_same(result[6], expected_result[6], key)
+        if expected_level <= max_levels:
+            assert level == expected_level, key
+        else:
+            assert level in (max_levels, max_levels + 1), key
+            truncated += 1
+    if max_levels < 5:
+        assert truncated > 0
+
+
+# Bar plots
+def test_create_dfs_barplots(test_model, expected):
+    for entry in expected["barplots"]:
+        key = (entry["prod_index"], entry["method_index_list"])
+        grouped_sorted, chart_type_1, chart_type_2 = dp.create_dfs_barplots(*key)
+        assert [chart_type_1, chart_type_2] == entry["chart_types"], key
+        rows = grouped_sorted[entry["columns"]].astype(object).where(grouped_sorted[entry["columns"]].notna(), None)
+        assert_same(plain(rows.values.tolist()), entry["rows"], key)
+
+
+def test_barplot_dfs(test_model, expected):
+    prod_index_list = list(range(len(dl.ie_index)))
+    for method_index_list in {tuple(entry["method_index_list"]) for entry in expected["barplots"]}:
+        method_index_list = list(method_index_list)
+        dfs = dp.barplot_dfs(prod_index_list, method_index_list)
+        for prod_index in prod_index_list:
+            if dfs[prod_index] is None:
+                continue
+            grouped_sorted, chart_type_1, chart_type_2 = dp.create_dfs_barplots(prod_index, method_index_list)
+            pd.testing.assert_frame_equal(dfs[prod_index][0], grouped_sorted)
+            assert dfs[prod_index][1:] == (chart_type_1, chart_type_2)